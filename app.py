@@ -1,33 +1,49 @@
 import streamlit as st
 import base64
-import anthropic
-import matplotlib.pyplot as plt
-import tempfile
+import contextvars
+import hashlib
 import os
+import threading
+import uuid
+from collections import namedtuple
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from datetime import datetime
-import json
-
-prompt_example_img = """
-观察上面的图像，图像中是一个什么样的曲线？曲线中有哪些要素？
-1.请你帮我使用Python代码复现这张figure;
-2.复现的时候，尤其注意原图的色彩风格，图形样式，力求与原图一致;
-3.如果你读取图中数据有困难，可以自己生成示例数据;
-注意，我会将你回答的内容直接放进一个exec(code, {"plt": plt})语句中，所以:
-1.请你保证你返回的内容直接就是一个可以执行的代码，不要包括解释或者markdown元素等内容;
-2.你绘制的图像应该保存在一个plt对象中，以便我提取回传到其他逻辑里;
-3.在添加颜色条时，确保绑定到正确的图形对象 (使用 fig.colorbar);
-4.避免出现紧凑布局与颜色条冲突的问题;
-5.我的环境中没有GUI界面，不要出现plt.show();
-"""
-
-prompt_doc = f"""
-请你帮我把下面的代码抽象为一个函数，要求如下:
-1.函数名为generate_figure;
-2.函数的输入参数为图像所需要的路径，以及一些可以自定义的参数（如色彩、样式等），这些参数要有一个默认值;
-3.函数的输出为一个plt对象;
-4.函数中所有的注释、参数解释都应当使用中文;
-下面是我需要你帮忙处理的代码：
-"""
+from queue import Empty, SimpleQueue
+import time
+
+import metrics
+from artifacts import MANIFEST_SUFFIX, RUNS_PREFIX
+from cache import CachedRequest
+from claude_client import (
+    DEFAULT_MAX_TOKENS, DEFAULT_MODEL, acreate_message, api_errors, astream_message, count_tokens, create_message,
+    preload, run_sync, submit
+)
+from code_check import extract_code, find_partial_syntax_error
+from history import DEFAULT_TOKEN_BUDGET, estimate_tokens, first_image_bytes
+from jobqueue import DONE, FINISHED_STATUSES, QUEUED, get_default_queue
+from library import get_default_library
+from panels import detect_panels, panel_label, reconstruct_panels
+from preprocess import DEFAULT_MAX_LONG_EDGE, preprocess_image
+from pricing import estimate_cost
+from prompts import PROMPT_VARIANTS, prompt_doc, prompt_example_img, prompt_spec
+from repair import format_exec_error, generate_with_repair, render_spec_reply
+from resources import SessionEvicted, format_bytes, get_default_registry, maybe_collect_garbage, usage_report
+from routing import DEFAULT_VARIANT, Router, format_summary, get_default_stats, route_models
+from sandbox import PREVIEW_DPI, get_default_pool
+from similarity import SimilarityScore, compare, format_score, reference_from_messages
+from storage import get_default_persister
+
+CLAUDE_MODEL = DEFAULT_MODEL
+MAX_TOKENS = DEFAULT_MAX_TOKENS
+MAX_STREAM_ATTEMPTS = 3  # 流式生成因语法错误被提前中止时的最大尝试次数
+MAX_REPAIR_RETRIES = 3  # 代码执行失败后自动修复的默认最大次数
+JOB_POLL_INTERVAL = 0.5  # 任务队列模式下轮询任务状态的间隔（秒）
+PROGRESS_POLL_INTERVAL = 0.05  # 生成过程中在脚本线程里检查进度更新的间隔（秒）
+DEFAULT_EXPORT_DPI = 100  # 与 matplotlib 的默认 DPI 相同
+
+# 后台生成文档的任务：digest 为代码的 SHA-256，future 的结果为 (文档文本, API 响应)，
+# cancelled 被设置后任务不再发出请求（任务队列模式下同时取消队列中的文档任务）
+DocTask = namedtuple("DocTask", ["digest", "future", "cancelled"])
 
 def encode_image_to_base64(image_path):
     """将图片转换为 Base64 格式，并返回图片的媒体类型"""
@@ -48,45 +64,93 @@ def encode_image_to_base64(image_path):
     
     return image_data, media_type
 
-def count_tokens_and_estimate_cost(response):
-    # 获取输入和输出 token 数
-    input_tokens = response.usage.input_tokens
-    output_tokens = response.usage.output_tokens
+def preprocess_and_encode(image, max_long_edge=DEFAULT_MAX_LONG_EDGE, crop_borders=False):
+    """
+    预处理图片（限制尺寸、裁边、选择更小的编码格式）后转换为 Base64，返回 (image_data, media_type, report)。
+    image 可以是图片字节（例如上传文件的内容），也可以是文件路径。
+    """
+    if isinstance(image, str):
+        with open(image, "rb") as f:
+            image = f.read()
+    result = preprocess_image(image, max_long_edge=max_long_edge, crop_borders=crop_borders)
+    image_data = base64.standard_b64encode(result.data).decode("utf-8")
+    return image_data, result.media_type, result.report
 
-    # 定价
-    cost_per_tok_input = 3.00 / 1000000  # 每token 输入成本
-    cost_per_tok_output = 15.00 / 1000000  # 每 token 输出成本
+def show_preprocess_report(report):
+    """在界面中显示图片预处理节省的体积和 token"""
+    st.write("### 图片预处理")
+    st.write(f"- 尺寸: {report['original_size'][0]}×{report['original_size'][1]} → "
+             f"{report['new_size'][0]}×{report['new_size'][1]}，格式: {report['format']}")
+    st.write(f"- 体积: {report['original_bytes'] / 1024:.1f} KB → {report['new_bytes'] / 1024:.1f} KB"
+             f"（节省 {report['bytes_saved'] / 1024:.1f} KB）")
+    st.write(f"- 预计图片 tokens: {report['original_tokens']} → {report['new_tokens']}"
+             f"（每轮节省 {report['tokens_saved']}）")
 
-    # 计算费用
-    input_cost = input_tokens * cost_per_tok_input
-    output_cost = output_tokens * cost_per_tok_output
-    total_cost = input_cost + output_cost
-    total_tokens = input_tokens + output_tokens
+def count_tokens_and_estimate_cost(response):
+    # 获取各类 token 数并按模型价格计算费用（包括提示缓存的写入和读取）
+    cost = estimate_cost(response.usage, getattr(response, "model", None) or CLAUDE_MODEL)
+    total_tokens = (cost["input_tokens"] + cost["cache_write_tokens"]
+                    + cost["cache_read_tokens"] + cost["output_tokens"])
 
     # 使用 Streamlit 输出
     st.write("### Token 使用情况和费用估算")
-    st.write(f"- 输入 tokens: {input_tokens}")
-    st.write(f"- 输出 tokens: {output_tokens}")
+    st.write(f"- 输入 tokens: {cost['input_tokens']}")
+    st.write(f"- 缓存写入 tokens: {cost['cache_write_tokens']}")
+    st.write(f"- 缓存读取 tokens: {cost['cache_read_tokens']}")
+    st.write(f"- 输出 tokens: {cost['output_tokens']}")
     st.write(f"- 总 tokens: {total_tokens}")
-    st.write(f"- 预计费用: ${total_cost:.2f}")
-
-def call_claude_api(messages):
-    """调用 Claude API 获取代码回复"""
-    client = anthropic.Anthropic()
-    response = client.messages.create(
-        model="claude-3-5-sonnet-20241022",
-        max_tokens=2048,
-        messages=messages
-    )   
+    st.write(f"- 预计费用: ${cost['cost']:.4f}")
+    if cost["cache_write_tokens"] or cost["cache_read_tokens"]:
+        st.write(f"- 不使用提示缓存的费用: ${cost['cost_without_cache']:.4f}，"
+                 f"节省: ${cost['saved']:.4f}")
+
+def call_claude_api(messages, use_cache=True, prompt_cache=True, model=CLAUDE_MODEL):
+    """调用 Claude API 获取代码回复，相同请求优先从磁盘缓存返回；prompt_cache 控制是否加提示缓存标记"""
+    cached_request = CachedRequest(messages, model, MAX_TOKENS, use_cache)
+    cached = cached_request.get()
+    if cached is not None:
+        st.write("命中本地缓存，本次调用无 API 费用")
+        return cached
+
+    try:
+        # 共享的连接池客户端，带超时、并发上限和 429/5xx 退避重试
+        response = create_message(messages, model=model, max_tokens=MAX_TOKENS,
+                                  prompt_cache=prompt_cache)
+    except api_errors() as e:
+        st.error(f"API 调用失败: {e}")
+        return None
     
     if response:
         count_tokens_and_estimate_cost(response)
+        cached_request.put(response)
         return response.content
     else:
         st.error("API 调用失败")
         return None
 
-def execute_code(code, output_path):
+def invalidate_cached_response(messages, model=CLAUDE_MODEL):
+    """删除某个请求的缓存回复（例如回复的代码执行失败时），避免重试时拿到同样的结果"""
+    CachedRequest(messages, model, MAX_TOKENS).discard()
+
+def render_options(final=False):
+    """
+    沙箱的渲染参数（见 sandbox.SandboxPool.run）。
+    勾选“快速预览”时，生成和修复过程中以低分辨率渲染并抽稀密集的图形元素；final 为 True 时按导出设置渲染。
+    """
+    width = st.session_state.get("export_width", 0.0)
+    height = st.session_state.get("export_height", 0.0)
+    options = {
+        "fast": st.session_state.get("render_fast", True),
+        "figsize": (width, height) if width and height else None,
+    }
+    if st.session_state.get("render_preview", True) and not final:
+        options.update(preview=True, dpi=PREVIEW_DPI)
+    else:
+        options["dpi"] = st.session_state.get("export_dpi", DEFAULT_EXPORT_DPI)
+    return options
+
+def execute_code(code):
+    """在沙箱中执行代码并显示生成的图像，返回 PNG 字节（只在内存中，不写文件）"""
     try:
         # 确保 code 是字符串
         if isinstance(code, list) and len(code) > 0 and hasattr(code[0], 'text'):
@@ -98,14 +162,15 @@ def execute_code(code, output_path):
         if not isinstance(code, str):
             raise ValueError("返回的代码内容格式不正确，无法执行。")
 
-        # 执行代码
-        exec(code, {"plt": plt})
+        # 在沙箱工作进程中执行代码，得到 PNG 图片
+        options = render_options()
+        result = get_default_pool().run(code, **options)
+        if not result.ok:
+            raise RuntimeError(format_exec_error(result))
 
-        # 刷新绘图上下文并保存
-        plt.gcf().canvas.draw_idle()
-        plt.savefig(output_path)
-        st.image(output_path, caption="生成的图像")  # 在 Streamlit 界面中显示图片
-        plt.close()
+        caption = "生成的图像（预览）" if options.get("preview") else "生成的图像"
+        st.image(result.png, caption=caption)  # 在 Streamlit 界面中显示图片
+        return result.png
     except Exception as e:
         raise RuntimeError(f"代码执行出错: {e}")
 
@@ -115,44 +180,584 @@ def initialize_session_state():
         st.session_state.generation_count = 0
     if 'current_code' not in st.session_state:
         st.session_state.current_code = None
-    if 'conversation_history' not in st.session_state:
-        st.session_state.conversation_history = None
+    if 'conversation_turns' not in st.session_state:
+        st.session_state.conversation_turns = None
     if 'is_generated' not in st.session_state:
         st.session_state.is_generated = False
     if 'is_satisfied' not in st.session_state:
         st.session_state.is_satisfied = False
 
-def generate_new_image(conversation_history, output_path):
-    """生成新的图像"""
-    st.info("正在调用 Claude API...")
-    response = call_claude_api(conversation_history)
-    
-    if response:
+def session_id():
+    """当前浏览器会话的 id，用于在 resources.SessionRegistry 中记录会话持有的图片"""
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "default"
+
+def get_conversation():
+    """
+    取得当前会话的对话历史。session_state 中只保存图片的内容哈希（见 resources.py），
+    这里还原为带 base64 图片的消息；会话已被释放时抛出 SessionEvicted
+    """
+    turns = st.session_state.get("conversation_turns")
+    if turns is None:
+        return None
+    return get_default_registry().load_messages(turns)
+
+def set_conversation(messages):
+    """保存对话历史：图片放进进程内共享的图片存储，同一张图在多轮对话和多个会话之间只存一份"""
+    if messages is None:
+        st.session_state.conversation_turns = None
+        return
+    st.session_state.conversation_turns = get_default_registry().keep_messages(session_id(), messages)
+
+def set_current_png(png):
+    """记录当前显示的图像（同样只在 session_state 中保存内容哈希）"""
+    digest = None
+    if png is not None:
+        digest = get_default_registry().keep_bytes(session_id(), png, slot="figure")
+    st.session_state.current_figure = digest
+
+def current_png():
+    figure = st.session_state.get("current_figure")
+    if figure is None:
+        return None
+    try:
+        return get_default_registry().load_bytes(figure)
+    except SessionEvicted:
+        return None
+
+def reset_session():
+    """会话空闲太久、占用的图片已被释放时，清空生成状态，等待用户重新开始"""
+    cancel_doc_tasks()
+    for key in ("current_code", "current_reply", "conversation_turns", "current_figure", "final_export",
+                "pending_job", "library_doc", "saved_run"):
+        st.session_state[key] = None
+    st.session_state.generation_count = 0
+    st.session_state.is_generated = False
+    st.session_state.is_satisfied = False
+    st.session_state.session_expired = True
+
+def handle_restart():
+    st.session_state.session_expired = False
+
+@st.cache_data(ttl=60, show_spinner=False)
+def disk_usage():
+    """各目录的磁盘占用，遍历目录较慢，一分钟内的页面执行共用一次结果"""
+    return usage_report()["disk"]
+
+def show_resource_usage():
+    """在侧边栏显示进程内存、图片存储和磁盘占用（同样的数据以 Prometheus 仪表的形式输出到 /metrics）"""
+    with st.sidebar.expander("资源使用"):
+        report = usage_report(get_default_registry(), disk=False)
+        rss = report["rss"]
+        st.write(f"进程内存: {format_bytes(rss) if rss is not None else '未知'}")
+        st.write(f"活动会话: {report['sessions']}")
+        st.write(f"共享图片: {report['images']} 张，{format_bytes(report['image_bytes'])}，"
+                 f"被引用 {report['image_refs']} 次")
+        for kind, size in disk_usage().items():
+            st.write(f"磁盘 {kind}: {format_bytes(size)}")
+
+def output_format():
+    """侧边栏选择的生成方式："code" 让模型直接写绘图代码，"spec" 让模型返回数据规格（见 spec_render.py）"""
+    return st.session_state.get("output_format", "code")
+
+def split_panels_enabled():
+    """
+    是否拆分多子图：只在第一次生成时拆分，之后的修改按整张图进行。
+    子图按 draw_panel(ax) 函数生成，与数据规格模式不能同时使用
+    """
+    return (output_format() == "code" and st.session_state.get("split_panels", False)
+            and st.session_state.generation_count == 0)
+
+def get_router():
+    """按侧边栏的设置构造 routing.Router；既不逐级升级也不分配候选时返回 None，始终使用 CLAUDE_MODEL"""
+    escalate = st.session_state.get("route_escalate", False)
+    fan_out = st.session_state.get("route_fan_out", False)
+    if not escalate and not fan_out:
+        return None
+    variants = st.session_state.get("prompt_variants") or [DEFAULT_VARIANT]
+    return Router(route_models(), variants=variants, fan_out=fan_out)
+
+def routing_options():
+    """提交到任务队列的路由设置（见 worker.py），不使用路由时为 None"""
+    router = get_router()
+    if router is None:
+        return None
+    return {"models": router.models, "variants": router.variants, "fan_out": router.fan_out}
+
+def show_route_stats():
+    """在侧边栏显示各模型的实测统计和当前的升级顺序"""
+    stats = get_default_stats()
+    with st.sidebar.expander("模型实测统计"):
+        summaries = stats.summaries()
+        if not summaries:
+            st.write("还没有记录")
+        for summary in summaries:
+            st.write(f"**{summary.model}**: {format_summary(summary)}")
+        st.write(f"逐级升级顺序: {' → '.join(Router(route_models(), stats=stats).plan())}")
+
+def token_counter():
+    """压缩对话历史时计算 token 的方式：勾选“使用 API 计算 token”时调用计数接口，出错时退回本地估算"""
+    if not st.session_state.get("count_tokens_via_api", False):
+        return estimate_tokens
+
+    def count(messages):
         try:
-            execute_code(response, output_path)
-            code = response[0].text
-            if "```python" in code and "```" in code:
-                code = code.split("```python\n", 1)[-1].split("```", 1)[0]
-            st.code(code)
-            return True, code
-        except RuntimeError as e:
-            error_info = str(e)
-            st.error(f"执行代码失败: {error_info}")
-            return False, None
-    return False, None
+            return count_tokens(messages, model=CLAUDE_MODEL)
+        except api_errors():
+            return estimate_tokens(messages)
+    return count
+
+def run_with_progress(coro, updates):
+    """
+    在后台事件循环中运行 coro，同时在脚本线程中依次执行协程放进 updates 的界面更新 (函数, 参数)。
+    Streamlit 只能在脚本线程中输出，进度回调在事件循环中被调用，只能把要显示的内容交给这里。
+    """
+    future = submit(coro)
+    while not future.done():
+        try:
+            update, args = updates.get(timeout=PROGRESS_POLL_INTERVAL)
+        except Empty:
+            continue
+        update(*args)
+    while not updates.empty():
+        update, args = updates.get()
+        update(*args)
+    return future.result()
+
+def generate_new_image(conversation_history):
+    """
+    生成新的图像。请求、执行、自动修复和按相似度改进的循环由 repair.generate_with_repair 完成，这里只显示进度：
+    代码执行失败时把错误信息发回给模型修复，最多修复 max_repair_retries 次；设置了相似度目标时，
+    得分未达标的图像也会占用一次重试，最终采用得分最高的一次。
+
+    返回 (success, code, conversation_history, png)，conversation_history 包含修复过程中的对话轮次，
+    png 为采用的图像字节。采用的回复原文记在 st.session_state.current_reply 中（数据规格模式下为规格 JSON）。
+    """
+    n_candidates = st.session_state.get("n_candidates", 1)
+    threshold = st.session_state.get("similarity_threshold", 0.0) or None
+    reference = reference_from_messages(conversation_history)
+    options = render_options()
+    # 多个相同的请求会命中同一条缓存，只有一个候选时才读写响应缓存、流式显示；
+    # 数据规格是 JSON，不能按 Python 代码检查流式输出中的语法错误
+    use_cache = n_candidates == 1 and not st.session_state.get("bypass_cache", False)
+    stream = n_candidates == 1 and st.session_state.get("stream_output", True) and output_format() != "spec"
+    updates = SimpleQueue()
+    shown = {}
+
+    def later(update, *args):
+        updates.put((update, args))
+
+    def show_round(round_index, routes, tokens):
+        if tokens is not None:
+            st.info(f"对话历史约 {tokens[0]} tokens，超过预算 {st.session_state.token_budget}，"
+                    f"已压缩为约 {tokens[1]} tokens")
+        model = routes[0].model
+        if round_index == 0:
+            st.info(f"正在调用 Claude API（{model}）..." if n_candidates == 1 else "正在调用 Claude API...")
+        else:
+            st.info(f"正在进行第 {round_index} 次自动修复（{model}）..." if n_candidates == 1
+                    else f"正在进行第 {round_index} 次自动修复...")
+        if n_candidates > 1:
+            names = "、".join(sorted({f"{route.model}/{route.variant}" for route in routes}))
+            st.write(f"并发请求 {len(routes)} 个候选（{names}），采用第一个执行成功的")
+        shown["stream"] = st.empty()
+
+    def show_candidate(route, messages, reply, code, result, score):
+        if not result.ok:
+            st.error(f"执行代码失败: {format_exec_error(result)}")
+            invalidate_cached_response(messages, route.model)
+            return
+        caption = "生成的图像（预览）" if options.get("preview") else "生成的图像"
+        if n_candidates > 1:
+            caption += f"（{route.model}/{route.variant}）"
+        st.image(result.png, caption=caption)
+        st.code(code)
+        if score is None and reference is not None:
+            score = compare(reference, result.png)
+        if score is not None:
+            st.write(f"与原图的相似度: {format_score(score)}")
+
+    async def stream_reply(messages, model):
+        """流式请求：边生成边显示代码，已到达的代码出现语法错误时提前中止并重新生成"""
+        text = ""
+        for attempt in range(MAX_STREAM_ATTEMPTS):
+            progress = {"lines": 0, "rendered": 0.0, "error": None}
+
+            def on_text(delta, text):
+                # 限制刷新频率，避免每个 token 都重绘页面
+                now = time.monotonic()
+                if now - progress["rendered"] > 0.1:
+                    later(lambda code: shown["stream"].code(code), extract_code(text))
+                    progress["rendered"] = now
+                # 每到达一行新代码就检查一次语法
+                lines = text.count("\n")
+                if lines > progress["lines"]:
+                    progress["lines"] = lines
+                    progress["error"] = find_partial_syntax_error(text)
+                    return progress["error"] is None
+
+            response, text, aborted = await astream_message(messages, model=model, max_tokens=MAX_TOKENS,
+                                                            on_text=on_text)
+            later(lambda: shown["stream"].empty())
+            if not aborted:
+                return response, text
+            later(st.warning, f"第 {attempt + 1} 次生成的代码{progress['error']}，已提前中止并重新生成")
+        # 连续几次都被中止时采用最后一次的部分代码，语法错误作为执行失败发回模型修复
+        return None, text
+
+    async def request(messages, route, max_tokens):
+        cached_request = CachedRequest(messages, route.model, max_tokens, use_cache)
+        cached = cached_request.get()
+        if cached is not None:
+            later(st.write, "命中本地缓存，本次调用无 API 费用")
+            return cached[0].text, 0.0
+        if stream:
+            response, text = await stream_reply(messages, route.model)
+            if response is None:
+                return text, 0.0
+        else:
+            response = await acreate_message(messages, model=route.model, max_tokens=max_tokens)
+        later(count_tokens_and_estimate_cost, response)
+        cached_request.put(response)
+        return response.content[0].text, estimate_cost(response.usage, route.model)["cost"]
+
+    try:
+        outcome = run_with_progress(generate_with_repair(
+            conversation_history, get_default_pool(),
+            max_retries=st.session_state.get("max_repair_retries", MAX_REPAIR_RETRIES),
+            n_candidates=n_candidates, model=CLAUDE_MODEL, max_tokens=MAX_TOKENS,
+            token_budget=st.session_state.get("token_budget", DEFAULT_TOKEN_BUDGET), count_tokens=token_counter(),
+            similarity_threshold=threshold, exec_options=options, router=get_router(),
+            output_format=output_format(), request=request,
+            on_round=lambda *args: later(show_round, *args),
+            on_candidate=lambda *args: later(show_candidate, *args),
+        ), updates)
+    except api_errors() as e:
+        st.error(f"API 调用失败: {e}")
+        return False, None, conversation_history, None
+
+    if not outcome.ok:
+        st.error("已达到最大重试次数，无法成功生成图表。")
+        return False, None, conversation_history, None
+    st.session_state.current_reply = outcome.reply
+    if threshold is not None and outcome.score is not None and outcome.score.score < threshold:
+        st.warning(f"相似度未达到目标 {threshold:.2f}，采用得分最高的一次: {format_score(outcome.score)}")
+        st.image(outcome.result.png, caption="采用的图像")
+    return True, outcome.code, outcome.messages, outcome.result.png
+
+def generate_panels(image_bytes, conversation_history):
+    """
+    原图是多子图的组合图时，拆成子图并发复现后再拼回原来的布局。
+    返回与 generate_new_image 相同的结果；只检测到一个子图时返回 None，由调用方整张生成。
+    """
+    layout = detect_panels(image_bytes)
+    if len(layout.panels) < 2:
+        return None
+    st.info(f"检测到 {len(layout.panels)} 个子图（{layout.nrows}×{layout.ncols} 网格），正在并发复现各子图...")
+    try:
+        outcome = run_sync(reconstruct_panels(
+            image_bytes, get_default_pool(), layout,
+            max_retries=st.session_state.get("max_repair_retries", MAX_REPAIR_RETRIES), max_tokens=MAX_TOKENS,
+            max_long_edge=st.session_state.get("max_long_edge", DEFAULT_MAX_LONG_EDGE),
+            exec_options=render_options(), router=get_router(),
+        ))
+    except api_errors() as e:
+        st.error(f"API 调用失败: {e}")
+        return False, None, conversation_history, None
+
+    columns = st.columns(min(len(layout.panels), 4))
+    for i, (panel, panel_outcome) in enumerate(zip(layout.panels, outcome.outcomes)):
+        with columns[i % len(columns)]:
+            if isinstance(panel_outcome, Exception) or not panel_outcome.ok:
+                st.warning(f"子图 {panel_label(panel)} 复现失败，用占位代替")
+            else:
+                st.image(panel_outcome.result.png, caption=f"子图 {panel_label(panel)}")
+    st.write(f"各子图共执行了 {outcome.attempts} 个候选")
+    if not outcome.result.ok:
+        st.error(f"拼合子图的代码执行失败: {format_exec_error(outcome.result)}")
+        return False, None, conversation_history, None
+
+    st.image(outcome.result.png, caption="拼合后的图像")
+    st.code(outcome.code)
+    reference = reference_from_messages(conversation_history)
+    if reference is not None:
+        st.write(f"与原图的相似度: {format_score(compare(reference, outcome.result.png))}")
+    # 之后的修改按整张图进行，对话中接着的是拼合后的代码
+    st.session_state.current_reply = None
+    return True, outcome.code, conversation_history, outcome.result.png
+
+# Streamlit 每次交互都会重新执行整个脚本，模块级变量每次都是新的；
+# 需要在多次执行之间保留的对象放在 st.cache_resource 中，整个进程只创建一次
+@st.cache_resource(show_spinner=False)
+def get_export_executor():
+    """确认采用的图像在后台按导出设置重新渲染，不阻塞页面"""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="export")
+
+@st.cache_resource(show_spinner=False)
+def warm_up(start_pool):
+    """
+    第一次显示页面时在后台导入 anthropic（一秒多）、启动沙箱进程池，
+    页面不用等它们，用户上传图片时通常已经准备好。
+    """
+    preload()
+    if start_pool:
+        threading.Thread(target=get_default_pool, name="sandbox-warmup", daemon=True).start()
+    return True
+
+def _render_final(code, spec_reply, options):
+    if spec_reply is not None:
+        _, result = render_spec_reply(spec_reply, **options)
+    else:
+        result = get_default_pool().run(code, **options)
+    if not result.ok:
+        raise RuntimeError(format_exec_error(result))
+    return result.png
+
+def unique_name(date_str, base):
+    """
+    保存用的名称。时间只精确到分钟，不同会话在同一分钟内上传同名文件时，
+    加上随机后缀才不会互相覆盖 runs/ 中的清单和图像
+    """
+    return f"{date_str}_{base}_{uuid.uuid4().hex[:8]}"
+
+def start_final_export(code, spec_reply=None):
+    """
+    在后台按导出设置重新执行采用的代码，返回 Future（结果为高清图像的 PNG 字节）；
+    数据规格模式下给出 spec_reply（模型回复的规格 JSON），按规格直接渲染，不执行代码
+    """
+    context = contextvars.copy_context()
+    return get_export_executor().submit(context.run, _render_final, code, spec_reply, render_options(final=True))
+
+def final_png():
+    """取得采用的高清图像：后台导出还没完成时等待，导出失败时退回到预览图"""
+    future = st.session_state.get("final_export")
+    if future is None:
+        return current_png()
+    try:
+        with st.spinner("正在导出高清图像..."):
+            return future.result()
+    except RuntimeError as e:
+        st.warning(f"高清图像导出失败，使用预览图: {e}")
+        return current_png()
+
+def reuse_from_library(conversation_history):
+    """
+    在图库中查找与上传图片足够接近的图。勾选了“直接复用图库中的相似图”时在沙箱中执行保存的代码，
+    成功则返回与 generate_new_image 相同的结果，不调用 API；否则只展示保存的代码，返回 None。
+    图库中索引的是对话里预处理后的原图（见 main 中的 library.add 和 library.build），查询时也用同一份字节。
+    """
+    library = get_default_library()
+    if library is None or len(library) == 0:
+        return None
+    with metrics.timed("library_lookup", entries=len(library)):
+        match = library.find(first_image_bytes(conversation_history))
+    if match is None:
+        return None
+
+    st.info(f"图库中有相似的图（特征相似度 {match.similarity:.3f}，来源 {match.source or match.id}）")
+    # 任务队列模式下代码统一由工作进程执行，这里只展示
+    if not st.session_state.get("reuse_library", True) or get_default_queue() is not None:
+        with st.expander("图库中保存的代码"):
+            st.code(match.code)
+            if match.doc:
+                st.write(match.doc)
+        return None
+
+    try:
+        png = execute_code(match.code)
+    except RuntimeError as e:
+        st.warning(f"图库中的代码执行失败，改为调用 Claude API: {e}")
+        return None
+    st.code(match.code)
+    reference = reference_from_messages(conversation_history)
+    if reference is not None:
+        st.write(f"与原图的相似度: {format_score(compare(reference, png))}")
+    metrics.log_event("library_reuse", entry=match.id, similarity=round(match.similarity, 4))
+    # 确认满意时直接使用保存的文档，不再请求
+    st.session_state.library_doc = (match.code, match.doc)
+    st.session_state.current_reply = None
+    return True, match.code, conversation_history, png
+
+def wait_for_job(queue, job_id):
+    """轮询任务状态直到任务结束，返回 Job（任务不存在时返回 None）"""
+    placeholder = st.empty()
+    while True:
+        job = queue.get(job_id)
+        if job is None or job.status in FINISHED_STATUSES:
+            placeholder.empty()
+            return job
+        if job.status == QUEUED:
+            placeholder.info(f"任务 {job_id} 排队中，前面还有 {queue.position(job_id) or 0} 个任务")
+        else:
+            placeholder.info(f"任务 {job_id} 正在由工作进程 {job.worker} 处理...")
+        time.sleep(JOB_POLL_INTERVAL)
+
+def generate_via_queue(queue, conversation_history):
+    """
+    把生成任务提交到任务队列，由工作进程调用 API 和执行代码，页面只轮询结果。
+    任务 id 同时记在 URL 参数中，刷新页面后可以找回。返回值与 generate_new_image 相同。
+    """
+    job_id = st.session_state.get("pending_job")
+    if job_id is None:
+        threshold = st.session_state.get("similarity_threshold", 0.0) or None
+        job_id = queue.submit("generate", {
+            "messages": conversation_history,
+            "max_retries": st.session_state.get("max_repair_retries", MAX_REPAIR_RETRIES),
+            "n_candidates": st.session_state.get("n_candidates", 1),
+            "token_budget": st.session_state.get("token_budget", DEFAULT_TOKEN_BUDGET),
+            "similarity_threshold": threshold,
+            # 工作进程直接按导出设置渲染，不需要再单独导出
+            "exec_options": render_options(final=True),
+            "routing": routing_options(),
+            "output_format": output_format(),
+            "split_panels": split_panels_enabled(),
+            "image_name": st.session_state.get("image_name"),
+            "generation_count": st.session_state.generation_count,
+        })
+        st.session_state.pending_job = job_id
+        st.query_params["job"] = job_id
+
+    job = wait_for_job(queue, job_id)
+    st.session_state.pending_job = None
+    if job is None or job.status != DONE:
+        error = "任务不存在" if job is None else (job.error or job.status).splitlines()[0]
+        st.error(f"生成任务失败: {error}")
+        return False, None, conversation_history, None
+
+    result = job.result
+    st.session_state.current_reply = result.get("reply")
+    st.image(job.png, caption="生成的图像")
+    st.code(result["code"])
+    if result.get("score"):
+        st.write(f"与原图的相似度: {format_score(SimilarityScore(**result['score']))}")
+    return True, result["code"], result["messages"], job.png
+
+def restore_job(queue, job_id):
+    """刷新页面后根据 URL 中的任务 id 恢复会话：任务完成则直接显示结果，否则继续等待"""
+    job = queue.get(job_id)
+    if job is None or job.kind != "generate":
+        del st.query_params["job"]
+        return
+    set_conversation(job.payload["messages"])
+    st.session_state.image_name = job.payload.get("image_name")
+    st.session_state.generation_count = job.payload.get("generation_count", 0)
+    st.session_state.pending_job = job_id
+
+def code_digest(code):
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+def doc_messages(code):
+    return [
+        {
+            "role": "user",
+            "content": [{"type": "text", "text": prompt_doc + code}],
+        },
+    ]
+
+@st.cache_resource(show_spinner=False)
+def get_doc_executor():
+    """后台生成文档的线程池，和导出一样在多次执行脚本之间共用"""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="doc")
+
+def _fetch_doc(code, use_cache, queue, cancelled):
+    """
+    在后台线程中生成函数文档，返回 (文档文本, API 响应)；命中缓存或由工作进程生成时响应为 None。
+    这里不能调用 st.* 显示内容，错误以异常的形式留在 Future 中，由 wait_for_doc 显示。
+    """
+    messages_doc = doc_messages(code)
+    if queue is not None:
+        job_id = queue.submit("doc", {"messages": messages_doc})
+        while True:
+            if cancelled.is_set():
+                queue.cancel(job_id)
+                raise CancelledError()
+            job = queue.get(job_id)
+            if job is None or job.status in FINISHED_STATUSES:
+                break
+            time.sleep(JOB_POLL_INTERVAL)
+        if job is None or job.status != DONE:
+            error = "任务不存在" if job is None else (job.error or job.status).splitlines()[0]
+            raise RuntimeError(f"文档任务失败: {error}")
+        return job.result["text"], None
+
+    cached_request = CachedRequest(messages_doc, CLAUDE_MODEL, MAX_TOKENS, use_cache)
+    cached = cached_request.get()
+    if cached is not None:
+        return cached[0].text, None
+    if cancelled.is_set():
+        raise CancelledError()
+    # 文档请求只发送一次，写入提示缓存反而多付 25% 的输入费用
+    response = create_message(messages_doc, model=CLAUDE_MODEL, max_tokens=MAX_TOKENS, prompt_cache=False)
+    cached_request.put(response)
+    return response.content[0].text, response
+
+def start_doc_task(code):
+    """
+    在后台开始为 code 生成文档，返回 DocTask。
+    同一段代码（按 SHA-256）在一个会话中只请求一次：页面重新执行、反复点击都复用同一个任务。
+    """
+    tasks = st.session_state.setdefault("doc_tasks", {})
+    digest = code_digest(code)
+    task = tasks.get(digest)
+    if task is None:
+        cancelled = threading.Event()
+        context = contextvars.copy_context()
+        future = get_doc_executor().submit(
+            context.run, _fetch_doc, code, not st.session_state.get("bypass_cache", False),
+            get_default_queue(), cancelled
+        )
+        task = tasks[digest] = DocTask(digest, future, cancelled)
+    return task
+
+def cancel_doc_tasks():
+    """
+    取消还没有完成的文档任务（重新生成时调用）。排队中的任务不会再发出请求；
+    已经发出的请求无法中途撤回，它的结果会被丢弃。已完成的任务保留，代码相同时直接复用。
+    """
+    tasks = st.session_state.get("doc_tasks") or {}
+    for digest, task in list(tasks.items()):
+        if not task.future.done():
+            task.cancelled.set()
+            task.future.cancel()
+            del tasks[digest]
+
+def wait_for_doc(code):
+    """取得 code 的文档：后台任务还没完成时等待，失败时显示错误并返回 None"""
+    task = start_doc_task(code)
+    try:
+        with st.spinner("正在生成函数文档..."):
+            text, response = task.future.result()
+    except (RuntimeError, CancelledError, *api_errors()) as e:
+        # 失败的任务不保留，下次执行脚本时可以重新请求
+        st.session_state.doc_tasks.pop(task.digest, None)
+        st.error(f"文档生成失败: {e}")
+        return None
+    if response is not None:
+        count_tokens_and_estimate_cost(response)
+    return text
 
 def handle_regeneration():
     """处理重新生成的回调函数"""
     new_prompt = st.session_state.new_prompt
     if new_prompt:
-        st.session_state.conversation_history.append({
+        cancel_doc_tasks()
+        # 数据规格模式下模型上一轮回复的是规格 JSON，接着修改规格而不是由它生成的代码
+        reply = st.session_state.get("current_reply") or st.session_state.current_code
+        try:
+            conversation_history = get_conversation()
+        except SessionEvicted:
+            # 会话已被释放，main() 中会提示用户重新开始
+            return
+        conversation_history.append({
             "role": "assistant",
-            "content": [{"type": "text", "text": st.session_state.current_code}]
+            "content": [{"type": "text", "text": reply}]
         })
-        st.session_state.conversation_history.append({
+        conversation_history.append({
             "role": "user",
             "content": [{"type": "text", "text": new_prompt}]
         })
+        set_conversation(conversation_history)
         st.session_state.generation_count += 1
         st.session_state.is_generated = False
     else:
@@ -161,35 +766,221 @@ def handle_regeneration():
 def handle_satisfaction():
     """处理用户满意的回调函数"""
     st.session_state.is_satisfied = True
+    # 只导出和保存确认采用的图像；页面上显示的是低分辨率预览时，在后台按导出设置重新渲染
+    if get_default_queue() is None and st.session_state.render_preview:
+        spec_reply = st.session_state.get("current_reply") if output_format() == "spec" else None
+        st.session_state.final_export = start_final_export(st.session_state.current_code, spec_reply)
 
 def main():
     st.title("图像到代码工具")
     st.write("上传图像，调用 Claude API 将其转换为 Python 代码。")
     
     initialize_session_state()
+    metrics.serve_from_env()
+    # 空闲太久的会话占用的图片已被释放，对话无法继续，需要重新开始
+    if not get_default_registry().touch(session_id()):
+        reset_session()
+    if st.session_state.get("session_expired"):
+        st.info("会话空闲时间过长，占用的资源已释放，请重新上传图片")
+        st.button("重新开始", on_click=handle_restart)
+        return
+    maybe_collect_garbage()
+    show_resource_usage()
+    queue = get_default_queue()
+    if queue is not None:
+        st.sidebar.info("任务队列模式：生成任务由后台工作进程处理（python worker.py）")
+        if st.session_state.conversation_turns is None and "job" in st.query_params:
+            restore_job(queue, st.query_params["job"])
+    # 任务队列模式下代码由工作进程执行，界面进程不需要沙箱进程池
+    warm_up(start_pool=queue is None)
+
+    st.sidebar.radio(
+        "生成方式",
+        options=["code", "spec"],
+        format_func={"code": "绘图代码", "spec": "数据规格（JSON）"}.get,
+        key="output_format",
+        disabled=st.session_state.generation_count > 0,
+        help="数据规格：模型只返回图中的数据和样式（JSON），由本地渲染器确定性地画图，回复更短、结果可复现"
+    )
+    st.sidebar.checkbox(
+        "拆分多子图",
+        key="split_panels",
+        disabled=output_format() == "spec",
+        help="原图是由多个子图组成的组合图时，按空白间隔拆分，各子图并发复现后再拼回原来的布局（只用于绘图代码方式）"
+    )
+    st.sidebar.checkbox(
+        "提前生成文档",
+        value=True,
+        key="speculative_doc",
+        help="代码执行成功后立即在后台生成函数文档，确认满意时不用再等；重新生成时取消还没完成的文档请求"
+    )
+    st.sidebar.checkbox(
+        "跳过响应缓存",
+        key="bypass_cache",
+        help="勾选后总是重新调用 Claude API，不读取也不写入本地缓存"
+    )
+    st.sidebar.checkbox(
+        "直接复用图库中的相似图",
+        value=True,
+        key="reuse_library",
+        help="上传的图片与图库中已有的图足够接近时，直接执行保存的代码，不调用 API"
+    )
+    st.sidebar.checkbox(
+        "流式显示生成过程",
+        value=True,
+        key="stream_output",
+        help="边生成边显示代码，发现语法错误时提前中止并重新生成"
+    )
+    st.sidebar.number_input(
+        "最大自动修复次数",
+        min_value=0,
+        max_value=10,
+        value=MAX_REPAIR_RETRIES,
+        key="max_repair_retries",
+        help="代码执行失败时，自动把错误信息发回给模型修复的最大次数"
+    )
+    st.sidebar.number_input(
+        "并发候选数",
+        min_value=1,
+        max_value=8,
+        value=1,
+        key="n_candidates",
+        help="大于 1 时同时请求多个候选代码，采用第一个执行成功的（不使用流式显示和响应缓存）"
+    )
+    models = route_models()
+    st.sidebar.checkbox(
+        "按成本逐级升级模型",
+        value=False,
+        key="route_escalate",
+        help=f"先用 {models[0]}，代码执行失败或相似度未达标时下一轮换用更强的模型（{' → '.join(models)}）；"
+             "便宜模型的实测成功率太低、先试它反而更贵时自动跳过"
+    )
+    st.sidebar.checkbox(
+        "候选分配到不同模型和提示词",
+        key="route_fan_out",
+        help="并发候选数大于 1 时，同一轮的候选分别使用不同的模型和提示词变体，按实测成功率排序"
+    )
+    st.sidebar.multiselect(
+        "提示词变体",
+        options=list(PROMPT_VARIANTS),
+        default=[DEFAULT_VARIANT],
+        key="prompt_variants",
+        disabled=not st.session_state.get("route_fan_out", False),
+        help="分配候选时参与的提示词写法（见 prompts.py）"
+    )
+    show_route_stats()
+    st.sidebar.number_input(
+        "相似度目标",
+        min_value=0.0,
+        max_value=1.0,
+        value=0.0,
+        step=0.05,
+        key="similarity_threshold",
+        help="大于 0 时自动比较生成图像与原图：达到目标即停止，否则把得分发回模型继续改进（占用自动修复次数），"
+             "多个候选时取得分最高的；为 0 时只显示得分"
+    )
+    st.sidebar.number_input(
+        "对话 token 预算",
+        min_value=2000,
+        max_value=200000,
+        value=DEFAULT_TOKEN_BUDGET,
+        step=1000,
+        key="token_budget",
+        help="每次调用前，对话历史超过此预算时压缩为：图片、原始提示词、最新代码和历史要求摘要"
+    )
+    st.sidebar.checkbox(
+        "使用 API 计算 token",
+        key="count_tokens_via_api",
+        help="用 token 计数接口精确计算对话长度（多一次请求），否则在本地估算"
+    )
+    st.sidebar.number_input(
+        "图片最长边上限（像素）",
+        min_value=256,
+        max_value=4096,
+        value=DEFAULT_MAX_LONG_EDGE,
+        step=64,
+        key="max_long_edge",
+        help="上传前把图片缩小到此尺寸以内，减少上传体积和图片 token"
+    )
+    st.sidebar.checkbox(
+        "裁掉纯色边框",
+        key="crop_borders",
+        help="去掉扫描件或截图四周的空白边"
+    )
+    st.sidebar.checkbox(
+        "渲染优化",
+        value=True,
+        key="render_fast",
+        help="简化密集折线的路径并分块绘制，减少 savefig 的耗时"
+    )
+    st.sidebar.checkbox(
+        "快速预览",
+        value=True,
+        key="render_preview",
+        help="生成和修复过程中以低分辨率渲染，并把密集的散点和网格抽稀到显示分辨率；确认采用后再按导出设置渲染高清图像"
+    )
+    st.sidebar.number_input(
+        "导出 DPI",
+        min_value=50,
+        max_value=600,
+        value=DEFAULT_EXPORT_DPI,
+        step=50,
+        key="export_dpi"
+    )
+    st.sidebar.number_input(
+        "导出宽度（英寸）",
+        min_value=0.0,
+        max_value=40.0,
+        value=0.0,
+        step=0.5,
+        key="export_width",
+        help="宽度和高度都大于 0 时按此尺寸导出，否则保持代码中设置的尺寸"
+    )
+    st.sidebar.number_input(
+        "导出高度（英寸）",
+        min_value=0.0,
+        max_value=40.0,
+        value=0.0,
+        step=0.5,
+        key="export_height",
+        help="宽度和高度都大于 0 时按此尺寸导出，否则保持代码中设置的尺寸"
+    )
     
     uploaded_file = st.file_uploader("上传图片", type=["png", "jpg", "jpeg", "gif", "webp"])
 
+    image_bytes = None
     if uploaded_file:
         image_name = uploaded_file.name
+        # 直接使用上传文件的字节，不经过临时文件，多个用户上传同名文件也不会互相覆盖
+        with metrics.timed("upload_read"):
+            image_bytes = uploaded_file.getvalue()
+        st.session_state.image_name = image_name
+    elif queue is not None and st.session_state.conversation_turns and (
+            st.session_state.get("pending_job") or st.session_state.is_generated):
+        # 刷新页面后从任务队列恢复的会话没有上传文件，预览使用对话中的原图
+        image_name = st.session_state.get("image_name") or "image.png"
+        image_bytes = first_image_bytes(get_conversation())
+
+    if image_bytes is not None:
         image_name_to_save = os.path.splitext(os.path.basename(image_name))[0]
         date_str = datetime.now().strftime("%Y%m%d_%H%M")
-        output_path = f"{date_str}_{os.path.splitext(image_name)[0]}.png"
+        output_name = f"{date_str}_{image_name_to_save}.png"
 
-        # 保存上传文件到临时目录
-        temp_dir = tempfile.gettempdir()
-        image_path = os.path.join(temp_dir, image_name)
-        with open(image_path, "wb") as f:
-            f.write(uploaded_file.read())
-        
-        st.image(image_path, caption="上传的图片预览", use_container_width=True)
+        st.image(image_bytes, caption="上传的图片预览", use_container_width=True)
 
         # 如果是首次生成或需要重新生成
         if not st.session_state.is_generated:
-            if st.session_state.generation_count == 0:
+            reused = None
+            if st.session_state.generation_count == 0 and not st.session_state.get("pending_job"):
                 # 首次生成
-                image_data, media_type = encode_image_to_base64(image_path)
-                st.session_state.conversation_history = [
+                with metrics.timed("encode"):
+                    image_data, media_type, report = preprocess_and_encode(
+                        image_bytes,
+                        max_long_edge=st.session_state.max_long_edge,
+                        crop_borders=st.session_state.crop_borders
+                    )
+                show_preprocess_report(report)
+                conversation_history = [
                     {
                         "role": "user",
                         "content": [
@@ -203,20 +994,40 @@ def main():
                             },
                             {
                                 "type": "text",
-                                "text": prompt_example_img,
+                                "text": prompt_spec if output_format() == "spec" else prompt_example_img,
                             },
                         ],
                     }
                 ]
+                set_conversation(conversation_history)
+                reused = reuse_from_library(conversation_history)
+            else:
+                conversation_history = get_conversation()
             
-            success, code = generate_new_image(
-                st.session_state.conversation_history,
-                output_path
-            )
+            if reused is not None:
+                success, code, conversation_history, png = reused
+            elif queue is not None:
+                success, code, conversation_history, png = generate_via_queue(queue, conversation_history)
+            else:
+                panels = None
+                # 只有第一次生成时拆分子图，之后的修改按整张图进行，对话中接着的是拼合后的代码
+                if split_panels_enabled():
+                    panels = generate_panels(image_bytes, conversation_history)
+                if panels is not None:
+                    success, code, conversation_history, png = panels
+                else:
+                    success, code, conversation_history, png = generate_new_image(conversation_history)
             
             if success:
                 st.session_state.current_code = code
+                set_current_png(png)
+                set_conversation(conversation_history)
                 st.session_state.is_generated = True
+                st.session_state.final_export = None
+                library_doc = st.session_state.get("library_doc")
+                if st.session_state.get("speculative_doc", True) and not (library_doc and library_doc[0] == code):
+                    # 用户查看图像时文档已经在后台生成，确认满意后通常不用再等
+                    start_doc_task(code)
 
         # 只有在成功生成图像后才显示反馈界面
         if st.session_state.is_generated and not st.session_state.is_satisfied:
@@ -245,30 +1056,58 @@ def main():
         if st.session_state.is_satisfied:
             st.success("已确认图像生成结果，正在生成函数文档...")
             
-            messages_doc = [
-                {
-                    "role": "user",
-                    "content": [{"type": "text", "text": prompt_doc + st.session_state.current_code}],
-                },
-            ]
-            response = call_claude_api(messages_doc)
-            doc = response[0].text
+            library_doc = st.session_state.get("library_doc")
+            if library_doc and library_doc[0] == st.session_state.current_code and library_doc[1]:
+                doc = library_doc[1]
+            else:
+                # 每次交互都会重新执行到这里，文档按代码的哈希只请求一次
+                doc = wait_for_doc(st.session_state.current_code)
+            if doc is None:
+                return
 
             st.write("生成的文档:")
             st.write(doc)
 
-            # 构造文件名
-            json_filename = f"{date_str}_{image_name_to_save}.json"
+            png = final_png()
+            if png is not None:
+                st.download_button("下载图像", data=png, file_name=output_name, mime="image/png")
 
-            # 将 code 和 doc 保存到 JSON 文件
-            with open(json_filename, 'w', encoding='utf-8') as json_file:
-                json.dump({
-                    "code": st.session_state.current_code, 
-                    "doc": doc,
-                    "conversation_history": st.session_state.conversation_history
-                }, json_file, ensure_ascii=False, indent=4)
+            # 在后台按紧凑格式保存代码、文档和对话历史（原图和图像按内容去重，见 artifacts.py）
+            # 同一段代码只保存一次并加入图库一次，之后页面重新执行时只显示保存位置
+            digest = code_digest(st.session_state.current_code)
+            saved = st.session_state.get("saved_run")
+            persister = get_default_persister()
+            if saved is not None and saved[0] == digest:
+                if persister is not None:
+                    st.success(f"代码、文档、对话历史和图像已保存为 {persister.location(saved[1])}")
+                return
+
+            conversation_history = get_conversation()
+            run_name = unique_name(date_str, image_name_to_save)
+            manifest_name = f"{RUNS_PREFIX}/{run_name}{MANIFEST_SUFFIX}"
+            if persister is not None:
+                # 采用的图像作为 blob 与代码一起保存，在后台线程中写入，不阻塞页面
+                persister.save_run(
+                    run_name,
+                    st.session_state.current_code,
+                    doc,
+                    conversation_history,
+                    figure=png,
+                    image_name=st.session_state.get("image_name"),
+                )
+                st.success(f"代码、文档、对话历史和图像正在保存为 {persister.location(manifest_name)}")
+            else:
+                st.info("FIGURE_STORAGE=none，结果没有保存")
 
-            st.success(f"代码、文档和对话历史已成功保存为 {json_filename}")
+            # 加入图库，之后上传相似的图可以直接复用（同一张原图只加入一次）
+            library = get_default_library()
+            original = first_image_bytes(conversation_history)
+            if library is not None and original is not None:
+                source = persister.location(manifest_name) if persister is not None else None
+                library.add(original, st.session_state.current_code, doc, source=source)
+            st.session_state.saved_run = (digest, manifest_name)
 
 if __name__ == "__main__":
-    main()
+    # 每次脚本运行（上传、重新生成、确认满意）的统计事件共用一个 request_id
+    with metrics.request_scope():
+        main()
@@ -1,8 +1,10 @@
 import base64
-import anthropic
-import matplotlib.pyplot as plt
 import tempfile
 import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from claude_client import create_message
 
 # 模拟调用 Claude 的函数
 def send_to_claude(image_path, prompt, conversation_history=[]):
@@ -24,8 +26,7 @@ def send_to_claude(image_path, prompt, conversation_history=[]):
         raise ValueError("Unsupported image type. Supported types are: JPEG, PNG, GIF, and WEBP.")
     
     # 构造 API 请求数据
-    client = anthropic.Anthropic()
-    response = client.messages.create(
+    response = create_message(
         model="claude-3-5-sonnet-20241022",
         max_tokens=1024,
         messages=conversation_history + [
@@ -57,6 +58,9 @@ def send_to_claude(image_path, prompt, conversation_history=[]):
         return None
 
 def execute_and_save_code(code, output_path):
+    # matplotlib 在第一次执行代码时才导入，只调用 API 的流程不必为它等待
+    import matplotlib.pyplot as plt
+
     try:
         # 确保 code 是字符串
         if isinstance(code, list) and len(code) > 0 and hasattr(code[0], 'text'):
@@ -1,11 +1,13 @@
 import base64
-import anthropic
-import matplotlib.pyplot as plt
 import tempfile
 import os
+import sys
 from datetime import datetime
 import json
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from claude_client import create_message
+
 def encode_image_to_base64(image_path):
     """将图片转换为 Base64 格式，并返回图片的媒体类型"""
     with open(image_path, "rb") as f:
@@ -27,13 +29,8 @@ def encode_image_to_base64(image_path):
 
 def call_claude_api(messages):
     """调用 Claude API 获取代码回复"""
-    client = anthropic.Anthropic()
-    response = client.messages.create(
-        model="claude-3-5-sonnet-20241022",
-        max_tokens=2048,
-        messages=messages
-    )   
-    """调用 Claude API 获取代码回复"""
+    # 使用共享的连接池客户端，自带超时与退避重试
+    response = create_message(messages, model="claude-3-5-sonnet-20241022", max_tokens=2048)
     
     if response:
         return response.content  
@@ -42,6 +39,9 @@ def call_claude_api(messages):
         return None
     
 def execute_code(code, output_path):
+    # matplotlib 在第一次执行代码时才导入，只调用 API 的流程不必为它等待
+    import matplotlib.pyplot as plt
+
     try:
         # 确保 code 是字符串
         if isinstance(code, list) and len(code) > 0 and hasattr(code[0], 'text'):
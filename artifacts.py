@@ -0,0 +1,314 @@
+"""
+生成结果的紧凑存储格式。
+
+以前每次生成的结果保存为一个缩进排版的 JSON，对话历史中带着完整的 base64 原图，每个文件好几 MB，
+同一张原图在多次生成中反复保存。现在拆成三部分（路径相对于存储根目录）:
+    blobs/ab/<sha256>.png        原图和生成的图像，按内容的 SHA-256 命名，相同内容只保存一份
+    runs/<name>.json.gz          代码、文档和对话轮次（图片替换为 blob 引用），gzip 压缩
+    runs/<name>.manifest.json    几百字节的清单：时间、原图、代码哈希、文档标题、相似度、各部分大小
+
+列出和搜索历史结果只读取清单，代码、文档和图片在第一次访问时才读取和解压。
+
+    store = ArtifactStore(LocalStorage("."))
+    store.save("20241222_1812_image", code, doc, conversation_history, figure=png_bytes)
+    for run in store.search("散点图"):
+        run.name, run.manifest["created"], run.code
+
+命令行:
+    python artifacts.py list [-q 关键词]
+    python artifacts.py show 20241222_1812_image
+    python artifacts.py convert *.json          把旧格式的 JSON 转换为紧凑格式
+"""
+import argparse
+import base64
+import copy
+import gzip
+import hashlib
+import json
+import os
+import time
+
+RUNS_PREFIX = "runs"
+BLOBS_PREFIX = "blobs"
+MANIFEST_SUFFIX = ".manifest.json"
+PAYLOAD_SUFFIX = ".json.gz"
+FORMAT_VERSION = 1
+DOC_TITLE_CHARS = 80
+
+_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/gif": "gif", "image/webp": "webp"}
+
+
+def blob_name(digest, media_type):
+    return f"{BLOBS_PREFIX}/{digest[:2]}/{digest}.{_EXTENSIONS.get(media_type, 'bin')}"
+
+
+def _compact_json(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dehydrate(messages):
+    """
+    把对话中的 base64 图片替换为 blob 引用。
+
+    返回 (turns, blobs)：turns 为替换后的对话，blobs 为 {sha256: (图片字节, media_type)}
+    """
+    turns = copy.deepcopy(messages)
+    blobs = {}
+    for message in turns:
+        content = message["content"]
+        if isinstance(content, str):
+            continue
+        for block in content:
+            source = block.get("source", {}) if block.get("type") == "image" else {}
+            if source.get("type") != "base64":
+                continue
+            data = base64.standard_b64decode(source["data"])
+            digest = hashlib.sha256(data).hexdigest()
+            blobs[digest] = (data, source["media_type"])
+            block["source"] = {"type": "blob", "media_type": source["media_type"], "sha256": digest}
+    return turns, blobs
+
+
+def rehydrate(turns, read_blob):
+    """dehydrate 的逆操作，read_blob(sha256, media_type) 返回图片字节"""
+    messages = copy.deepcopy(turns)
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            continue
+        for block in content:
+            source = block.get("source", {}) if block.get("type") == "image" else {}
+            if source.get("type") != "blob":
+                continue
+            data = read_blob(source["sha256"], source["media_type"])
+            block["source"] = {
+                "type": "base64",
+                "media_type": source["media_type"],
+                "data": base64.standard_b64encode(data).decode("utf-8"),
+            }
+    return messages
+
+
+def doc_title(doc):
+    """文档的第一行非空文字（跳过代码块标记，去掉 Markdown 标记），用于列表和搜索"""
+    for line in (doc or "").splitlines():
+        if line.strip().startswith("```"):
+            continue
+        line = line.strip().lstrip("#").strip().strip("`*").strip()
+        if line:
+            return line[:DOC_TITLE_CHARS]
+    return ""
+
+
+def _put_blob(backend, data, media_type):
+    """保存一个 blob，内容已存在时跳过，返回 (sha256, 是否新写入)"""
+    digest = hashlib.sha256(data).hexdigest()
+    name = blob_name(digest, media_type)
+    # 已有的 blob 可能还没有被任何清单引用（例如之前的保存中断了）：刷新修改时间，
+    # 在引用它的清单写入之前，resources.collect_garbage 不会把它当作过期的 blob 删掉
+    if backend.touch(name):
+        return digest, False
+    backend.write(name, data)
+    return digest, True
+
+
+def write_run(backend, name, code, doc, messages, figure=None, **meta):
+    """保存一次生成的结果，返回清单的位置；meta 中的字段（如 image_name、similarity）原样写入清单"""
+    turns, blobs = dehydrate(messages)
+    blob_bytes = 0
+    images = []
+    for digest, (data, media_type) in blobs.items():
+        _, written = _put_blob(backend, data, media_type)
+        blob_bytes += len(data) if written else 0
+        images.append({"sha256": digest, "media_type": media_type, "bytes": len(data)})
+    figure_ref = None
+    if figure is not None:
+        digest, written = _put_blob(backend, figure, "image/png")
+        blob_bytes += len(figure) if written else 0
+        figure_ref = {"sha256": digest, "media_type": "image/png", "bytes": len(figure)}
+
+    payload = gzip.compress(_compact_json({"code": code, "doc": doc, "turns": turns}), mtime=0)
+    backend.write(f"{RUNS_PREFIX}/{name}{PAYLOAD_SUFFIX}", payload)
+
+    manifest = dict(
+        meta,
+        version=FORMAT_VERSION,
+        name=name,
+        created=meta.get("created") or round(time.time(), 3),
+        images=images,
+        figure=figure_ref,
+        code_sha256=hashlib.sha256((code or "").encode("utf-8")).hexdigest(),
+        code_lines=len((code or "").splitlines()),
+        doc_title=doc_title(doc),
+        turns=len(messages),
+        payload_bytes=len(payload),
+        new_blob_bytes=blob_bytes,
+    )
+    # 清单最后写入，读取方看到清单时其余部分一定已经存在
+    manifest_name = f"{RUNS_PREFIX}/{name}{MANIFEST_SUFFIX}"
+    backend.write(manifest_name, _compact_json(manifest))
+    return backend.location(manifest_name)
+
+
+class Run:
+    """一次保存的结果：manifest 立即可用，代码、文档、对话和图片在第一次访问时才读取"""
+
+    def __init__(self, store, manifest):
+        self.store = store
+        self.manifest = manifest
+        self._payload = None
+
+    def __repr__(self):
+        return f"Run({self.name!r})"
+
+    @property
+    def name(self):
+        return self.manifest["name"]
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            data = self.store.backend.read(f"{RUNS_PREFIX}/{self.name}{PAYLOAD_SUFFIX}")
+            self._payload = json.loads(gzip.decompress(data))
+        return self._payload
+
+    @property
+    def code(self):
+        return self.payload["code"]
+
+    @property
+    def doc(self):
+        return self.payload["doc"]
+
+    @property
+    def turns(self):
+        """对话轮次，图片仍是 blob 引用"""
+        return self.payload["turns"]
+
+    def image_bytes(self):
+        """上传的原图，没有时返回 None"""
+        images = self.manifest.get("images") or []
+        return self.store.read_blob(images[0]["sha256"], images[0]["media_type"]) if images else None
+
+    def figure_bytes(self):
+        """采用的生成图像，没有时返回 None"""
+        figure = self.manifest.get("figure")
+        return self.store.read_blob(figure["sha256"], figure["media_type"]) if figure else None
+
+    def conversation_history(self):
+        """还原为带 base64 图片的完整对话，可以直接发给 API"""
+        return rehydrate(self.turns, self.store.read_blob)
+
+
+class ArtifactStore:
+    """在 storage.py 的存储后端（LocalStorage / S3Storage）上读写紧凑格式的结果"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def save(self, name, code, doc, messages, figure=None, **meta):
+        return write_run(self.backend, name, code, doc, messages, figure=figure, **meta)
+
+    def read_blob(self, digest, media_type):
+        return self.backend.read(blob_name(digest, media_type))
+
+    def _load(self, manifest_name):
+        return Run(self, json.loads(self.backend.read(manifest_name)))
+
+    def get(self, name):
+        return self._load(f"{RUNS_PREFIX}/{name}{MANIFEST_SUFFIX}")
+
+    def runs(self):
+        """所有结果，按时间从新到旧排列（只读取清单）"""
+        runs = [self._load(name) for name in self.backend.list(RUNS_PREFIX) if name.endswith(MANIFEST_SUFFIX)]
+        runs.sort(key=lambda run: run.manifest.get("created", 0), reverse=True)
+        return runs
+
+    def search(self, query=None, since=None):
+        """按名称、原图文件名和文档标题中的关键词（不区分大小写）及时间筛选"""
+        query = (query or "").lower()
+        results = []
+        for run in self.runs():
+            manifest = run.manifest
+            if since is not None and manifest.get("created", 0) < since:
+                continue
+            text = " ".join(str(manifest.get(key) or "") for key in ("name", "image_name", "doc_title"))
+            if query in text.lower():
+                results.append(run)
+        return results
+
+
+def is_store(path):
+    """目录中是否有紧凑格式的结果"""
+    return os.path.isdir(os.path.join(path, RUNS_PREFIX))
+
+
+def convert_legacy(store, path):
+    """把旧格式的结果 JSON 转换为紧凑格式，返回 (原大小, 新写入的字节数)"""
+    with open(path, "r", encoding="utf-8") as f:
+        result = json.load(f)
+    name = os.path.splitext(os.path.basename(path))[0]
+    meta = {key: result[key] for key in ("image_path", "similarity") if result.get(key) is not None}
+    figure = None
+    figure_path = os.path.splitext(path)[0] + ".png"
+    if os.path.exists(figure_path):
+        with open(figure_path, "rb") as f:
+            figure = f.read()
+    store.save(name, result.get("code"), result.get("doc"), result.get("conversation_history") or [],
+               figure=figure, created=round(os.path.getmtime(path), 3), **meta)
+    manifest = store.get(name).manifest
+    written = manifest["payload_bytes"] + manifest["new_blob_bytes"]
+    return os.path.getsize(path), written
+
+
+def main():
+    from storage import make_backend
+
+    parser = argparse.ArgumentParser(description="查看和转换紧凑格式保存的结果")
+    parser.add_argument("--root", default=os.environ.get("FIGURE_STORAGE") or ".",
+                        help="存储位置（目录或 s3://桶/前缀），默认与 FIGURE_STORAGE 相同")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    list_parser = subparsers.add_parser("list", help="列出保存的结果")
+    list_parser.add_argument("-q", "--query", help="按名称、原图文件名或文档标题筛选")
+    show_parser = subparsers.add_parser("show", help="显示一个结果的代码和文档")
+    show_parser.add_argument("name")
+    show_parser.add_argument("--figure", metavar="PATH", help="把保存的图像写入此文件")
+    convert_parser = subparsers.add_parser("convert", help="把旧格式的 JSON 转换为紧凑格式")
+    convert_parser.add_argument("paths", nargs="+")
+    args = parser.parse_args()
+
+    backend = make_backend(args.root)
+    if backend is None:
+        parser.error("FIGURE_STORAGE=none 时没有保存的结果，请用 --root 指定位置")
+    store = ArtifactStore(backend)
+
+    if args.command == "list":
+        for run in store.search(args.query):
+            manifest = run.manifest
+            created = time.strftime("%Y-%m-%d %H:%M", time.localtime(manifest.get("created", 0)))
+            similarity = manifest.get("similarity")
+            score = f"  相似度 {similarity['score']:.2f}" if isinstance(similarity, dict) else ""
+            print(f"{created}  {run.name}{score}  {manifest.get('doc_title', '')}")
+    elif args.command == "show":
+        run = store.get(args.name)
+        print(json.dumps(run.manifest, ensure_ascii=False, indent=2))
+        print(run.code)
+        print(run.doc or "")
+        if args.figure:
+            figure = run.figure_bytes()
+            if figure is None:
+                parser.error(f"{args.name} 没有保存图像")
+            with open(args.figure, "wb") as f:
+                f.write(figure)
+    else:
+        before = after = 0
+        for path in args.paths:
+            size, written = convert_legacy(store, path)
+            before += size
+            after += written
+            print(f"{path}: {size} → {written} 字节")
+        print(f"共 {len(args.paths)} 个文件，{before} → {after} 字节")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+批量复现工具：无界面地把一个目录（或清单文件）中的所有图片复现为绘图代码。
+
+用法:
+    python batch.py 图片目录 -o batch_output
+    python batch.py manifest.txt -o batch_output --concurrency 8 --exec-workers 4
+    python batch.py 图片目录 -o batch_output --spec      模型只返回数据规格，由 spec_render.py 画图
+    python batch.py 图片目录 -o batch_output --panels    组合图拆分子图并发复现（见 panels.py）
+
+清单文件每行一个图片路径（相对路径以清单所在目录为基准），空行和 # 开头的行会被忽略。
+每张图片生成的图像写入输出目录，代码、文档和对话按 artifacts.py 的紧凑格式保存在同一目录，
+进度记录在 batch_state.jsonl 中，中途崩溃后重新运行同一命令即可跳过已完成的图片。
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import claude_client
+import metrics
+from artifacts import write_run
+from history import DEFAULT_TOKEN_BUDGET
+from panels import detect_panels, reconstruct_panels
+from preprocess import DEFAULT_MAX_LONG_EDGE, preprocess_image
+from prompts import PROMPT_VARIANTS, prompt_doc, prompt_example_img, prompt_spec
+from repair import generate_with_repair
+from routing import DEFAULT_VARIANT, Router, format_summary, route_models, unknown_variants
+from sandbox import SandboxPool
+from similarity import format_score
+from storage import LocalStorage
+
+SUPPORTED_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+STATE_FILENAME = "batch_state.jsonl"
+
+
+def collect_images(source):
+    """从目录或清单文件中收集待处理的图片路径"""
+    if os.path.isdir(source):
+        paths = []
+        for root, _, files in os.walk(source):
+            for name in files:
+                if os.path.splitext(name)[-1].lower() in SUPPORTED_EXTENSIONS:
+                    paths.append(os.path.join(root, name))
+        return sorted(paths)
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if not os.path.isabs(line):
+                line = os.path.join(base_dir, line)
+            paths.append(line)
+    return paths
+
+
+def image_key(image_path):
+    """为图片生成稳定的输出文件名前缀，避免不同目录下同名图片互相覆盖"""
+    abs_path = os.path.abspath(image_path)
+    digest = hashlib.sha1(abs_path.encode("utf-8")).hexdigest()[:8]
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    return f"{name}_{digest}"
+
+
+def load_finished(output_dir):
+    """读取进度文件，返回已经成功完成的图片 key 集合"""
+    state_path = os.path.join(output_dir, STATE_FILENAME)
+    finished = set()
+    if not os.path.exists(state_path):
+        return finished
+    with open(state_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 崩溃时可能留下半行记录，直接忽略
+                continue
+            if record.get("status") == "done":
+                finished.add(record["key"])
+    return finished
+
+
+def append_state(output_dir, record):
+    """向进度文件追加一条记录"""
+    state_path = os.path.join(output_dir, STATE_FILENAME)
+    with open(state_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+async def call_claude_api(messages, prompt_cache=None):
+    """通过共享客户端调用 Claude API（并发上限由 claude_client 控制），返回回复文本"""
+    response = await claude_client.acreate_message(messages, prompt_cache=prompt_cache)
+    if not response or not response.content:
+        raise RuntimeError("API 调用失败")
+    return response.content[0].text
+
+
+async def process_image(image_path, output_dir, sandbox, max_retries, n_candidates=1,
+                        max_long_edge=DEFAULT_MAX_LONG_EDGE, crop_borders=False,
+                        token_budget=DEFAULT_TOKEN_BUDGET, similarity_threshold=None, dpi=None, router=None,
+                        output_format="code", split_panels=False):
+    """对单张图片执行 编码 → 调用 API → 执行代码 → 生成文档 的完整流程"""
+    key = image_key(image_path)
+    output_path = os.path.join(output_dir, f"{key}.png")
+
+    with metrics.timed("encode"):
+        with open(image_path, "rb") as f:
+            original = f.read()
+        prepared = preprocess_image(original, max_long_edge=max_long_edge, crop_borders=crop_borders)
+        image_data = base64.standard_b64encode(prepared.data).decode("utf-8")
+    media_type = prepared.media_type
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": media_type,
+                        "data": image_data,
+                    },
+                },
+                {
+                    "type": "text",
+                    "text": prompt_spec if output_format == "spec" else prompt_example_img,
+                },
+            ],
+        }
+    ]
+
+    # 批量模式没有预览，直接按导出 DPI 渲染，并启用渲染优化的 rcParams
+    exec_options = {"fast": True, "dpi": dpi} if dpi else {"fast": True}
+    layout = detect_panels(original) if split_panels else None
+    if layout is not None and len(layout.panels) > 1:
+        outcome = await reconstruct_panels(
+            original, sandbox, layout, max_retries=max_retries, max_long_edge=max_long_edge,
+            exec_options=exec_options, router=router,
+        )
+        if not outcome.result.ok:
+            raise RuntimeError(f"拼合子图的代码执行失败: {outcome.result.error}")
+        score = None
+    else:
+        outcome = await generate_with_repair(
+            messages, sandbox, max_retries=max_retries, n_candidates=n_candidates, token_budget=token_budget,
+            similarity_threshold=similarity_threshold, exec_options=exec_options, router=router,
+            output_format=output_format,
+        )
+        if not outcome.ok:
+            raise RuntimeError(f"已达到最大重试次数，无法成功生成图表: {outcome.error}")
+        messages = outcome.messages
+        score = outcome.score
+    code = outcome.code
+    with open(output_path, "wb") as f:
+        f.write(outcome.result.png)
+
+    messages_doc = [
+        {
+            "role": "user",
+            "content": [{"type": "text", "text": prompt_doc + code}],
+        },
+    ]
+    doc = await call_claude_api(messages_doc, prompt_cache=False)
+
+    # 紧凑格式：原图按内容去重保存，代码、文档和对话压缩保存，清单最后写入
+    manifest_path = write_run(
+        LocalStorage(output_dir), key, code, doc, messages, figure=outcome.result.png,
+        image_name=os.path.basename(image_path),
+        image_path=os.path.abspath(image_path),
+        similarity=score._asdict() if score else None,
+    )
+    return key, output_path, manifest_path, score
+
+
+async def run_batch_async(source, output_dir, concurrency=4, exec_workers=2, max_retries=3, n_candidates=1,
+                          max_long_edge=DEFAULT_MAX_LONG_EDGE, crop_borders=False,
+                          token_budget=DEFAULT_TOKEN_BUDGET, similarity_threshold=None, dpi=None, router=None,
+                          output_format="code", split_panels=False):
+    """
+    批量处理所有图片，返回 (成功数, 失败数, 跳过数)；router 为 routing.Router，None 时使用默认模型；
+    output_format 为 "spec" 时模型返回数据规格（见 spec_render.py）；
+    split_panels 为 True 时组合图拆分子图并发复现（见 panels.py），不能与 output_format="spec" 同时使用
+    """
+    if split_panels and output_format == "spec":
+        raise ValueError("拆分子图只用于绘图代码方式，不能与数据规格模式同时使用")
+    os.makedirs(output_dir, exist_ok=True)
+    images = collect_images(source)
+    finished = load_finished(output_dir)
+    pending = [path for path in images if image_key(path) not in finished]
+    skipped = len(images) - len(pending)
+    print(f"共 {len(images)} 张图片，已完成 {skipped} 张，本次处理 {len(pending)} 张")
+
+    claude_client.configure(max_concurrency=concurrency)
+    succeeded = failed = 0
+
+    # 限制同时在处理中的图片数，避免成千上万张图片同时编码、占满内存
+    inflight = asyncio.Semaphore(concurrency * 2 + exec_workers)
+
+    async def run_one(path):
+        # 每张图片的统计事件以图片的 key 作为 request_id
+        async with inflight:
+            try:
+                with metrics.request_scope(image_key(path)):
+                    result = await process_image(
+                        path, output_dir, sandbox, max_retries, n_candidates, max_long_edge, crop_borders,
+                        token_budget, similarity_threshold, dpi, router, output_format, split_panels
+                    )
+                return path, result, None
+            except Exception as e:
+                return path, None, e
+
+    # API 请求数由共享客户端的信号量限制，绘图代码在沙箱进程池中执行
+    sandbox = SandboxPool(workers=exec_workers)
+    try:
+        tasks = [asyncio.ensure_future(run_one(path)) for path in pending]
+        for next_done in asyncio.as_completed(tasks):
+            path, result, error = await next_done
+            record = {
+                "key": image_key(path),
+                "image": os.path.abspath(path),
+                "time": datetime.now().isoformat(timespec="seconds"),
+            }
+            if error is None:
+                _, output_path, manifest_path, score = result
+                record.update(status="done", output=output_path, manifest=manifest_path)
+                succeeded += 1
+                if score is not None:
+                    record["similarity"] = round(score.score, 4)
+                    print(f"[完成] {path}（相似度 {format_score(score)}）")
+                else:
+                    print(f"[完成] {path}")
+            else:
+                record.update(status="failed", error=str(error))
+                failed += 1
+                print(f"[失败] {path}: {error}")
+            append_state(output_dir, record)
+    finally:
+        sandbox.close()
+
+    print(f"批量处理结束：成功 {succeeded}，失败 {failed}，跳过 {skipped}")
+    if router is not None:
+        for summary in router.stats.summaries(by_variant=router.fan_out):
+            name = f"{summary.model} / {summary.variant}" if router.fan_out else summary.model
+            print(f"  {name}: {format_summary(summary)}")
+    return succeeded, failed, skipped
+
+
+def run_batch(source, output_dir, **options):
+    """run_batch_async 的同步入口，options 与 run_batch_async 的关键字参数相同"""
+    return asyncio.run(run_batch_async(source, output_dir, **options))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量将图片复现为 Python 绘图代码")
+    parser.add_argument("source", help="图片目录或清单文件")
+    parser.add_argument("-o", "--output-dir", default="batch_output", help="输出目录")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时进行的 API 请求数上限")
+    parser.add_argument("--exec-workers", type=int, default=2, help="执行绘图代码的沙箱进程数")
+    parser.add_argument("--max-retries", type=int, default=3, help="代码执行失败后的最大自动修复次数")
+    parser.add_argument("--candidates", type=int, default=1, help="每轮同时请求的候选代码数，采用第一个执行成功的")
+    parser.add_argument("--max-edge", type=int, default=DEFAULT_MAX_LONG_EDGE, help="上传前图片最长边的上限（像素）")
+    parser.add_argument("--crop-borders", action="store_true", help="上传前裁掉图片四周的纯色边框")
+    parser.add_argument("--token-budget", type=int, default=DEFAULT_TOKEN_BUDGET,
+                        help="自动修复过程中对话历史的 token 预算，超出后压缩历史")
+    parser.add_argument("--similarity-threshold", type=float,
+                        help="与原图的相似度目标（0~1，例如 0.8）：未达到时继续改进并占用修复次数，最终采用得分最高的一次")
+    parser.add_argument("--dpi", type=int, help="生成图像的 DPI，默认使用 matplotlib 的设置")
+    parser.add_argument("--route", action="store_true",
+                        help="按成本逐级升级模型：先用便宜的模型，失败或相似度未达标时换用更强的模型")
+    parser.add_argument("--models", help="参与路由的模型，逗号分隔，从便宜到贵（默认与 CLAUDE_ROUTE_MODELS 相同）")
+    parser.add_argument("--fan-out", action="store_true",
+                        help="--candidates 大于 1 时，同一轮的候选分配到不同的模型和提示词变体上")
+    parser.add_argument("--variants", default=DEFAULT_VARIANT,
+                        help="--fan-out 时参与的提示词变体，逗号分隔（见 prompts.PROMPT_VARIANTS）")
+    # 子图按 draw_panel(ax) 函数生成，不能与数据规格模式同时使用
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--spec", action="store_true",
+                      help="模型只返回图中数据和样式的 JSON 规格，由本地渲染器确定性地画图（见 spec_render.py）")
+    mode.add_argument("--panels", action="store_true",
+                      help="原图是组合图时按空白间隔拆分子图，各子图并发复现后再拼回原来的布局")
+    args = parser.parse_args()
+    variants = [variant.strip() for variant in args.variants.split(",") if variant.strip()]
+    unknown = unknown_variants(variants)
+    if unknown:
+        parser.error(f"未知的提示词变体: {', '.join(unknown)}（可选: {', '.join(PROMPT_VARIANTS)}）")
+
+    router = None
+    if args.route or args.fan_out or args.models:
+        models = args.models.split(",") if args.models else route_models()
+        router = Router(models, variants=variants, fan_out=args.fan_out)
+
+    run_batch(
+        args.source,
+        args.output_dir,
+        concurrency=args.concurrency,
+        exec_workers=args.exec_workers,
+        max_retries=args.max_retries,
+        n_candidates=args.candidates,
+        max_long_edge=args.max_edge,
+        crop_borders=args.crop_borders,
+        token_budget=args.token_budget,
+        similarity_threshold=args.similarity_threshold,
+        dpi=args.dpi,
+        router=router,
+        output_format="spec" if args.spec else "code",
+        split_panels=args.panels,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+端到端流水线压测：在本地模拟的 Claude API 上运行 app.py 中的各个环节，不需要联网，也不产生费用。
+
+每个请求依次经过:
+    encode   encode_image_to_base64 / preprocess_and_encode
+    call     call_claude_api（生成绘图代码）
+    execute  execute_code（沙箱执行，图片只在内存中）
+    doc      call_claude_api（把代码封装为函数）
+
+输出每个环节的 p50 / p95 / p99 延迟、给定并发下的吞吐量，以及进程（含沙箱子进程）的峰值内存。
+可以用 --threshold / --min-throughput / --max-rss-mb 设置门限，超出时以非零状态码退出，便于在 CI 中发现性能回退。
+
+用法:
+    python benchmarks/bench_pipeline.py -n 40 -c 4 --latency 0.3
+    python benchmarks/bench_pipeline.py -n 20 -c 2 --threshold execute.p95=3 --threshold total.p99=10 --json bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from metrics import percentile
+from mock_claude_server import MockConfig, load_responses, start_server
+
+STAGES = ["encode", "call", "execute", "doc", "total"]
+PERCENTILES = [50, 95, 99]
+
+
+def _rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _process_tree(root_pid):
+    """返回 root_pid 及其所有子孙进程的 pid（沙箱工作进程由 forkserver 创建，不是直接子进程）"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(children.get(pid, []))
+    return pids
+
+
+class RssSampler:
+    """后台线程定期采样进程树的总内存，记录峰值（仅 Linux 可用，其他平台只报告本进程的峰值）"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.available = os.path.isdir("/proc")
+
+    def _run(self):
+        while not self._stop.is_set():
+            total = sum(_rss_kb(pid) for pid in _process_tree(os.getpid()))
+            self.peak_kb = max(self.peak_kb, total)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if self.available:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self.available:
+            self._thread.join()
+
+
+def run_one(app, image_path, preprocess):
+    """跑一遍完整流水线，返回各环节耗时和失败的环节"""
+    timings = {}
+    start = time.perf_counter()
+
+    t = time.perf_counter()
+    if preprocess:
+        image_data, media_type, _ = app.preprocess_and_encode(image_path)
+    else:
+        image_data, media_type = app.encode_image_to_base64(image_path)
+    timings["encode"] = time.perf_counter() - t
+
+    messages = [{
+        "role": "user",
+        "content": [
+            {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": image_data}},
+            {"type": "text", "text": app.prompt_example_img},
+        ],
+    }]
+    t = time.perf_counter()
+    content = app.call_claude_api(messages, use_cache=False)
+    timings["call"] = time.perf_counter() - t
+    if content is None:
+        return timings, "call"
+
+    t = time.perf_counter()
+    try:
+        app.execute_code(content)
+    except RuntimeError:
+        return timings, "execute"
+    finally:
+        timings["execute"] = time.perf_counter() - t
+
+    code = app.extract_code(content[0].text)
+    messages_doc = [{"role": "user", "content": [{"type": "text", "text": app.prompt_doc + code}]}]
+    t = time.perf_counter()
+    doc = app.call_claude_api(messages_doc, use_cache=False, prompt_cache=False)
+    timings["doc"] = time.perf_counter() - t
+    if doc is None:
+        return timings, "doc"
+
+    timings["total"] = time.perf_counter() - start
+    return timings, None
+
+
+def summarize(samples, failures, requests, wall, peak_self_kb, peak_tree_kb, config):
+    report = {
+        "requests": requests,
+        "succeeded": len(samples["total"]),
+        "failures": failures,
+        "wall_seconds": wall,
+        "throughput_per_second": len(samples["total"]) / wall if wall else 0.0,
+        "peak_rss_mb": peak_self_kb / 1024,
+        "peak_tree_rss_mb": peak_tree_kb / 1024 if peak_tree_kb else None,
+        "mock_requests": config.requests,
+        "mock_errors": config.errors,
+        "stages": {},
+    }
+    for stage in STAGES:
+        values = samples[stage]
+        report["stages"][stage] = {"count": len(values), "mean": sum(values) / len(values) if values else None}
+        for q in PERCENTILES:
+            report["stages"][stage][f"p{q}"] = percentile(values, q)
+    return report
+
+
+def print_report(report):
+    print(f"请求数: {report['requests']}，成功: {report['succeeded']}，失败: {report['failures'] or '无'}")
+    print(f"模拟 API 收到请求 {report['mock_requests']} 次，注入错误 {report['mock_errors']} 次")
+    print(f"总耗时: {report['wall_seconds']:.2f}s，吞吐量: {report['throughput_per_second']:.2f} 张/秒")
+    print(f"峰值内存: 本进程 {report['peak_rss_mb']:.1f} MB", end="")
+    if report["peak_tree_rss_mb"] is not None:
+        print(f"，含沙箱子进程 {report['peak_tree_rss_mb']:.1f} MB")
+    else:
+        print()
+    print(f"{'环节':<10}{'次数':>6}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, stats in report["stages"].items():
+        cells = [f"{stats[k]:.3f}" if stats[k] is not None else "-" for k in ("mean", "p50", "p95", "p99")]
+        print(f"{stage:<10}{stats['count']:>6}" + "".join(f"{cell:>10}" for cell in cells))
+
+
+def check_thresholds(report, thresholds, min_throughput, max_rss_mb):
+    """返回所有超出门限的描述"""
+    violations = []
+    for name, limit in thresholds:
+        stage, _, stat = name.partition(".")
+        value = report["stages"].get(stage, {}).get(stat or "p95")
+        if value is None:
+            violations.append(f"{name}: 没有数据")
+        elif value > limit:
+            violations.append(f"{name} = {value:.3f}s，超过门限 {limit}s")
+    if min_throughput is not None and report["throughput_per_second"] < min_throughput:
+        violations.append(f"吞吐量 {report['throughput_per_second']:.2f} 张/秒，低于门限 {min_throughput}")
+    if max_rss_mb is not None:
+        peak = report["peak_tree_rss_mb"] or report["peak_rss_mb"]
+        if peak > max_rss_mb:
+            violations.append(f"峰值内存 {peak:.1f} MB，超过门限 {max_rss_mb} MB")
+    if report["failures"]:
+        violations.append(f"有 {sum(report['failures'].values())} 个请求失败")
+    return violations
+
+
+def parse_threshold(text):
+    name, _, value = text.partition("=")
+    if not value:
+        raise argparse.ArgumentTypeError("门限格式应为 环节.统计量=秒数，例如 execute.p95=2.5")
+    return name, float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在本地模拟的 Claude API 上压测整条流水线")
+    parser.add_argument("-n", "--requests", type=int, default=20, help="请求总数")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="并发数")
+    parser.add_argument("--image", default=os.path.join(ROOT, "example_image.png"), help="上传的图片")
+    parser.add_argument("--preprocess", action="store_true", help="使用 preprocess_and_encode 代替 encode_image_to_base64")
+    parser.add_argument("--exec-workers", type=int, help="沙箱工作进程数（默认与并发数相同）")
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟 API 的固定延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.05, help="模拟 API 延迟的随机抖动（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟 API 返回 429/500/529 的概率")
+    parser.add_argument("--responses-dir", help="从该目录加载 .py 文件作为模拟 API 返回的代码")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    parser.add_argument("--warmup", type=int, default=1, help="正式计时前预热的请求数")
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    parser.add_argument("--threshold", type=parse_threshold, action="append", default=[],
+                        help="延迟门限，例如 execute.p95=2.5（统计量省略时为 p95），可重复")
+    parser.add_argument("--min-throughput", type=float, help="吞吐量门限（张/秒）")
+    parser.add_argument("--max-rss-mb", type=float, help="峰值内存门限（MB）")
+    args = parser.parse_args()
+
+    responses = load_responses(args.responses_dir) if args.responses_dir else None
+    config = MockConfig(args.latency, args.jitter, error_rate=args.error_rate, responses=responses, seed=args.seed)
+    server, base_url = start_server(config)
+
+    # 必须在导入 app 之前设置，客户端和沙箱在导入或首次使用时读取这些环境变量
+    os.environ["ANTHROPIC_BASE_URL"] = base_url
+    os.environ.setdefault("ANTHROPIC_API_KEY", "mock")
+    os.environ["CLAUDE_CACHE_DISABLE"] = "1"
+    os.environ.setdefault("METRICS_DISABLE", "1")  # 不把压测产生的事件写进 metrics.jsonl
+    os.environ["CLAUDE_MAX_CONCURRENCY"] = str(args.concurrency)
+    os.environ["SANDBOX_WORKERS"] = str(args.exec_workers or args.concurrency)
+
+    import app
+    from sandbox import get_default_pool
+
+    # 没有 Streamlit 运行时，每次 st.* 调用都会打印缺少 ScriptRunContext 的警告
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").disabled = True
+
+    try:
+        for _ in range(args.warmup):
+            run_one(app, args.image, args.preprocess)
+        config.requests = config.errors = 0
+
+        samples = {stage: [] for stage in STAGES}
+        failures = {}
+        with RssSampler() as sampler, ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            start = time.perf_counter()
+            futures = [
+                executor.submit(run_one, app, args.image, args.preprocess)
+                for _ in range(args.requests)
+            ]
+            for future in futures:
+                timings, failed = future.result()
+                for stage, value in timings.items():
+                    samples[stage].append(value)
+                if failed:
+                    failures[failed] = failures.get(failed, 0) + 1
+            wall = time.perf_counter() - start
+    finally:
+        get_default_pool().close()
+        server.shutdown()
+
+    peak_self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_self_kb //= 1024  # macOS 上 ru_maxrss 的单位是字节
+    report = summarize(samples, failures, args.requests, wall, peak_self_kb, sampler.peak_kb, config)
+    report["config"] = {
+        "concurrency": args.concurrency,
+        "exec_workers": args.exec_workers or args.concurrency,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "error_rate": args.error_rate,
+        "preprocess": args.preprocess,
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    violations = check_thresholds(report, args.threshold, args.min_throughput, args.max_rss_mb)
+    for violation in violations:
+        print(f"超出门限: {violation}")
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+冷启动压测：测量导入 app.py（Streamlit 首次渲染页面前的准备工作）和各个命令行脚本启动所需的时间。
+
+每个目标在新的 Python 进程中运行若干次，取墙钟时间的中位数；另外用 python -X importtime 运行一次，
+统计导入耗时最多的模块，并检查不应在启动时导入的重量级模块（如 anthropic、matplotlib）。
+超出时间预算或导入了不该导入的模块时以非零状态码退出，便于在 CI 中发现启动变慢。
+
+用法:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py -n 10 --budget app=0.8 --budget batch=0.4 --json startup.json
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 目标: (python 的参数, 默认时间预算（秒）, 启动时不应导入的模块)
+TARGETS = {
+    "app": (["-c", "import app"], 1.0, ["anthropic", "matplotlib"]),
+    "batch": (["batch.py", "--help"], 0.6, ["anthropic", "matplotlib", "streamlit"]),
+    "worker": (["worker.py", "--help"], 0.3, ["anthropic", "matplotlib", "numpy"]),
+    "artifacts": (["artifacts.py", "--help"], 0.3, ["anthropic", "matplotlib", "numpy"]),
+    "library": (["library.py", "--help"], 0.6, ["anthropic", "matplotlib", "streamlit"]),
+    "metrics": (["metrics.py", "--help"], 0.3, ["anthropic", "matplotlib", "numpy"]),
+}
+
+_IMPORTTIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def _environ():
+    # 不连接真实的 API，也不写统计文件
+    env = dict(os.environ, METRICS_DISABLE="1", PYTHONDONTWRITEBYTECODE="1")
+    env.setdefault("ANTHROPIC_API_KEY", "x")
+    return env
+
+
+def time_target(args, runs):
+    """运行 runs 次，返回每次的墙钟时间（秒）"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, *args], cwd=ROOT, env=_environ(), capture_output=True)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(f"{' '.join(args)} 退出码 {result.returncode}:\n{result.stderr.decode(errors='replace')}")
+    return times
+
+
+def import_profile(args):
+    """用 -X importtime 运行一次，返回 {模块: 累计导入耗时（秒）} 和顶层导入的总耗时"""
+    result = subprocess.run([sys.executable, "-X", "importtime", *args], cwd=ROOT, env=_environ(),
+                            capture_output=True, text=True)
+    modules = {}
+    total = 0.0
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match is None:
+            continue
+        cumulative = int(match.group(2)) / 1e6
+        modules[match.group(4)] = cumulative
+        if len(match.group(3)) == 1:
+            total += cumulative
+    return modules, total
+
+
+def measure(names, runs):
+    report = {}
+    for name in names:
+        args, budget, forbidden = TARGETS[name]
+        # 先跑一次，让 .pyc 和文件系统缓存就绪，只测量之后的几次
+        time_target(args, 1)
+        times = time_target(args, runs)
+        modules, import_total = import_profile(args)
+        top_level = sorted(((m, s) for m, s in modules.items() if "." not in m), key=lambda item: -item[1])
+        report[name] = {
+            "median": statistics.median(times),
+            "min": min(times),
+            "max": max(times),
+            "import_total": import_total,
+            "budget": budget,
+            "slowest_imports": [[module, seconds] for module, seconds in top_level[:5]],
+            "forbidden_loaded": [module for module in forbidden if module in modules],
+        }
+    return report
+
+
+def print_report(report):
+    print(f"{'目标':<12}{'中位数':>10}{'最小':>10}{'最大':>10}{'导入':>10}{'预算':>8}  导入最慢的模块")
+    for name, stats in report.items():
+        slowest = "，".join(f"{module} {seconds * 1000:.0f}ms" for module, seconds in stats["slowest_imports"][:3])
+        print(f"{name:<12}{stats['median']:>10.3f}{stats['min']:>10.3f}{stats['max']:>10.3f}"
+              f"{stats['import_total']:>10.3f}{stats['budget']:>8g}  {slowest}")
+
+
+def check_budgets(report):
+    """返回所有超出预算或导入了不该导入的模块的描述"""
+    violations = []
+    for name, stats in report.items():
+        if stats["median"] > stats["budget"]:
+            violations.append(f"{name}: 启动耗时 {stats['median']:.3f}s，超过预算 {stats['budget']}s")
+        if stats["forbidden_loaded"]:
+            violations.append(f"{name}: 启动时导入了 {', '.join(stats['forbidden_loaded'])}")
+    return violations
+
+
+def parse_budget(text):
+    name, _, value = text.partition("=")
+    if name not in TARGETS or not value:
+        raise argparse.ArgumentTypeError(f"预算格式应为 目标=秒数，目标为 {', '.join(TARGETS)} 之一")
+    return name, float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测量 app.py 和命令行脚本的冷启动时间")
+    parser.add_argument("targets", nargs="*", help=f"要测量的目标（{', '.join(TARGETS)}），默认全部")
+    parser.add_argument("-n", "--runs", type=int, default=5, help="每个目标的运行次数")
+    parser.add_argument("--budget", type=parse_budget, action="append", default=[],
+                        help="覆盖默认的时间预算，例如 app=0.8（可多次指定）")
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.targets if name not in TARGETS]
+    if unknown:
+        parser.error(f"未知的目标: {', '.join(unknown)}")
+    names = args.targets or list(TARGETS)
+    report = measure(names, args.runs)
+    for name, budget in args.budget:
+        if name in report:
+            report[name]["budget"] = budget
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    violations = check_budgets(report)
+    for violation in violations:
+        print(f"[超出预算] {violation}")
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""
+本地模拟的 Claude Messages API 服务，用于离线压测，不产生任何费用。
+
+支持:
+    POST /v1/messages               普通请求和 stream=true 的 SSE 流式请求
+    POST /v1/messages/count_tokens  token 计数
+
+可以配置固定延迟与随机抖动、流式输出的逐 token 延迟、错误率（随机返回 429 / 500 / 529），
+以及返回的绘图代码（默认内置几段常见图表代码，也可以从目录加载 .py 文件）。
+
+用法:
+    python benchmarks/mock_claude_server.py --port 8765 --latency 0.5 --error-rate 0.05
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 ANTHROPIC_API_KEY=mock streamlit run app.py
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_CODE = [
+    """import numpy as np
+x = np.linspace(0, 10, 200)
+fig, ax = plt.subplots(figsize=(6, 4))
+ax.plot(x, np.sin(x), color="tab:blue", label="sin")
+ax.plot(x, np.cos(x), color="tab:orange", linestyle="--", label="cos")
+ax.set_xlabel("x")
+ax.set_ylabel("y")
+ax.legend()
+""",
+    """import numpy as np
+rng = np.random.default_rng(0)
+x = rng.normal(size=2000)
+y = 0.5 * x + rng.normal(scale=0.5, size=2000)
+fig, ax = plt.subplots(figsize=(5, 5))
+ax.scatter(x, y, s=4, alpha=0.5, c=y, cmap="viridis")
+ax.set_title("scatter")
+""",
+    """import numpy as np
+labels = ["A", "B", "C", "D", "E"]
+values = [12, 25, 18, 30, 9]
+fig, ax = plt.subplots(figsize=(6, 4))
+ax.bar(labels, values, color=["#4C72B0", "#55A868", "#C44E52", "#8172B2", "#CCB974"])
+ax.set_ylabel("count")
+""",
+    """import numpy as np
+x = np.linspace(-3, 3, 150)
+X, Y = np.meshgrid(x, x)
+Z = np.exp(-(X ** 2 + Y ** 2)) * np.cos(3 * X)
+fig, ax = plt.subplots(figsize=(5, 4))
+mesh = ax.pcolormesh(X, Y, Z, cmap="RdBu_r", shading="auto")
+fig.colorbar(mesh, ax=ax)
+""",
+]
+
+CANNED_DOC = '''```python
+import numpy as np
+import matplotlib.pyplot as plt
+
+
+def generate_figure(save_path="figure.png", color="tab:blue"):
+    """生成示例图像
+
+    参数:
+        save_path: 图像保存路径
+        color: 曲线颜色
+    """
+    x = np.linspace(0, 10, 200)
+    fig, ax = plt.subplots(figsize=(6, 4))
+    ax.plot(x, np.sin(x), color=color)
+    fig.savefig(save_path)
+    return plt
+```'''
+
+
+class MockConfig:
+    """模拟服务的可调参数"""
+
+    def __init__(self, latency=0.2, jitter=0.05, token_delay=0.0, error_rate=0.0,
+                 responses=None, fenced=True, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.responses = responses or CANNED_CODE
+        self.fenced = fenced
+        self.random = random.Random(seed)
+        self._cycle = itertools.cycle(range(len(self.responses)))
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def next_reply(self, messages):
+        """文档请求返回函数封装，其余请求轮流返回绘图代码"""
+        last_text = _last_user_text(messages)
+        if "generate_figure" in last_text:
+            return CANNED_DOC
+        with self._lock:
+            code = self.responses[next(self._cycle)]
+        return f"```python\n{code}```" if self.fenced else code
+
+    def sleep(self):
+        delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        time.sleep(delay)
+
+    def pick_error(self):
+        with self._lock:
+            self.requests += 1
+            if self.random.random() >= self.error_rate:
+                return None
+            self.errors += 1
+            return self.random.choice([429, 500, 529])
+
+
+def _last_user_text(messages):
+    for message in reversed(messages):
+        if message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, str):
+            return content
+        return "\n".join(block.get("text", "") for block in content if block.get("type") == "text")
+    return ""
+
+
+def _estimate_input_tokens(body):
+    """粗略估算输入 token：文本按 4 字节 1 个 token，图片按固定 1000 个 token"""
+    tokens = 0
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content.encode("utf-8")) // 4
+            continue
+        for block in content:
+            if block.get("type") == "image":
+                tokens += 1000
+            else:
+                tokens += len(block.get("text", "").encode("utf-8")) // 4
+    return max(tokens, 1)
+
+
+ERROR_TYPES = {429: "rate_limit_error", 500: "api_error", 529: "overloaded_error"}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None  # 由 make_server 注入
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+
+        if self.path.startswith("/v1/messages/count_tokens"):
+            self._send_json(200, {"input_tokens": _estimate_input_tokens(body)})
+            return
+        if not self.path.startswith("/v1/messages"):
+            self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+            return
+
+        config = self.config
+        config.sleep()
+        status = config.pick_error()
+        if status is not None:
+            self._send_json(status, {
+                "type": "error",
+                "error": {"type": ERROR_TYPES[status], "message": "mock error"},
+            }, headers={"retry-after": "0"} if status == 429 else None)
+            return
+
+        text = config.next_reply(body.get("messages", []))
+        input_tokens = _estimate_input_tokens(body)
+        output_tokens = max(1, len(text.encode("utf-8")) // 4)
+        if body.get("stream"):
+            self._stream(body, text, input_tokens, output_tokens)
+        else:
+            self._send_json(200, {
+                "id": "msg_mock",
+                "type": "message",
+                "role": "assistant",
+                "model": body.get("model"),
+                "content": [{"type": "text", "text": text}],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+            })
+
+    def _stream(self, body, text, input_tokens, output_tokens):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("connection", "close")
+        self.end_headers()
+
+        def event(name, payload):
+            self.wfile.write(f"event: {name}\ndata: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            event("message_start", {"type": "message_start", "message": {
+                "id": "msg_mock", "type": "message", "role": "assistant", "model": body.get("model"),
+                "content": [], "stop_reason": None, "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": 1},
+            }})
+            event("content_block_start", {"type": "content_block_start", "index": 0,
+                                          "content_block": {"type": "text", "text": ""}})
+            # 约 4 个字符一个 token
+            for start in range(0, len(text), 4):
+                event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                              "delta": {"type": "text_delta", "text": text[start:start + 4]}})
+                if self.config.token_delay:
+                    time.sleep(self.config.token_delay)
+            event("content_block_stop", {"type": "content_block_stop", "index": 0})
+            event("message_delta", {"type": "message_delta",
+                                    "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                    "usage": {"output_tokens": output_tokens}})
+            event("message_stop", {"type": "message_stop"})
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前中止了流式输出
+            pass
+        self.close_connection = True
+
+
+def load_responses(directory):
+    """从目录加载 .py 文件作为返回的绘图代码"""
+    responses = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.py"))):
+        with open(path, "r", encoding="utf-8") as f:
+            responses.append(f.read())
+    return responses
+
+
+def make_server(config, host="127.0.0.1", port=0):
+    """创建服务（port=0 时自动选择空闲端口）"""
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"config": config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_server(config=None, host="127.0.0.1", port=0):
+    """在后台线程中启动服务，返回 (server, base_url)"""
+    server = make_server(config or MockConfig(), host, port)
+    thread = threading.Thread(target=server.serve_forever, name="mock-claude", daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的 Claude Messages API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="每个请求的固定延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.05, help="延迟的随机抖动范围（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="流式输出时每个 token 的延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 429/500/529 错误的概率")
+    parser.add_argument("--responses-dir", help="从该目录加载 .py 文件作为返回的绘图代码")
+    parser.add_argument("--seed", type=int, help="随机数种子")
+    args = parser.parse_args()
+
+    responses = load_responses(args.responses_dir) if args.responses_dir else None
+    config = MockConfig(args.latency, args.jitter, args.token_delay, args.error_rate, responses, seed=args.seed)
+    server = make_server(config, args.host, args.port)
+    print(f"模拟 Claude API 已启动: http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Claude 回复的磁盘缓存。
+
+缓存键由图片内容哈希、提示词文本（完整对话）、模型名和 max_tokens 共同决定，
+相同请求直接从磁盘返回，不再产生 API 费用。
+缓存目录按总大小做 LRU 淘汰，条目写入后超过 TTL 即失效。
+条目文件写入一次后不再修改，修改时间就是写入时间（用于 TTL），访问时间记录最近一次命中（用于 LRU）。
+
+环境变量:
+    CLAUDE_CACHE_DIR        缓存目录，默认 .claude_cache
+    CLAUDE_CACHE_MAX_BYTES  缓存总大小上限，默认 200MB
+    CLAUDE_CACHE_TTL        条目有效期（秒），默认 7 天
+    CLAUDE_CACHE_DISABLE    设为 1 时跳过缓存
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+DEFAULT_CACHE_DIR = ".claude_cache"
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+DEFAULT_TTL = 7 * 24 * 3600
+EVICT_EVERY = 100  # 总大小没有超出上限时，每写入这么多条才扫描一次目录（清理过期条目、计入其他进程写入的条目）
+
+# 与 anthropic 返回的 TextBlock 保持同样的属性访问方式 (block.type / block.text)
+CachedTextBlock = namedtuple("CachedTextBlock", ["type", "text"])
+
+
+def hash_image_source(source):
+    """计算图片内容的 sha256，base64 图片按解码后的字节计算"""
+    if source.get("type") == "base64":
+        data = base64.standard_b64decode(source["data"])
+    else:
+        data = json.dumps(source, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def canonicalize_messages(messages):
+    """把对话中的图片数据替换为内容哈希，得到用于计算缓存键的规范形式"""
+    canonical = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            canonical.append({"role": message["role"], "content": content})
+            continue
+        blocks = []
+        for block in content:
+            if block.get("type") == "image":
+                blocks.append({"type": "image", "sha256": hash_image_source(block["source"])})
+            else:
+                # cache_control 等标记不影响回复内容，不参与缓存键
+                blocks.append({k: v for k, v in block.items() if k != "cache_control"})
+        canonical.append({"role": message["role"], "content": blocks})
+    return canonical
+
+
+def make_cache_key(messages, model, max_tokens):
+    """根据对话内容、模型名和 max_tokens 生成缓存键"""
+    payload = json.dumps({
+        "model": model,
+        "max_tokens": max_tokens,
+        "messages": canonicalize_messages(messages),
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """基于文件的回复缓存，每个条目一个 JSON 文件；修改时间为写入时间，访问时间记录最近一次命中"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._approx_bytes = None  # 上次扫描得到的总大小加上之后写入的字节数，还没扫描过时为 None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _expired(self, written, now):
+        """get 和 evict 共用的过期判断：从条目写入的时间算起"""
+        return self.ttl is not None and now - written > self.ttl
+
+    def get(self, key):
+        """命中时返回 CachedTextBlock 列表，未命中或已过期返回 None"""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                written = os.fstat(f.fileno()).st_mtime
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        now = time.time()
+        if self._expired(written, now):
+            self._remove(path)
+            return None
+
+        # 只更新访问时间供 LRU 淘汰使用，保留修改时间（写入时间）
+        try:
+            os.utime(path, (now, written))
+        except FileNotFoundError:
+            return None
+        return [CachedTextBlock(block["type"], block["text"]) for block in entry["content"]]
+
+    def put(self, key, content, model=None, usage=None):
+        """写入一条回复，content 为带 type/text 属性的块列表"""
+        entry = {
+            "created": time.time(),
+            "model": model,
+            "usage": usage,
+            "content": [
+                {"type": block.type, "text": block.text}
+                for block in content if getattr(block, "type", None) == "text"
+            ],
+        }
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        # 不必每次写入都列出整个目录：估计的总大小超出上限，或者写入了 EVICT_EVERY 条之后才扫描
+        with self._lock:
+            self._puts += 1
+            if self._approx_bytes is not None:
+                self._approx_bytes += len(data)
+            due = self._approx_bytes is None or self._approx_bytes > self.max_bytes or self._puts >= EVICT_EVERY
+        if due:
+            self.evict()
+
+    def discard(self, key):
+        """删除指定条目"""
+        self._remove(self._path(key))
+
+    def evict(self):
+        """删除过期条目，并按最近访问时间淘汰，直到总大小不超过上限"""
+        with self._lock:
+            now = time.time()
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+            # 按最近访问时间从旧到新淘汰
+            entries.sort()
+            for _, written, size, path in entries:
+                if not self._expired(written, now) and total <= self.max_bytes:
+                    continue
+                self._remove(path)
+                total -= size
+            self._approx_bytes = total
+            self._puts = 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+_default_cache = None
+
+
+def cache_enabled():
+    """CLAUDE_CACHE_DISABLE=1 时关闭缓存"""
+    return os.environ.get("CLAUDE_CACHE_DISABLE", "0") != "1"
+
+
+def get_default_cache():
+    """返回按环境变量配置的全局缓存实例"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResponseCache(
+            cache_dir=os.environ.get("CLAUDE_CACHE_DIR", DEFAULT_CACHE_DIR),
+            max_bytes=int(os.environ.get("CLAUDE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+            ttl=float(os.environ.get("CLAUDE_CACHE_TTL", DEFAULT_TTL)),
+        )
+    return _default_cache
+
+
+class CachedRequest:
+    """
+    一次 API 请求在缓存中的条目。各处调用 API 的地方都通过它读写缓存，
+    缓存键（对话、模型、max_tokens）和记录的用量格式保持一致；use_cache 为 False 或缓存被禁用时什么都不做。
+    """
+
+    def __init__(self, messages, model, max_tokens, use_cache=True):
+        self.model = model
+        self.cache = get_default_cache() if use_cache and cache_enabled() else None
+        self.key = make_cache_key(messages, model, max_tokens) if self.cache is not None else None
+
+    def get(self):
+        """命中时返回 CachedTextBlock 列表，否则返回 None"""
+        return self.cache.get(self.key) if self.cache is not None else None
+
+    def put(self, response):
+        """保存 API 响应的回复和 token 用量"""
+        if self.cache is not None:
+            self.cache.put(self.key, response.content, model=self.model, usage={
+                "input_tokens": response.usage.input_tokens,
+                "output_tokens": response.usage.output_tokens,
+            })
+
+    def discard(self):
+        """删除这条缓存（例如回复的代码执行失败时），重试时不会拿到同样的结果"""
+        if self.cache is not None:
+            self.cache.discard(self.key)
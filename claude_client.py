@@ -0,0 +1,306 @@
+"""
+基于 asyncio 的 Claude API 调用层。
+
+整个进程共享一个 AsyncAnthropic 客户端，它运行在一个常驻的后台事件循环线程中，
+所有请求复用同一个 HTTP 连接池。在同一时刻发出的请求数由信号量限制，
+因此同时打开的连接数也不会超过并发上限。
+
+    # 协程中（批量处理、任意事件循环）
+    response = await acreate_message(messages)
+
+    # 同步代码中（Streamlit 脚本、命令行脚本）
+    response = create_message(messages)
+
+    # 流式输出，on_text 在后台事件循环中被调用，返回 False 时中止
+    response, text, aborted = await astream_message(messages, on_text=lambda delta, text: ...)
+
+每个请求都有单独的超时时间，遇到 429 / 5xx / 网络错误时按指数退避加随机抖动重试。
+默认会给对话的稳定前缀加上提示缓存标记（见 prompt_cache.py），可以用 prompt_cache=False 关闭。
+
+导入 anthropic 要一秒多，因此推迟到第一次请求时才导入；界面可以先调用 preload() 在后台线程中提前导入，
+捕获 API 错误时用 except api_errors()。
+
+环境变量:
+    CLAUDE_MAX_CONCURRENCY  同时进行的请求数上限，默认 8
+    CLAUDE_TIMEOUT          单个请求的超时时间（秒），默认 120
+    CLAUDE_MAX_RETRIES      最大重试次数，默认 4
+    CLAUDE_PROMPT_CACHE     设为 0 时不加提示缓存标记
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+
+import metrics
+from prompt_cache import mark_cache_breakpoints
+
+DEFAULT_MODEL = "claude-3-5-sonnet-20241022"
+DEFAULT_MAX_TOKENS = 2048
+
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+_settings = {
+    "max_concurrency": int(os.environ.get("CLAUDE_MAX_CONCURRENCY", 8)),
+    "timeout": float(os.environ.get("CLAUDE_TIMEOUT", 120)),
+    "max_retries": int(os.environ.get("CLAUDE_MAX_RETRIES", 4)),
+    "prompt_cache": os.environ.get("CLAUDE_PROMPT_CACHE", "1") != "0",
+}
+
+_loop = None
+_loop_thread = None
+_client = None
+_semaphore = None
+_lock = threading.Lock()
+_preload_thread = None
+
+
+def _anthropic():
+    """导入 anthropic（第一次调用之后只是查 sys.modules）"""
+    import anthropic
+
+    return anthropic
+
+
+def preload():
+    """在后台线程中提前导入 anthropic，不阻塞调用方；重复调用只启动一次"""
+    global _preload_thread
+    with _lock:
+        if _preload_thread is None:
+            _preload_thread = threading.Thread(target=_anthropic, name="claude-preload", daemon=True)
+            _preload_thread.start()
+
+
+def api_errors():
+    """调用 API 可能抛出的异常类型，用于 except api_errors()"""
+    return _anthropic().APIError, TimeoutError
+
+
+def configure(max_concurrency=None, timeout=None, max_retries=None, prompt_cache=None):
+    """修改并发上限、超时时间、重试次数和提示缓存开关，需要在第一次请求之前调用才能改变并发上限"""
+    if max_concurrency is not None:
+        _settings["max_concurrency"] = max_concurrency
+    if timeout is not None:
+        _settings["timeout"] = timeout
+    if max_retries is not None:
+        _settings["max_retries"] = max_retries
+    if prompt_cache is not None:
+        _settings["prompt_cache"] = prompt_cache
+
+
+def _prepare_messages(messages, prompt_cache):
+    """按设置给对话加上提示缓存标记"""
+    if prompt_cache is None:
+        prompt_cache = _settings["prompt_cache"]
+    return mark_cache_breakpoints(messages) if prompt_cache else messages
+
+
+def _run_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def _ensure_loop():
+    """启动后台事件循环线程，并在其中创建共享客户端"""
+    global _loop, _loop_thread, _client, _semaphore
+    with _lock:
+        if _loop is not None:
+            return _loop
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=_run_loop, args=(loop,), name="claude-client", daemon=True)
+        thread.start()
+
+        async def _init():
+            # 客户端和信号量必须在所属的事件循环中创建
+            client = _anthropic().AsyncAnthropic(max_retries=0, timeout=_settings["timeout"])
+            return client, asyncio.Semaphore(_settings["max_concurrency"])
+
+        _client, _semaphore = asyncio.run_coroutine_threadsafe(_init(), loop).result()
+        _loop, _loop_thread = loop, thread
+        return loop
+
+
+def is_retryable(error):
+    """判断错误是否值得重试：限流、服务端错误、超时和网络错误"""
+    anthropic = _anthropic()
+    if isinstance(error, (anthropic.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+def retry_delay(attempt, error=None):
+    """指数退避加全抖动；服务端给出 retry-after 时以其为下限"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+    return delay
+
+
+async def _with_retries(request, timeout):
+    """在并发上限内执行请求，可重试的错误按退避策略重试"""
+    timeout = _settings["timeout"] if timeout is None else timeout
+    attempt = 0
+    while True:
+        try:
+            async with _semaphore:
+                return await asyncio.wait_for(request(timeout), timeout)
+        except Exception as e:
+            if not is_retryable(e) or attempt >= _settings["max_retries"]:
+                raise
+            await asyncio.sleep(retry_delay(attempt, e))
+            attempt += 1
+
+
+async def _create_message(messages, model, max_tokens, timeout, extra):
+    start = time.perf_counter()
+    try:
+        response = await _with_retries(
+            lambda t: _client.messages.create(
+                model=model,
+                max_tokens=max_tokens,
+                messages=messages,
+                timeout=t,
+                **extra
+            ),
+            timeout,
+        )
+    except Exception:
+        # CancelledError 不是 Exception 的子类，被取消的请求（例如多余的候选）不计入统计
+        metrics.record_stage("api", time.perf_counter() - start, ok=False, model=model)
+        raise
+    metrics.record_stage("api", time.perf_counter() - start, model=model)
+    metrics.record_usage(response.usage, model)
+    return response
+
+
+async def _submit(coro):
+    """把协程交给后台事件循环执行，并在调用方的事件循环中等待结果"""
+    loop = _ensure_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+async def acreate_message(messages, model=DEFAULT_MODEL, max_tokens=DEFAULT_MAX_TOKENS, timeout=None,
+                          prompt_cache=None, **extra):
+    """异步调用 messages.create，可以在任意事件循环中 await"""
+    _ensure_loop()
+    messages = _prepare_messages(messages, prompt_cache)
+    return await _submit(_create_message(messages, model, max_tokens, timeout, extra))
+
+
+def create_message(messages, model=DEFAULT_MODEL, max_tokens=DEFAULT_MAX_TOKENS, timeout=None,
+                   prompt_cache=None, **extra):
+    """同步调用 messages.create，供 Streamlit 脚本和命令行脚本使用"""
+    loop = _ensure_loop()
+    messages = _prepare_messages(messages, prompt_cache)
+    future = asyncio.run_coroutine_threadsafe(
+        _create_message(messages, model, max_tokens, timeout, extra), loop
+    )
+    return future.result()
+
+
+async def _count_tokens(messages, model, timeout):
+    result = await _with_retries(
+        lambda t: _client.messages.count_tokens(model=model, messages=messages, timeout=t),
+        timeout,
+    )
+    return result.input_tokens
+
+
+def count_tokens(messages, model=DEFAULT_MODEL, timeout=None):
+    """调用 token 计数接口（免费，不产生输出），返回输入 token 数"""
+    loop = _ensure_loop()
+    return asyncio.run_coroutine_threadsafe(_count_tokens(messages, model, timeout), loop).result()
+
+
+def submit(coro):
+    """在后台事件循环中运行任意协程，立即返回 concurrent.futures.Future"""
+    loop = _ensure_loop()
+    return asyncio.run_coroutine_threadsafe(coro, loop)
+
+
+def run_sync(coro):
+    """在后台事件循环中运行任意协程并阻塞等待结果，适合从同步代码中并发发出多个请求"""
+    return submit(coro).result()
+
+
+async def _stream_message(messages, model, max_tokens, timeout, on_text, extra):
+    """
+    流式调用 messages.stream，每收到一段文本调用 on_text(delta, text)。
+    on_text 返回 False 时立即关闭连接，不再为剩余输出付费。
+
+    返回 (final_message, text, aborted)，中止时 final_message 为 None。
+    只有在还没收到任何文本时出错才会重试，避免重复输出。
+    """
+    start = time.perf_counter()
+    try:
+        final_message, text, aborted = await _stream_with_retries(
+            messages, model, max_tokens, timeout, on_text, extra, start
+        )
+    except asyncio.CancelledError:
+        # 请求被取消（例如多余的候选）
+        metrics.record_stage("api", time.perf_counter() - start, model=model, stream=True, aborted=True)
+        raise
+    except Exception:
+        metrics.record_stage("api", time.perf_counter() - start, ok=False, model=model, stream=True)
+        raise
+    metrics.record_stage("api", time.perf_counter() - start, model=model, stream=True, aborted=aborted)
+    if final_message is not None:
+        metrics.record_usage(final_message.usage, model)
+    return final_message, text, aborted
+
+
+async def _stream_with_retries(messages, model, max_tokens, timeout, on_text, extra, start):
+    timeout = _settings["timeout"] if timeout is None else timeout
+    attempt = 0
+    while True:
+        text = ""
+        try:
+            async with _semaphore:
+                async def consume():
+                    nonlocal text
+                    async with _client.messages.stream(
+                        model=model,
+                        max_tokens=max_tokens,
+                        messages=messages,
+                        timeout=timeout,
+                        **extra
+                    ) as stream:
+                        async for delta in stream.text_stream:
+                            if not text:
+                                metrics.record_stage("api_ttft", time.perf_counter() - start, model=model)
+                            text += delta
+                            if on_text is not None and on_text(delta, text) is False:
+                                return None, text, True
+                        return await stream.get_final_message(), text, False
+
+                return await asyncio.wait_for(consume(), timeout)
+        except Exception as e:
+            if text or not is_retryable(e) or attempt >= _settings["max_retries"]:
+                raise
+            await asyncio.sleep(retry_delay(attempt, e))
+            attempt += 1
+
+
+async def astream_message(messages, model=DEFAULT_MODEL, max_tokens=DEFAULT_MAX_TOKENS, timeout=None,
+                          on_text=None, prompt_cache=None, **extra):
+    """
+    异步流式调用，每收到一段文本在后台事件循环中调用 on_text(delta, text)，返回 False 时中止生成。
+    返回 (final_message, text, aborted)，中止时 final_message 为 None。
+    """
+    _ensure_loop()
+    messages = _prepare_messages(messages, prompt_cache)
+    return await _submit(_stream_message(messages, model, max_tokens, timeout, on_text, extra))
@@ -0,0 +1,409 @@
+"""
+生成代码的检查工具。
+
+流式生成时，回复是一点点到达的，这里只检查已经完整到达的行：
+能确定是语法错误（而不是“还没写完”）时立即报告，调用方就可以提前中止这次生成并重试，
+不必等到整段回复结束、付完全部输出 token 之后才在 exec 时发现问题。
+
+完整的代码在交给沙箱执行之前，还会用 analyze_code 做一次基于 AST 的静态检查：
+禁止调用的函数（plt.show() 等）、不允许导入或没有安装的模块、使用了却没有导入的名字、
+没有出口的死循环、常量参数就能看出过大的数组。有问题的代码不再执行，检查结果直接作为错误信息发回模型修复，
+省去执行到一半才失败（或者卡到超时）的时间。
+"""
+import ast
+import builtins
+import codeop
+import importlib.util
+import re
+import warnings
+from collections import namedtuple
+
+# 没有代码块标记时，只有以这些语句开头的回复才确定是代码；
+# "Sure, here is the code:" 之类的说明文字也能匹配赋值、调用等宽松的模式，不能当作代码检查
+_CODE_LINE = re.compile(r"^\s*(import\s+\w|from\s+[\w\.]+\s+import\s|def\s+\w+\s*\(|class\s+\w+\s*[\(:])")
+
+
+def extract_code(text):
+    """从模型回复中提取实际代码"""
+    if "```python" in text and "```" in text:
+        text = text.split("```python\n", 1)[-1].split("```", 1)[0]
+    return text
+
+
+def partial_code_view(text):
+    """
+    从尚未结束的流式回复中取出当前已到达的代码部分。
+
+    返回 (code, closed)：closed 表示代码块已经结束。
+    回复以说明文字开头、还看不到代码时返回 (None, False)。
+    """
+    if "```python" in text:
+        code = text.split("```python", 1)[1]
+        code = code.split("\n", 1)[1] if "\n" in code else ""
+        closed = "```" in code
+        return code.split("```", 1)[0], closed
+
+    first_line = next((line for line in text.splitlines() if line.strip()), "")
+    if first_line.startswith("```") or not _CODE_LINE.match(first_line):
+        # 可能是代码块前的说明文字，等代码块出现后再检查
+        return None, False
+    return text, False
+
+
+def find_partial_syntax_error(text):
+    """
+    检查流式回复中已完整到达的代码行。
+
+    返回错误描述字符串；代码暂时没有问题或只是尚未写完时返回 None。
+    """
+    code, closed = partial_code_view(text)
+    if code is None:
+        return None
+    if not closed:
+        # 只检查完整的行，最后一行可能还没写完；以反斜杠续行结尾的行要和下一行一起才完整
+        lines = code.splitlines(True)
+        if lines and not code.endswith("\n"):
+            lines.pop()
+        while lines and lines[-1].rstrip("\r\n").endswith("\\"):
+            lines.pop()
+        code = "".join(lines)
+    if not code.strip():
+        return None
+
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            codeop.compile_command(code, "<stream>", "exec")
+    except (SyntaxError, ValueError, OverflowError) as e:
+        lineno = getattr(e, "lineno", None)
+        where = f"第 {lineno} 行" if lineno else "代码中"
+        return f"{where}存在语法错误: {getattr(e, 'msg', e)}"
+    return None
+
+
+# kind: syntax / forbidden_call / disallowed_import / missing_import / unbounded_loop / large_allocation
+Finding = namedtuple("Finding", ["lineno", "kind", "message"])
+
+# 执行环境预先提供的名字（见 sandbox._run_job）
+SANDBOX_GLOBALS = {"plt": "matplotlib.pyplot"}
+
+# 无界面的沙箱中会阻塞、切换后端、退出进程或调用外部程序的函数
+FORBIDDEN_CALLS = {
+    "matplotlib.pyplot.show": "不要调用 plt.show()，图像会在代码执行后自动保存",
+    "matplotlib.pyplot.pause": "不要调用 plt.pause()，环境中没有图形界面",
+    "matplotlib.pyplot.ginput": "不要调用 plt.ginput()，环境中没有图形界面",
+    "matplotlib.pyplot.waitforbuttonpress": "不要调用 plt.waitforbuttonpress()，环境中没有图形界面",
+    "matplotlib.use": "不要切换 matplotlib 后端",
+    "matplotlib.pyplot.switch_backend": "不要切换 matplotlib 后端",
+    "input": "不要调用 input()，执行时无法读取输入",
+    "breakpoint": "不要调用 breakpoint()",
+    "exit": "不要调用 exit()",
+    "quit": "不要调用 quit()",
+    "sys.exit": "不要调用 sys.exit()",
+    "os._exit": "不要调用 os._exit()",
+    "os.system": "不要调用 os.system() 执行外部命令",
+    "os.popen": "不要调用 os.popen() 执行外部命令",
+    "os.kill": "不要调用 os.kill()",
+    "os.remove": "不要删除文件",
+    "os.unlink": "不要删除文件",
+    "os.rmdir": "不要删除目录",
+}
+
+# 绘图代码不需要、且在沙箱中可能有害（联网、起进程、弹出窗口）的模块
+DISALLOWED_MODULES = {
+    "subprocess", "socket", "ctypes", "multiprocessing", "threading", "signal", "shutil",
+    "requests", "urllib", "http", "ftplib", "smtplib", "webbrowser",
+    "tkinter", "PyQt5", "PyQt6", "PySide2", "PySide6", "wx",
+}
+
+# 常见的模块别名，用于提示缺少的 import
+IMPORT_HINTS = {
+    "np": "import numpy as np",
+    "pd": "import pandas as pd",
+    "sns": "import seaborn as sns",
+    "mpl": "import matplotlib as mpl",
+    "cm": "from matplotlib import cm",
+    "colors": "from matplotlib import colors",
+    "mcolors": "import matplotlib.colors as mcolors",
+    "patches": "import matplotlib.patches as patches",
+    "mpatches": "import matplotlib.patches as mpatches",
+    "gridspec": "import matplotlib.gridspec as gridspec",
+    "stats": "from scipy import stats",
+    "math": "import math",
+    "random": "import random",
+}
+
+MAX_ARRAY_ELEMENTS = 2 * 10 ** 7   # 单个数组超过 2000 万个元素（float64 约 160MB）视为过大
+MAX_LOOP_ITERATIONS = 10 ** 8      # Python 循环超过 1 亿次视为过大
+
+# 数组的元素个数由哪个参数决定：(位置, 关键字)
+_COUNT_ARGUMENTS = {
+    "numpy.linspace": (2, "num"),
+    "numpy.logspace": (2, "num"),
+    "numpy.geomspace": (2, "num"),
+}
+_SHAPE_ARGUMENTS = {
+    "numpy.zeros": (0, "shape"),
+    "numpy.ones": (0, "shape"),
+    "numpy.empty": (0, "shape"),
+    "numpy.full": (0, "shape"),
+    "numpy.random.random": (0, "size"),
+    "numpy.random.normal": (2, "size"),
+    "numpy.random.uniform": (2, "size"),
+    "numpy.random.randint": (2, "size"),
+    "numpy.random.poisson": (1, "size"),
+    "numpy.random.exponential": (1, "size"),
+}
+_VARARG_SHAPES = {"numpy.random.rand", "numpy.random.randn"}
+
+
+def _const(node):
+    """计算只由数字常量组成的表达式，无法确定时返回 None"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return node.value
+    if isinstance(node, (ast.Tuple, ast.List)):
+        values = [_const(element) for element in node.elts]
+        return None if any(value is None for value in values) else tuple(values)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = _const(node.operand)
+        if isinstance(value, (int, float)):
+            return -value if isinstance(node.op, ast.USub) else value
+        return None
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ("int", "float") \
+            and len(node.args) == 1 and not node.keywords:
+        value = _const(node.args[0])
+        if isinstance(value, (int, float)):
+            return int(value) if node.func.id == "int" else float(value)
+        return None
+    if isinstance(node, ast.BinOp):
+        left, right = _const(node.left), _const(node.right)
+        if not isinstance(left, (int, float)) or not isinstance(right, (int, float)):
+            return None
+        try:
+            if isinstance(node.op, ast.Add):
+                return left + right
+            if isinstance(node.op, ast.Sub):
+                return left - right
+            if isinstance(node.op, ast.Mult):
+                return left * right
+            if isinstance(node.op, ast.Div):
+                return left / right
+            if isinstance(node.op, ast.FloorDiv):
+                return left // right
+            if isinstance(node.op, ast.Pow) and abs(right) <= 64:
+                return left ** right
+        except (ZeroDivisionError, OverflowError):
+            return None
+    return None
+
+
+def _element_count(value):
+    if isinstance(value, tuple):
+        total = 1
+        for dim in value:
+            if not isinstance(dim, (int, float)):
+                return None
+            total *= dim
+        return total
+    return value
+
+
+def _argument(call, position, keyword):
+    for item in call.keywords:
+        if item.arg == keyword:
+            return item.value
+    if position < len(call.args) and not any(isinstance(arg, ast.Starred) for arg in call.args[:position + 1]):
+        return call.args[position]
+    return None
+
+
+class _Analyzer(ast.NodeVisitor):
+    def __init__(self):
+        self.findings = []
+        self.aliases = dict(SANDBOX_GLOBALS)  # 本地名字 -> 完整的模块或函数名
+        self.imports = []                     # (lineno, 顶层模块名)
+
+    def report(self, node, kind, message):
+        self.findings.append(Finding(getattr(node, "lineno", None), kind, message))
+
+    def qualified_name(self, node):
+        """把 np.random.rand 之类的调用对象还原为 numpy.random.rand，无法确定时返回 None"""
+        parts = []
+        while isinstance(node, ast.Attribute):
+            parts.append(node.attr)
+            node = node.value
+        if not isinstance(node, ast.Name):
+            return None
+        parts.append(self.aliases.get(node.id, node.id))
+        return ".".join(reversed(parts))
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.asname:
+                self.aliases[alias.asname] = alias.name
+            else:
+                top = alias.name.split(".")[0]
+                self.aliases[top] = top
+            self.imports.append((node, alias.name))
+        self.generic_visit(node)
+
+    def visit_ImportFrom(self, node):
+        if node.module and not node.level:
+            for alias in node.names:
+                if alias.name != "*":
+                    self.aliases[alias.asname or alias.name] = f"{node.module}.{alias.name}"
+            self.imports.append((node, node.module))
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        name = self.qualified_name(node.func)
+        if name in FORBIDDEN_CALLS:
+            self.report(node, "forbidden_call", FORBIDDEN_CALLS[name])
+        elif name is not None and name.startswith("subprocess."):
+            self.report(node, "forbidden_call", "不要调用外部程序")
+        self.check_allocation(node, name)
+        self.generic_visit(node)
+
+    def check_allocation(self, node, name):
+        count = None
+        if name in _COUNT_ARGUMENTS:
+            argument = _argument(node, *_COUNT_ARGUMENTS[name])
+            count = _const(argument) if argument is not None else None
+        elif name in _SHAPE_ARGUMENTS:
+            argument = _argument(node, *_SHAPE_ARGUMENTS[name])
+            count = _element_count(_const(argument)) if argument is not None else None
+        elif name in _VARARG_SHAPES:
+            count = _element_count(_const(ast.Tuple(elts=node.args))) if node.args else None
+        elif name == "numpy.arange" and node.args:
+            bounds = [_const(arg) for arg in node.args[:3]]
+            if all(isinstance(value, (int, float)) for value in bounds):
+                start, stop, step = (0, bounds[0], 1) if len(bounds) == 1 else (bounds + [1])[:3]
+                count = (stop - start) / step if step else None
+        if isinstance(count, (int, float)) and count > MAX_ARRAY_ELEMENTS:
+            short = name.replace("numpy.", "np.", 1)
+            self.report(node, "large_allocation",
+                        f"{short}() 会创建约 {count:.3g} 个元素的数组，超过 {MAX_ARRAY_ELEMENTS:.0e} 的上限，请减少采样点数")
+
+    def visit_While(self, node):
+        test = node.test.value if isinstance(node.test, ast.Constant) else None
+        if test and not _has_exit(node.body):
+            self.report(node, "unbounded_loop", "while 循环的条件恒为真且循环体中没有 break / return / raise，会一直运行下去")
+        self.generic_visit(node)
+
+    def visit_For(self, node):
+        iterable = node.iter
+        if isinstance(iterable, ast.Call):
+            name = self.qualified_name(iterable.func)
+            if name in ("itertools.count", "itertools.cycle") and not _has_exit(node.body):
+                self.report(node, "unbounded_loop", f"for 循环遍历 {name}() 且没有 break，会一直运行下去")
+            elif name == "range" and iterable.args:
+                bounds = [_const(arg) for arg in iterable.args[:3]]
+                if all(isinstance(value, (int, float)) for value in bounds):
+                    start, stop, step = (0, bounds[0], 1) if len(bounds) == 1 else (bounds + [1])[:3]
+                    if step and (stop - start) / step > MAX_LOOP_ITERATIONS:
+                        self.report(node, "unbounded_loop",
+                                    f"for 循环约 {(stop - start) / step:.3g} 次，Python 循环太慢，请改用 NumPy 向量化或减少次数")
+        self.generic_visit(node)
+
+
+def _has_exit(body):
+    """循环体中是否有能结束这个循环的语句（不算内层循环里的 break 和内层函数里的 return）"""
+    stack = list(body)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (ast.Break, ast.Return, ast.Raise)):
+            return True
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+            continue
+        if isinstance(node, (ast.For, ast.While, ast.AsyncFor)):
+            # 内层循环里的 break 只结束内层循环，但 return / raise 仍然算数
+            if any(isinstance(child, (ast.Return, ast.Raise)) for child in ast.walk(node)):
+                return True
+            continue
+        stack.extend(ast.iter_child_nodes(node))
+    return False
+
+
+def _bound_names(tree):
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, ast.alias):
+            names.add(node.asname or node.name.split(".")[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, (ast.MatchAs, ast.MatchStar)) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            names.add(node.rest)
+    return names
+
+
+def _check_names(tree, report):
+    """使用了却没有定义或导入的名字"""
+    if any(isinstance(node, ast.ImportFrom) and any(alias.name == "*" for alias in node.names)
+           for node in ast.walk(tree)):
+        return  # from xxx import * 引入的名字无法静态确定
+    known = _bound_names(tree) | set(dir(builtins)) | set(SANDBOX_GLOBALS)
+    seen = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in known \
+                and node.id not in seen:
+            seen.add(node.id)
+            hint = f"，需要 {IMPORT_HINTS[node.id]}" if node.id in IMPORT_HINTS else ""
+            report(node, "missing_import", f"使用了未定义的名字 {node.id}{hint}")
+
+
+def _find_spec(module):
+    try:
+        return importlib.util.find_spec(module)
+    except (ImportError, ValueError):
+        return True  # 无法判断时当作已安装，交给执行阶段
+
+
+def _check_imports(imports, report):
+    checked = set()
+    for node, module in imports:
+        top = module.split(".")[0]
+        if top in checked:
+            continue
+        checked.add(top)
+        if top in DISALLOWED_MODULES:
+            report(node, "disallowed_import", f"绘图代码中不允许导入 {top}")
+        elif _find_spec(top) is None:
+            report(node, "missing_import", f"执行环境中没有安装 {top}，请只使用 numpy、matplotlib 等已有的库")
+
+
+def analyze_code(code):
+    """
+    在执行前静态检查完整的代码，返回 Finding 列表（按行号排序），没有问题时返回空列表。
+    只依据代码本身判断，不执行任何代码。
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            tree = ast.parse(code, "<generated>")
+    except (SyntaxError, ValueError) as e:
+        lineno = getattr(e, "lineno", None)
+        return [Finding(lineno, "syntax", f"语法错误: {getattr(e, 'msg', e)}")]
+
+    analyzer = _Analyzer()
+    analyzer.visit(tree)
+    _check_imports(analyzer.imports, analyzer.report)
+    _check_names(tree, analyzer.report)
+    return sorted(analyzer.findings, key=lambda finding: finding.lineno or 0)
+
+
+def format_findings(findings):
+    """把静态检查结果整理成发给模型的文字，每个问题一行"""
+    return "\n".join(
+        f"第 {finding.lineno} 行: {finding.message}" if finding.lineno else finding.message
+        for finding in findings
+    )
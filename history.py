@@ -0,0 +1,129 @@
+"""
+对话历史压缩。
+
+每次重新生成都会把上一版完整代码和用户的补充说明追加到对话中，
+输入 token 随轮次大致按平方增长。超过 token 预算时，把对话压缩为：
+    1. 第一条用户消息（图片 + 原始指令提示词），保持不变，提示缓存依然命中；
+    2. 最新一版代码（assistant）；
+    3. 之前所有修改要求的简要摘要 + 最新的要求（user）。
+"""
+import base64
+import io
+
+from preprocess import estimate_image_tokens
+
+DEFAULT_TOKEN_BUDGET = 20000
+FEEDBACK_ITEM_CHARS = 200  # 摘要中每条历史要求保留的最大字符数
+# repair.repair_turns / refine_turns 生成的修复、改进请求的开头，压缩历史时据此识别这些轮次
+REPAIR_PROMPT_PREFIX = "你的代码出现错误，"
+REFINE_PROMPT_PREFIX = "代码可以正常运行，但生成的图像与原图的相似度只有"
+
+
+def _block_tokens(block):
+    """估算单个内容块的 token 数"""
+    if block.get("type") == "image":
+        source = block.get("source", {})
+        if source.get("type") == "base64":
+            from PIL import Image
+            image = Image.open(io.BytesIO(base64.standard_b64decode(source["data"])))
+            return estimate_image_tokens(*image.size)
+        return estimate_image_tokens(1568, 1568)
+    return estimate_text_tokens(block.get("text", ""))
+
+
+def estimate_text_tokens(text):
+    """粗略估算文本 token 数：ASCII 约 4 个字符 1 个 token，中文等约 1 个字符 1 个 token"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return int(ascii_chars / 4 + (len(text) - ascii_chars)) + 1
+
+
+def estimate_tokens(messages):
+    """在本地估算整个对话的输入 token 数，不调用 API"""
+    total = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            total += estimate_text_tokens(content)
+        else:
+            total += sum(_block_tokens(block) for block in content)
+        total += 4  # 每条消息的角色等固定开销
+    return total
+
+
+def message_text(message):
+    """取出消息中的全部文本"""
+    content = message["content"]
+    if isinstance(content, str):
+        return content
+    return "\n".join(block.get("text", "") for block in content if block.get("type") == "text")
+
+
+def first_image_bytes(messages):
+    """取出对话中第一张 base64 图片（即上传的原图）的字节，没有图片时返回 None"""
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            continue
+        for block in content:
+            source = block.get("source", {}) if block.get("type") == "image" else {}
+            if source.get("type") == "base64":
+                return base64.standard_b64decode(source["data"])
+    return None
+
+
+def _condense_feedback(text):
+    """把一条历史要求压缩成一行"""
+    if text.startswith(REPAIR_PROMPT_PREFIX):
+        # 自动修复的请求只保留错误信息的第一行
+        error = text.split("错误信息：", 1)[-1].strip().splitlines()
+        return f"修复执行错误: {error[0] if error else ''}"[:FEEDBACK_ITEM_CHARS]
+    if text.startswith(REFINE_PROMPT_PREFIX):
+        score = text[len(REFINE_PROMPT_PREFIX):].split("（", 1)[0].strip()
+        return f"提高与原图的相似度（当时得分 {score}）"
+    text = " ".join(text.split())
+    if len(text) > FEEDBACK_ITEM_CHARS:
+        text = text[:FEEDBACK_ITEM_CHARS] + "..."
+    return text
+
+
+def _build_compacted(first, latest_code, feedbacks, latest_request):
+    parts = []
+    if feedbacks:
+        lines = "\n".join(f"{i}. {item}" for i, item in enumerate(feedbacks, 1))
+        parts.append(f"此前已经按以下要求修改过代码（上面是最新版本的代码）：\n{lines}")
+    parts.append(latest_request)
+    return [
+        first,
+        {"role": "assistant", "content": [{"type": "text", "text": latest_code}]},
+        {"role": "user", "content": [{"type": "text", "text": "\n\n".join(parts)}]},
+    ]
+
+
+def compact_history(messages, token_budget=DEFAULT_TOKEN_BUDGET, count_tokens=estimate_tokens):
+    """
+    对话超过 token 预算时进行压缩，返回 (messages, tokens_before, tokens_after)。
+
+    只有以用户消息结尾、且至少有一轮 assistant 回复的对话才会被压缩；
+    压缩后仍然超出预算时，从最早的要求开始删除摘要条目。
+    """
+    tokens_before = count_tokens(messages)
+    if tokens_before <= token_budget or len(messages) <= 3 or messages[-1]["role"] != "user":
+        return messages, tokens_before, tokens_before
+
+    first = messages[0]
+    latest_code = next(message_text(m) for m in reversed(messages) if m["role"] == "assistant")
+    latest_request = message_text(messages[-1])
+    feedbacks = [
+        _condense_feedback(message_text(m))
+        for m in messages[1:-1] if m["role"] == "user"
+    ]
+    # 去掉重复的要求，保留顺序
+    feedbacks = list(dict.fromkeys(feedbacks))
+
+    compacted = _build_compacted(first, latest_code, feedbacks, latest_request)
+    tokens_after = count_tokens(compacted)
+    while tokens_after > token_budget and feedbacks:
+        feedbacks.pop(0)
+        compacted = _build_compacted(first, latest_code, feedbacks, latest_request)
+        tokens_after = count_tokens(compacted)
+    return compacted, tokens_before, tokens_after
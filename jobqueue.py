@@ -0,0 +1,230 @@
+"""
+基于 SQLite 的任务队列。
+
+Streamlit 页面只负责提交任务和轮询状态，生成代码、执行代码等耗时工作由 worker.py 启动的工作进程完成，
+吞吐量取决于工作进程数，而不是浏览器会话数；页面刷新后也可以凭任务 id 找回结果。
+
+任务状态: queued → running → done / failed，排队或运行中的任务可以被取消 (cancelled)。
+工作进程在运行任务期间定期更新心跳，心跳超时的任务（工作进程崩溃）会被重新放回队列。
+
+    queue = JobQueue("jobs.db")
+    job_id = queue.submit("generate", {"messages": messages})
+    job = queue.get(job_id)
+    if job.status == "done":
+        job.result, job.png
+
+环境变量:
+    JOB_QUEUE_DB  任务数据库路径，设置后界面改为提交任务到队列
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATUSES = (DONE, FAILED, CANCELLED)
+
+STALE_AFTER = 120.0  # 运行中的任务超过这么多秒没有心跳，视为工作进程已崩溃
+MAX_ATTEMPTS = 3     # 同一任务最多被领取的次数
+
+Job = namedtuple("Job", [
+    "id", "kind", "status", "payload", "result", "png", "error",
+    "created_at", "started_at", "finished_at", "worker", "attempts",
+])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    result TEXT,
+    png BLOB,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    heartbeat REAL,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+_COLUMNS = "id, kind, status, payload, result, png, error, created_at, started_at, finished_at, worker, attempts"
+
+
+def _to_job(row):
+    if row is None:
+        return None
+    values = list(row)
+    values[3] = json.loads(values[3])
+    values[4] = json.loads(values[4]) if values[4] is not None else None
+    values[5] = bytes(values[5]) if values[5] is not None else None
+    return Job(*values)
+
+
+class JobQueue:
+    """任务队列，可以在多个线程和多个进程中同时使用（每个线程一个连接）"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return _Transaction(conn)
+
+    def submit(self, kind, payload):
+        """提交任务，返回任务 id"""
+        job_id = uuid.uuid4().hex[:16]
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, kind, QUEUED, json.dumps(payload, ensure_ascii=False), time.time()),
+            )
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _to_job(row)
+
+    def position(self, job_id):
+        """排队中的任务前面还有几个任务，任务不在排队时返回 None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT status, created_at FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row[0] != QUEUED:
+                return None
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at < ?", (QUEUED, row[1])
+            ).fetchone()[0]
+
+    def claim(self, worker):
+        """领取最早的排队任务，没有任务时返回 None"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, started_at = ?, heartbeat = ?, worker = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (RUNNING, now, now, worker, row[0]),
+            )
+            row = conn.execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (row[0],)).fetchone()
+        return _to_job(row)
+
+    def heartbeat(self, job_id):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND status = ?", (time.time(), job_id, RUNNING))
+
+    def complete(self, job_id, result, png=None):
+        """保存结果；任务已被取消时丢弃结果并返回 False"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, png = ?, finished_at = ? WHERE id = ? AND status = ?",
+                (DONE, json.dumps(result, ensure_ascii=False), png, time.time(), job_id, RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, error):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status = ?",
+                (FAILED, error, time.time(), job_id, RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def cancel(self, job_id):
+        """取消排队中或运行中的任务（运行中的任务会跑完，但结果不会被保存）"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status IN (?, ?)",
+                (CANCELLED, time.time(), job_id, QUEUED, RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def requeue_stale(self, stale_after=STALE_AFTER, max_attempts=MAX_ATTEMPTS):
+        """把心跳超时的任务放回队列，领取次数过多的任务标记为失败，返回处理的任务数"""
+        deadline = time.time() - stale_after
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            failed = conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? "
+                "WHERE status = ? AND heartbeat < ? AND attempts >= ?",
+                (FAILED, "工作进程多次在运行任务时中断", time.time(), RUNNING, deadline, max_attempts),
+            ).rowcount
+            requeued = conn.execute(
+                "UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND heartbeat < ?",
+                (QUEUED, RUNNING, deadline),
+            ).rowcount
+        return failed + requeued
+
+    def purge(self, older_than):
+        """删除结束超过 older_than 秒的任务，返回删除的任务数"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"DELETE FROM jobs WHERE status IN ({','.join('?' * len(FINISHED_STATUSES))}) AND finished_at < ?",
+                (*FINISHED_STATUSES, time.time() - older_than),
+            )
+        return cursor.rowcount
+
+    def counts(self):
+        """各状态的任务数"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+
+class _Transaction:
+    """连接的上下文管理器：显式 BEGIN 的事务在退出时提交或回滚"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.conn.in_transaction:
+            if exc_type is None:
+                self.conn.execute("COMMIT")
+            else:
+                self.conn.execute("ROLLBACK")
+        return False
+
+
+_default_queue = None
+_default_lock = threading.Lock()
+
+
+def get_default_queue():
+    """设置了 JOB_QUEUE_DB 时返回进程内共享的 JobQueue，否则返回 None"""
+    global _default_queue
+    path = os.environ.get("JOB_QUEUE_DB")
+    if not path:
+        return None
+    with _default_lock:
+        if _default_queue is None:
+            _default_queue = JobQueue(path)
+    return _default_queue
@@ -0,0 +1,362 @@
+"""
+已生成图表的图库。
+
+每次用户确认满意后，把原图的特征和对应的绘图代码、generate_figure 文档加入图库；
+新上传的图片与图库中已有的图足够接近时，可以直接执行保存的代码，不必再调用 API。
+
+每张原图计算两种本地特征（不需要 API 调用）:
+    phash      64 位感知哈希（32×32 灰度图 DCT 低频部分与中位数比较），比较汉明距离
+    embedding  16×16 灰度缩略图和 4×4×4 颜色直方图拼接成的单位向量，比较余弦相似度
+查询时先用一次矩阵乘法求出与所有条目的余弦相似度，取前 k 个再检查感知哈希，几万个条目也只需几毫秒。
+
+    library = get_default_library()
+    match = library.find(image_bytes)
+    if match is not None:
+        match.code, match.doc
+
+数据保存在图库目录中:
+    entries.jsonl  每行一个条目（特征、代码、文档、来源），只追加
+    index.npz      特征矩阵和各条目在 entries.jsonl 中的偏移，是可以随时重建的缓存
+
+环境变量:
+    FIGURE_LIBRARY  图库目录，默认 .figure_library；设为 none 时不使用图库
+
+从已保存的结果（紧凑格式或旧的 JSON）建立图库:
+    python library.py build . batch_output
+    python library.py search image.png
+"""
+import argparse
+import base64
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+import numpy as np
+
+from artifacts import MANIFEST_SUFFIX, RUNS_PREFIX, ArtifactStore, is_store
+from history import first_image_bytes
+from similarity import color_histogram, load_image
+from storage import LocalStorage
+
+DEFAULT_LIBRARY_DIR = ".figure_library"
+HASH_SIZE = 8             # 感知哈希取 DCT 左上角 8×8，共 64 位
+HASH_IMAGE_SIZE = 32
+THUMB_SIZE = 16
+EMBED_HIST_BINS = 4
+THUMB_WEIGHT = 0.6        # 余弦相似度 = 0.6 × 缩略图相似度 + 0.4 × 颜色相似度
+MAX_DISTANCE = 10         # 感知哈希的汉明距离不超过此值才算相似
+MIN_SIMILARITY = 0.9      # 特征向量的余弦相似度不低于此值才算相似
+SEARCH_K = 10
+
+EMBEDDING_DIM = THUMB_SIZE * THUMB_SIZE + EMBED_HIST_BINS ** 3
+
+# similarity: 特征向量的余弦相似度；distance: 感知哈希的汉明距离
+Match = namedtuple("Match", ["id", "similarity", "distance", "source", "code", "doc"])
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT = _dct_matrix(HASH_IMAGE_SIZE)
+
+
+def _downsample(array, size):
+    """按块求均值缩小到 size×size（边长必须是 size 的整数倍）"""
+    factor = array.shape[0] // size
+    return array.reshape(size, factor, size, factor, *array.shape[2:]).mean(axis=(1, 3))
+
+
+def image_features(data):
+    """计算一张图片的 (感知哈希, 特征向量)"""
+    rgb = load_image(data, HASH_IMAGE_SIZE * 2)
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+    coefficients = _DCT @ _downsample(gray, HASH_IMAGE_SIZE) @ _DCT.T
+    low = coefficients[:HASH_SIZE, :HASH_SIZE].ravel()
+    bits = low > np.median(low[1:])  # 直流分量不参与中位数
+    phash = int(np.packbits(bits).view(">u8")[0])
+
+    thumb = _downsample(gray, THUMB_SIZE).ravel()
+    thumb = thumb - thumb.mean()
+    hist = color_histogram(rgb, EMBED_HIST_BINS)
+    hist = np.zeros(EMBED_HIST_BINS ** 3) if hist is None else np.sqrt(hist)
+    embedding = np.concatenate([
+        np.sqrt(THUMB_WEIGHT) * _unit(thumb),
+        np.sqrt(1 - THUMB_WEIGHT) * _unit(hist),
+    ]).astype(np.float32)
+    return phash, _unit(embedding)
+
+
+def _unit(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def hamming_distances(hashes, phash):
+    """一组 64 位哈希与 phash 的汉明距离"""
+    xor = np.bitwise_xor(hashes, np.uint64(phash))
+    return np.unpackbits(xor.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+class FigureLibrary:
+    """图库：特征矩阵常驻内存，代码和文档按偏移从 entries.jsonl 读取"""
+
+    def __init__(self, root=DEFAULT_LIBRARY_DIR):
+        self.root = root
+        self.entries_path = os.path.join(root, "entries.jsonl")
+        self.index_path = os.path.join(root, "index.npz")
+        self._lock = threading.Lock()
+        self._hashes = np.zeros(0, dtype=np.uint64)
+        self._embeddings = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        self._offsets = np.zeros(0, dtype=np.int64)
+        self._digests = set()
+        self._size = 0  # 已读入索引的 entries.jsonl 字节数
+        with self._lock:
+            self._load()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _load(self):
+        if os.path.exists(self.index_path):
+            try:
+                with np.load(self.index_path) as index:
+                    self._hashes = index["hashes"]
+                    self._embeddings = index["embeddings"].astype(np.float32)
+                    self._offsets = index["offsets"]
+                    self._digests = set(index["digests"].astype(str))
+                    self._size = int(index["size"])
+            except (OSError, KeyError, ValueError):
+                self._size = 0  # 索引损坏，从 entries.jsonl 重建
+        if self._refresh() or not os.path.exists(self.index_path):
+            self._save_index()
+
+    def _refresh(self):
+        """读入 entries.jsonl 中索引之后新增的条目（可能由其他进程写入），返回新增的条目数"""
+        if not os.path.exists(self.entries_path):
+            return 0
+        if os.path.getsize(self.entries_path) < self._size:
+            # 文件被替换过，全部重建
+            self._hashes, self._offsets = self._hashes[:0], self._offsets[:0]
+            self._embeddings = self._embeddings[:0]
+            self._digests, self._size = set(), 0
+        hashes, embeddings, offsets = [], [], []
+        with open(self.entries_path, "rb") as f:
+            f.seek(self._size)
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break  # 文件末尾或其他进程写了一半的行
+                self._size = f.tell()
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                hashes.append(int(entry["phash"], 16))
+                embeddings.append(np.frombuffer(base64.b64decode(entry["embedding"]), dtype=np.float16))
+                offsets.append(offset)
+                self._digests.add(entry["sha256"])
+        if offsets:
+            self._hashes = np.concatenate([self._hashes, np.array(hashes, dtype=np.uint64)])
+            self._embeddings = np.vstack([self._embeddings, np.array(embeddings, dtype=np.float32)])
+            self._offsets = np.concatenate([self._offsets, np.array(offsets, dtype=np.int64)])
+        return len(offsets)
+
+    def _save_index(self):
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp_", suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    hashes=self._hashes,
+                    embeddings=self._embeddings.astype(np.float16),
+                    offsets=self._offsets,
+                    digests=np.array(sorted(self._digests), dtype="S64"),
+                    size=np.int64(self._size),
+                )
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def contains(self, data):
+        """图库中是否已有内容完全相同的原图"""
+        return hashlib.sha256(data).hexdigest() in self._digests
+
+    def _entry(self, data, code, doc, source):
+        """计算原图的特征，返回 (sha256, 条目 id, entries.jsonl 中的一行)"""
+        digest = hashlib.sha256(data).hexdigest()
+        phash, embedding = image_features(data)
+        entry = {
+            "id": uuid.uuid4().hex[:12],
+            "created": round(time.time(), 3),
+            "source": source,
+            "sha256": digest,
+            "phash": f"{phash:016x}",
+            "embedding": base64.b64encode(embedding.astype(np.float16).tobytes()).decode("ascii"),
+            "code": code,
+            "doc": doc,
+        }
+        return digest, entry["id"], (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def _append(self, digest, line):
+        """追加一行条目（调用方持有锁），内容相同的原图已存在时返回 False；不写 index.npz"""
+        self._refresh()
+        if digest in self._digests:
+            return False
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.entries_path, "ab") as f:
+            f.write(line)
+        self._refresh()
+        return True
+
+    def add(self, data, code, doc=None, source=None):
+        """加入一张原图及其代码，内容相同的原图已存在时跳过并返回 None，否则返回条目 id"""
+        digest, entry_id, line = self._entry(data, code, doc, source)
+        with self._lock:
+            if not self._append(digest, line):
+                return None
+            self._save_index()
+        return entry_id
+
+    def add_many(self, items):
+        """
+        逐个加入 (原图字节, code, doc, source)，返回各自的条目 id（已存在时为 None）。
+        index.npz 只在最后写一次，大量加入时不必每个条目都重写整个特征矩阵。
+        """
+        ids = []
+        for data, code, doc, source in items:
+            digest, entry_id, line = self._entry(data, code, doc, source)
+            with self._lock:
+                ids.append(entry_id if self._append(digest, line) else None)
+        if any(ids):
+            with self._lock:
+                self._save_index()
+        return ids
+
+    def _read_entry(self, offset):
+        with open(self.entries_path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def search(self, data, k=SEARCH_K):
+        """返回与图片最接近的 k 个条目，按特征向量相似度从高到低排列"""
+        phash, embedding = image_features(data)
+        with self._lock:
+            self._refresh()
+            if len(self) == 0:
+                return []
+            similarities = self._embeddings @ embedding
+            k = min(k, len(similarities))
+            top = np.argpartition(-similarities, k - 1)[:k]
+            top = top[np.argsort(-similarities[top], kind="stable")]
+            distances = hamming_distances(self._hashes[top], phash)
+            matches = []
+            for i, distance in zip(top, distances):
+                entry = self._read_entry(int(self._offsets[i]))
+                matches.append(Match(entry["id"], float(similarities[i]), int(distance),
+                                     entry.get("source"), entry["code"], entry.get("doc")))
+        return matches
+
+    def find(self, data, max_distance=MAX_DISTANCE, min_similarity=MIN_SIMILARITY):
+        """返回足够接近的最佳条目，没有时返回 None"""
+        for match in self.search(data):
+            if match.similarity < min_similarity:
+                break
+            if match.distance <= max_distance:
+                return match
+        return None
+
+
+def iter_saved_results(paths):
+    """遍历目录中保存的结果（artifacts.py 的紧凑格式或旧的 JSON 文件），产生 (来源, 原图字节, code, doc)"""
+    for path in paths:
+        if os.path.isdir(path) and is_store(path):
+            backend = LocalStorage(path)
+            for run in ArtifactStore(backend).runs():
+                data = run.image_bytes()
+                if data is not None and run.code:
+                    yield backend.location(f"{RUNS_PREFIX}/{run.name}{MANIFEST_SUFFIX}"), data, run.code, run.doc
+        files = sorted(glob.glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path]
+        for file in files:
+            try:
+                with open(file, "r", encoding="utf-8") as f:
+                    result = json.load(f)
+            except (OSError, UnicodeDecodeError, json.JSONDecodeError):
+                continue
+            if not isinstance(result, dict) or not result.get("code"):
+                continue
+            data = first_image_bytes(result.get("conversation_history") or [])
+            if data is not None:
+                yield file, data, result["code"], result.get("doc")
+
+
+def build(library, paths):
+    """把已保存的结果加入图库，返回 (加入数, 跳过数)"""
+    ids = library.add_many((data, code, doc, os.path.abspath(file))
+                           for file, data, code, doc in iter_saved_results(paths))
+    added = sum(1 for entry_id in ids if entry_id is not None)
+    return added, len(ids) - added
+
+
+_default_library = None
+_default_lock = threading.Lock()
+_default_created = False
+
+
+def get_default_library():
+    """返回进程内共享的图库（按环境变量配置），不使用图库时返回 None"""
+    global _default_library, _default_created
+    with _default_lock:
+        if not _default_created:
+            root = os.environ.get("FIGURE_LIBRARY", DEFAULT_LIBRARY_DIR)
+            if root.strip().lower() != "none":
+                _default_library = FigureLibrary(root)
+            _default_created = True
+    return _default_library
+
+
+def main():
+    parser = argparse.ArgumentParser(description="已生成图表的图库")
+    parser.add_argument("--library", default=os.environ.get("FIGURE_LIBRARY", DEFAULT_LIBRARY_DIR),
+                        help="图库目录")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="把已保存的结果加入图库")
+    build_parser.add_argument("paths", nargs="+", help="保存结果的目录或旧格式的 JSON 文件")
+    search_parser = subparsers.add_parser("search", help="查找与图片最接近的条目")
+    search_parser.add_argument("image", help="图片路径")
+    search_parser.add_argument("-k", type=int, default=5, help="显示的条目数")
+    args = parser.parse_args()
+
+    library = FigureLibrary(args.library)
+    if args.command == "build":
+        added, skipped = build(library, args.paths)
+        print(f"加入 {added} 个条目，跳过 {skipped} 个已存在的原图，图库共 {len(library)} 个条目")
+    else:
+        with open(args.image, "rb") as f:
+            data = f.read()
+        matches = library.search(data, args.k)
+        if not matches:
+            print("图库为空")
+        for match in matches:
+            close = match.similarity >= MIN_SIMILARITY and match.distance <= MAX_DISTANCE
+            print(f"{match.id}  相似度 {match.similarity:.3f}  汉明距离 {match.distance:>2}"
+                  f"{'  ✓' if close else ''}  {match.source or ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+流水线各环节的耗时与费用统计。
+
+记录每个请求在各环节花费的时间（读取上传文件、图片编码、API 首个 token 延迟和总耗时、代码执行、savefig），
+以及每次 API 调用的 token 数和按 pricing.py 价格表计算的费用。数据有两种出口：
+    1. 追加写入的 JSONL 日志，每行一个事件，进程退出后仍然保留；
+    2. Prometheus 文本格式，可以在设置 METRICS_PORT 后通过 http://host:port/metrics 抓取，
+       也可以用 `python metrics.py metrics.jsonl` 从日志重新生成。
+
+    with metrics.request_scope():          # 同一个请求的事件带有相同的 request_id
+        with metrics.timed("encode"):
+            ...
+        metrics.record_usage(response.usage, model)
+
+环境变量:
+    METRICS_LOG      JSONL 日志路径，默认 metrics.jsonl
+    METRICS_DISABLE  设为 1 时不写日志（内存中的统计照常进行）
+    METRICS_PORT     设置后在该端口提供 Prometheus 格式的 /metrics
+"""
+import argparse
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pricing import estimate_cost
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_KINDS = ("input_tokens", "output_tokens", "cache_write_tokens", "cache_read_tokens")
+
+_request_id = contextvars.ContextVar("metrics_request_id", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+class MetricsRegistry:
+    """线程安全的计数器、仪表和直方图，按 Prometheus 文本格式输出"""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}    # name -> {labels: value}
+        self._gauges = {}      # name -> {labels: value}
+        self._histograms = {}  # name -> {labels: [bucket_counts, sum, count]}
+        self._help = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1.0, help_text="", **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._help.setdefault(name, help_text)
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set_gauge(self, name, value, help_text="", **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._help.setdefault(name, help_text)
+            self._gauges.setdefault(name, {})[key] = float(value)
+
+    def add_collector(self, callback):
+        """注册在每次输出前调用的函数，用来更新当前值类的仪表（如内存占用）"""
+        with self._lock:
+            if callback not in self._collectors:
+                self._collectors.append(callback)
+
+    def observe(self, name, value, help_text="", **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._help.setdefault(name, help_text)
+            series = self._histograms.setdefault(name, {})
+            state = series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        """返回 Prometheus 文本格式"""
+        for callback in list(self._collectors):
+            callback(self)
+        lines = []
+        with self._lock:
+            for kind, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+                for name, series in sorted(metrics.items()):
+                    lines.append(f"# HELP {name} {self._help.get(name, '')}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for key, value in sorted(series.items()):
+                        lines.append(f"{name}{_format_labels(key)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# HELP {name} {self._help.get(name, '')}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, (counts, total, count) in sorted(series.items()):
+                    for bound, bucket_count in zip(self.buckets, counts):
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', f'{bound:g}'),))} {bucket_count}")
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {total:g}")
+                    lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+_registry = MetricsRegistry()
+_log_lock = threading.Lock()
+_server = None
+_server_lock = threading.Lock()
+
+
+def get_registry():
+    return _registry
+
+
+def log_path():
+    return os.environ.get("METRICS_LOG", "metrics.jsonl")
+
+
+def log_enabled():
+    return os.environ.get("METRICS_DISABLE", "0") != "1"
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+@contextlib.contextmanager
+def request_scope(request_id=None):
+    """在此范围内记录的事件都带有同一个 request_id"""
+    request_id = request_id or uuid.uuid4().hex[:12]
+    token = _request_id.set(request_id)
+    try:
+        yield request_id
+    finally:
+        _request_id.reset(token)
+
+
+def log_event(event, **fields):
+    """向 JSONL 日志追加一行事件"""
+    if not log_enabled():
+        return
+    record = {"ts": round(time.time(), 3), "event": event, "request_id": current_request_id()}
+    record.update(fields)
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _log_lock:
+        with open(log_path(), "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def _apply_stage(registry, stage, seconds, ok):
+    registry.observe("figure_stage_seconds", seconds, "各环节耗时（秒）", stage=stage)
+    registry.inc("figure_stage_total", 1, "各环节执行次数", stage=stage, status="ok" if ok else "error")
+
+
+def _apply_usage(registry, model, cost):
+    for kind in TOKEN_KINDS:
+        if cost[kind]:
+            registry.inc("figure_tokens_total", cost[kind], "API 使用的 token 数", model=model, kind=kind)
+    registry.inc("figure_cost_usd_total", cost["cost"], "按价格表估算的 API 费用（美元）", model=model)
+    registry.inc("figure_cost_saved_usd_total", cost["saved"], "提示缓存节省的费用（美元）", model=model)
+
+
+def record_stage(stage, seconds, ok=True, **fields):
+    """记录某个环节的耗时，fields 只写入日志"""
+    _apply_stage(_registry, stage, seconds, ok)
+    log_event("stage", stage=stage, seconds=round(seconds, 6), ok=ok, **fields)
+
+
+@contextlib.contextmanager
+def timed(stage, **fields):
+    """统计代码块的耗时，抛出异常时记为失败"""
+    start = time.perf_counter()
+    ok = True
+    try:
+        yield
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - start, ok, **fields)
+
+
+def record_usage(usage, model, **fields):
+    """记录一次 API 调用的 token 数和费用，返回 pricing.estimate_cost 的结果"""
+    cost = estimate_cost(usage, model)
+    _apply_usage(_registry, model, cost)
+    log_event("usage", model=model, **{key: cost[key] for key in TOKEN_KINDS},
+              cost=round(cost["cost"], 6), saved=round(cost["saved"], 6), **fields)
+    return cost
+
+
+def render_prometheus():
+    return _registry.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("content-type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """在后台线程中提供 /metrics，重复调用只会启动一次"""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+    return _server
+
+
+def serve_from_env():
+    """设置了 METRICS_PORT 时启动 /metrics 服务"""
+    port = os.environ.get("METRICS_PORT")
+    if port:
+        start_http_server(int(port))
+
+
+def load_log(path):
+    """从 JSONL 日志重建统计，返回 (registry, events)"""
+    registry = MetricsRegistry()
+    events = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 进程被杀时可能留下不完整的最后一行
+            events.append(event)
+            if event.get("event") == "stage":
+                _apply_stage(registry, event["stage"], event["seconds"], event.get("ok", True))
+            elif event.get("event") == "usage":
+                cost = dict({kind: event.get(kind, 0) for kind in TOKEN_KINDS},
+                            cost=event.get("cost", 0.0), saved=event.get("saved", 0.0))
+                _apply_usage(registry, event["model"], cost)
+    return registry, events
+
+
+def percentile(values, q):
+    """线性插值的百分位数，没有数据时返回 None（routing.py、replay.py 和压测脚本共用）"""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def summarize(events):
+    """按环节汇总耗时分位数，按模型汇总费用"""
+    stages = {}
+    costs = {}
+    for event in events:
+        if event.get("event") == "stage":
+            stages.setdefault(event["stage"], []).append(event["seconds"])
+        elif event.get("event") == "usage":
+            entry = costs.setdefault(event["model"], {"calls": 0, "cost": 0.0, "saved": 0.0})
+            entry["calls"] += 1
+            entry["cost"] += event.get("cost", 0.0)
+            entry["saved"] += event.get("saved", 0.0)
+    lines = [f"{'环节':<12}{'次数':>6}{'总耗时':>10}{'p50':>9}{'p95':>9}{'p99':>9}"]
+    for stage, values in sorted(stages.items(), key=lambda item: -sum(item[1])):
+        lines.append(f"{stage:<12}{len(values):>6}{sum(values):>10.2f}"
+                     + "".join(f"{percentile(values, q):>9.3f}" for q in (50, 95, 99)))
+    for model, entry in sorted(costs.items()):
+        lines.append(f"{model}: {entry['calls']} 次调用，费用 ${entry['cost']:.4f}，提示缓存节省 ${entry['saved']:.4f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="从 JSONL 日志生成 Prometheus 指标或汇总表")
+    parser.add_argument("log", nargs="?", default=log_path(), help="JSONL 日志路径")
+    parser.add_argument("--summary", action="store_true", help="输出各环节分位数和费用汇总，而不是 Prometheus 文本")
+    args = parser.parse_args()
+
+    registry, events = load_log(args.log)
+    output = summarize(events) + "\n" if args.summary else registry.render()
+    print(output, end="")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""
+多子图拆分复现。
+
+论文中的组合图（a/b/c/d 多个子图）整张交给模型时，一次回复要写完所有子图的代码，经常被 max_tokens 截断或出错。
+这里先在本地检测子图的边界：把图片中与背景色不同的像素按行、按列投影，连续的空白行（列）就是子图之间的间隔，
+按间隔切分出子图后分别裁剪。每个子图作为独立的请求并发复现（各自带执行-修复循环），
+模型只需写一个在给定 ax 上绘图的 draw_panel(ax) 函数；最后按检测到的网格生成 gridspec 布局，把各子图的函数拼成一段完整的代码。
+总耗时约等于最慢的一个子图，而不是一次很长的串行生成。
+
+    layout = detect_panels(image_bytes)          # PanelLayout，len(layout.panels) < 2 时不需要拆分
+    outcome = await reconstruct_panels(image_bytes, pool, layout)
+    outcome.code, outcome.result.png
+
+命令行（只检测，不调用 API）:
+    python panels.py figure.png [--crops 输出目录]
+"""
+import argparse
+import asyncio
+import base64
+import io
+import math
+import os
+import re
+import textwrap
+from collections import namedtuple
+
+import numpy as np
+
+from claude_client import DEFAULT_MAX_TOKENS
+from code_check import extract_code
+from preprocess import DEFAULT_MAX_LONG_EDGE, preprocess_image
+from prompts import prompt_panel
+from repair import generate_with_repair
+
+BACKGROUND_TOLERANCE = 24   # 与背景色的最大通道差不超过此值的像素视为空白
+GAP_FRACTION = 0.008        # 空白间隔至少占图片边长的比例（且不少于 MIN_GAP_PIXELS）
+MIN_GAP_PIXELS = 8          # 比坐标轴与刻度文字之间的空隙宽
+NOISE_FRACTION = 0.002      # 一行（列）中内容像素的比例不超过此值时仍视为空白（抗锯齿、噪点）
+INTRUSION_FRACTION = 0.06   # 内容比例都不超过此值、宽度不超过 INTRUSION_GAPS 个最小间隔的片段可能是伸进间隔的文字
+INTRUSION_GAPS = 3
+MIN_PANEL_FRACTION = 0.12   # 短于边长这一比例的片段（子图编号、总标题）并入相邻的片段
+MAX_PANELS = 12
+PANEL_PADDING = 4
+FIGURE_DPI = 100
+MAX_FIGURE_INCHES = 16.0
+
+# index: 从 1 开始的编号；box: 在原图中的像素范围 (left, top, right, bottom)；
+# rows / cols: 在 gridspec 中占据的行、列范围（左闭右开）
+Panel = namedtuple("Panel", ["index", "box", "rows", "cols"])
+
+# width / height: 原图像素尺寸；nrows / ncols: gridspec 的行列数；height_ratios / width_ratios: 行高、列宽比例
+PanelLayout = namedtuple("PanelLayout", ["width", "height", "nrows", "ncols", "panels", "height_ratios", "width_ratios"])
+
+# ok: 所有子图都复现成功；code: 拼好的完整代码；result: 完整代码的 ExecResult；
+# outcomes: 各子图的 repair.RepairResult（请求出错时为异常）；attempts: 执行过的候选总数
+PanelOutcome = namedtuple("PanelOutcome", ["ok", "code", "result", "layout", "outcomes", "attempts"])
+
+
+def _load(data):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    return image.convert("RGB")
+
+
+def content_mask(pixels, tolerance=BACKGROUND_TOLERANCE):
+    """与背景色（四条边上像素的中位数）不同的像素"""
+    border = np.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]])
+    background = np.median(border, axis=0)
+    return np.abs(pixels.astype(np.int16) - background.astype(np.int16)).max(axis=2) > tolerance
+
+
+def _segments(profile, length):
+    """
+    按投影切分：profile 为每行（列）内容像素的比例，返回内容片段的列表 [(start, end, core_start, core_end)]。
+    足够宽的空白才算间隔；过短的片段（子图编号、总标题等）并入间隔较小的一侧，
+    core 为其中原本最长的部分，按另一个方向切分时只看这部分，横跨多个子图的总标题不会把间隔填上。
+    """
+    min_gap = max(MIN_GAP_PIXELS, int(length * GAP_FRACTION))
+    filled = profile > NOISE_FRACTION
+    # 相邻位置状态变化的地方即片段的边界
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], filled.astype(np.int8), [0]]))).tolist()
+    runs = list(zip(edges[::2], edges[1::2]))
+    if not runs:
+        return []
+
+    # 伸进间隔里的刻度文字、负号等窄而稀疏的片段不算作内容：与两侧的空白合起来足够宽时仍是间隔，
+    # 在其中最宽的一段空白处切开，这些片段按位置归入两侧的子图
+    def intrusion(run):
+        return run[1] - run[0] <= INTRUSION_GAPS * min_gap and profile[run[0]:run[1]].max() <= INTRUSION_FRACTION
+
+    segments = [list(runs[0])]
+    pending = []
+    for k, run in enumerate(runs[1:], 1):
+        if k < len(runs) - 1 and intrusion(run):
+            pending.append(run)
+            continue
+        bounds = [segments[-1][1], *[edge for inner in pending for edge in inner], run[0]]
+        blanks = [bounds[i + 1] - bounds[i] for i in range(0, len(bounds), 2)]
+        if run[0] - segments[-1][1] >= min_gap and sum(blanks) >= min_gap / 2:
+            cut = int(np.argmax(blanks))
+            if cut:
+                segments[-1][1] = pending[cut - 1][1]
+            segments.append([pending[cut][0] if cut < len(pending) else run[0], run[1]])
+        else:
+            segments[-1][1] = run[1]
+        pending = []
+    segments = [[start, end, start, end] for start, end in segments]
+
+    min_size = length * MIN_PANEL_FRACTION
+    while len(segments) > 1:
+        sizes = [end - start for start, end, _, _ in segments]
+        i = int(np.argmin(sizes))
+        if sizes[i] >= min_size:
+            break
+        gap_before = segments[i][0] - segments[i - 1][1] if i > 0 else math.inf
+        gap_after = segments[i + 1][0] - segments[i][1] if i + 1 < len(segments) else math.inf
+        j = i - 1 if gap_before <= gap_after else i + 1
+        low, high = min(i, j), max(i, j)
+        segments[low:high + 1] = [[segments[low][0], segments[high][1], *segments[j][2:]]]
+    return [tuple(segment) for segment in segments]
+
+
+def _split(mask, rows_first):
+    """
+    先按行（rows_first 为 False 时先按列）切分成条带，再在每个条带内按另一个方向切分。
+    返回条带的列表，每个条带是 [((top, bottom), (left, right)), ...]。
+    """
+    if not rows_first:
+        return [[(cols, rows) for rows, cols in band] for band in _split(mask.T, True)]
+    height, width = mask.shape
+    bands = []
+    for top, bottom, core_top, core_bottom in _segments(mask.mean(axis=1), height):
+        core = mask[core_top:core_bottom]
+        bands.append([((top, bottom), (left, right)) for left, right, _, _ in _segments(core.mean(axis=0), width)])
+    return bands
+
+
+def _layout(bands, width, height, rows_first):
+    """把切分结果转换为 gridspec：条带数为行（列）数，各条带的子图数取最小公倍数作为列（行）数"""
+    counts = [len(band) for band in bands]
+    span = math.lcm(*counts)
+    uniform = len(set(counts)) == 1
+    panels = []
+    for b, band in enumerate(bands):
+        step = span // len(band)
+        for k, (rows, cols) in enumerate(band):
+            box = (max(cols[0] - PANEL_PADDING, 0), max(rows[0] - PANEL_PADDING, 0),
+                   min(cols[1] + PANEL_PADDING, width), min(rows[1] + PANEL_PADDING, height))
+            grid = ((b, b + 1), (k * step, (k + 1) * step))
+            if not rows_first:
+                grid = grid[::-1]
+            panels.append(Panel(len(panels) + 1, box, *grid))
+
+    def size(extent):
+        return float(extent[1] - extent[0])
+
+    # 条带方向按实测尺寸设置比例；各条带的子图数相同时，另一个方向也按同一位置子图的平均尺寸设置，否则等分
+    along = 0 if rows_first else 1
+    band_sizes = [float(np.mean([size(pair[along]) for pair in band])) for band in bands]
+    if uniform:
+        cross_sizes = [float(np.mean([size(band[k][1 - along]) for band in bands])) for k in range(span)]
+    else:
+        cross_sizes = [1.0] * span
+    if rows_first:
+        return PanelLayout(width, height, len(bands), span, panels, band_sizes, cross_sizes)
+    return PanelLayout(width, height, span, len(bands), panels, cross_sizes, band_sizes)
+
+
+def detect_panels(data, tolerance=BACKGROUND_TOLERANCE):
+    """
+    检测组合图中的子图，返回 PanelLayout。
+    分别尝试先按行和先按列切分，取切出子图较多的一种；没有可切分的间隔时只有一个子图（即整张图）。
+    """
+    image = _load(data)
+    width, height = image.size
+    mask = content_mask(np.asarray(image), tolerance)
+    best = None
+    for rows_first in (True, False):
+        bands = [band for band in _split(mask, rows_first) if band]
+        if not bands:
+            continue
+        layout = _layout(bands, width, height, rows_first)
+        if best is None or len(layout.panels) > len(best.panels):
+            best = layout
+    if best is None or len(best.panels) > MAX_PANELS:
+        return PanelLayout(width, height, 1, 1, [Panel(1, (0, 0, width, height), (0, 1), (0, 1))], [1.0], [1.0])
+    return best
+
+
+def crop_panels(data, layout):
+    """按 layout 裁剪出各子图，返回 PNG 字节的列表"""
+    image = _load(data)
+    crops = []
+    for panel in layout.panels:
+        buffer = io.BytesIO()
+        image.crop(panel.box).save(buffer, format="PNG")
+        crops.append(buffer.getvalue())
+    return crops
+
+
+def figure_size(width, height):
+    """按原图的像素尺寸（以 FIGURE_DPI 换算）得到画布尺寸（英寸），最长边不超过 MAX_FIGURE_INCHES"""
+    scale = min(1.0, MAX_FIGURE_INCHES * FIGURE_DPI / max(width, height))
+    return (round(width * scale / FIGURE_DPI, 2), round(height * scale / FIGURE_DPI, 2))
+
+
+def panel_label(panel):
+    return f"({chr(ord('a') + panel.index - 1)})" if panel.index <= 26 else f"({panel.index})"
+
+
+def panel_messages(crop, panel, layout, max_long_edge=DEFAULT_MAX_LONG_EDGE):
+    """一个子图的复现请求：子图图片 + prompts.prompt_panel + 它在组合图中的位置"""
+    prepared = preprocess_image(crop, max_long_edge=max_long_edge)
+    position = (f"这是组合图中的第 {panel.index} 个子图（共 {len(layout.panels)} 个），"
+                f"位于 {layout.nrows} 行 {layout.ncols} 列网格中的第 {panel.rows[0] + 1} 行、第 {panel.cols[0] + 1} 列。")
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": prepared.media_type,
+                        "data": base64.standard_b64encode(prepared.data).decode("utf-8"),
+                    },
+                },
+                {"type": "text", "text": prompt_panel},
+                {"type": "text", "text": position},
+            ],
+        }
+    ]
+
+
+def panel_to_code(reply):
+    """
+    把子图的回复转换为可以单独执行的代码（在一个新的 ax 上调用 draw_panel），返回 (code, error)。
+    用于执行-修复循环中逐个检查子图，见 repair.reply_to_code。
+    """
+    code = extract_code(reply)
+    if not re.search(r"^def draw_panel\(", code, re.M):
+        return None, "回复中没有顶层的 draw_panel(ax) 函数，请只定义这个函数并在传入的 ax 上绘图"
+    return code + "\n\nfig, ax = plt.subplots()\ndraw_panel(ax)\n", None
+
+
+def _panel_function(panel, code):
+    """把子图的代码整体包进 draw_panel_<编号>(ax)，各子图的导入和辅助变量互不影响"""
+    name = f"draw_panel_{panel.index}"
+    if code is None:
+        body = (f"ax.text(0.5, 0.5, {panel_label(panel) + ' 复现失败'!r}, ha='center', va='center', "
+                "transform=ax.transAxes)\nax.set_axis_off()\n")
+    else:
+        body = extract_code(code).strip("\n") + "\n\ndraw_panel(ax)\n"
+    return f"def {name}(ax):\n{textwrap.indent(body, '    ')}"
+
+
+def compose_code(layout, codes):
+    """
+    按 layout 生成组合图的完整代码：每个子图一个函数，再用 gridspec 把它们放回原来的位置。
+    codes 与 layout.panels 一一对应，为 None 的子图画一个“复现失败”的占位。
+    """
+    width, height = figure_size(layout.width, layout.height)
+    lines = ["import matplotlib.pyplot as plt", ""]
+    for panel, code in zip(layout.panels, codes):
+        lines.extend([_panel_function(panel, code), ""])
+    ratios = lambda values: "[" + ", ".join(f"{value / max(values):.3f}" for value in values) + "]"
+    lines.extend([
+        f"fig = plt.figure(figsize=({width}, {height}), layout='constrained')",
+        f"grid = fig.add_gridspec({layout.nrows}, {layout.ncols}, "
+        f"height_ratios={ratios(layout.height_ratios)}, width_ratios={ratios(layout.width_ratios)})",
+    ])
+    for panel in layout.panels:
+        rows = f"{panel.rows[0]}:{panel.rows[1]}" if panel.rows[1] - panel.rows[0] > 1 else str(panel.rows[0])
+        cols = f"{panel.cols[0]}:{panel.cols[1]}" if panel.cols[1] - panel.cols[0] > 1 else str(panel.cols[0])
+        lines.append(f"draw_panel_{panel.index}(fig.add_subplot(grid[{rows}, {cols}]))")
+    return "\n".join(lines) + "\n"
+
+
+async def reconstruct_panels(data, pool, layout=None, max_retries=3, max_tokens=DEFAULT_MAX_TOKENS,
+                             max_long_edge=DEFAULT_MAX_LONG_EDGE, exec_options=None, router=None):
+    """
+    并发复现各子图（每个子图都有自己的执行-修复循环），再拼成完整的代码并执行。
+    有子图失败时用占位代替，组合图仍然生成，但 ok 为 False。
+    """
+    layout = layout or detect_panels(data)
+    exec_options = exec_options or {}
+    crops = crop_panels(data, layout)
+
+    async def run_panel(panel, crop):
+        left, top, right, bottom = panel.box
+        # 单独检查子图时按它在原图中的尺寸渲染
+        options = dict(exec_options, figsize=figure_size(right - left, bottom - top))
+        return await generate_with_repair(
+            panel_messages(crop, panel, layout, max_long_edge), pool, max_retries=max_retries,
+            max_tokens=max_tokens, exec_options=options, router=router, output_format="panel",
+        )
+
+    outcomes = await asyncio.gather(*(run_panel(panel, crop) for panel, crop in zip(layout.panels, crops)),
+                                    return_exceptions=True)
+    codes = [extract_code(outcome.reply) if not isinstance(outcome, BaseException) and outcome.ok else None
+             for outcome in outcomes]
+    code = compose_code(layout, codes)
+    result = await pool.arun(code, **exec_options)
+    attempts = sum(outcome.attempts for outcome in outcomes if not isinstance(outcome, BaseException))
+    return PanelOutcome(result.ok and all(codes), code, result, layout, outcomes, attempts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检测组合图中的子图（只在本地计算，不调用 API）")
+    parser.add_argument("image")
+    parser.add_argument("--crops", help="把裁剪出的子图保存到此目录")
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as f:
+        data = f.read()
+    layout = detect_panels(data)
+    print(f"{layout.width}×{layout.height}，{len(layout.panels)} 个子图，网格 {layout.nrows}×{layout.ncols}")
+    for panel in layout.panels:
+        print(f"  {panel_label(panel)} 像素范围 {panel.box}，网格行 {panel.rows[0]}:{panel.rows[1]}，"
+              f"列 {panel.cols[0]}:{panel.cols[1]}")
+    if args.crops:
+        os.makedirs(args.crops, exist_ok=True)
+        for panel, crop in zip(layout.panels, crop_panels(data, layout)):
+            path = os.path.join(args.crops, f"panel_{panel.index}.png")
+            with open(path, "wb") as f:
+                f.write(crop)
+        print(f"子图已保存到 {args.crops}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+图片上传前的预处理：限制最长边、可选裁掉纯色边框、在 PNG / JPEG / WebP 中选择体积最小的编码。
+
+图片在对话历史中每一轮都会重新发送，缩小图片可以同时减少上传体积和输入 token。
+图片 token 按 Anthropic 文档的估算方式计算：约为 宽 × 高 / 750，
+且 API 会先把最长边超过 1568 像素（或总像素过多）的图片缩小。
+"""
+import io
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_MAX_LONG_EDGE = 1568
+API_MAX_LONG_EDGE = 1568
+API_MAX_PIXELS = 1568 * 1568 * 0.47  # 约 115 万像素，超过后 API 会进一步缩小
+JPEG_QUALITY = 90
+WEBP_QUALITY = 90
+
+MEDIA_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "GIF": "image/gif"}
+
+PreprocessResult = namedtuple("PreprocessResult", ["data", "media_type", "width", "height", "report"])
+
+
+def estimate_image_tokens(width, height):
+    """估算图片占用的输入 token 数（先按 API 的规则缩小，再按 宽×高/750 计算）"""
+    scale = min(1.0, API_MAX_LONG_EDGE / max(width, height), (API_MAX_PIXELS / (width * height)) ** 0.5)
+    return int(round(width * scale) * round(height * scale) / 750)
+
+
+def crop_uniform_border(image, tolerance=8, padding=4):
+    """裁掉与左上角颜色相近的外围边框（扫描件常见的白边）"""
+    pixels = np.asarray(image.convert("RGB"), dtype=np.int16)
+    background = pixels[0, 0]
+    # 每个像素与背景色的最大通道差
+    content = np.abs(pixels - background).max(axis=2) > tolerance
+    rows = np.flatnonzero(content.any(axis=1))
+    cols = np.flatnonzero(content.any(axis=0))
+    if rows.size == 0 or cols.size == 0:
+        return image
+    top = max(rows[0] - padding, 0)
+    bottom = min(rows[-1] + padding + 1, pixels.shape[0])
+    left = max(cols[0] - padding, 0)
+    right = min(cols[-1] + padding + 1, pixels.shape[1])
+    return image.crop((left, top, right, bottom))
+
+
+def _encode(image, fmt):
+    buffer = io.BytesIO()
+    if fmt == "PNG":
+        image.save(buffer, format="PNG", optimize=True)
+    elif fmt == "JPEG":
+        image.convert("RGB").save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    elif fmt == "WEBP":
+        image.save(buffer, format="WEBP", quality=WEBP_QUALITY, method=4)
+    return buffer.getvalue()
+
+
+def preprocess_image(data, max_long_edge=DEFAULT_MAX_LONG_EDGE, crop_borders=False, allow_lossy=True):
+    """
+    预处理图片字节，返回 PreprocessResult。
+
+    report 中包含原始/处理后的字节数和估算的图片 token 数，以及节省的数量。
+    如果处理后反而更大，则保留原图。
+    """
+    image = Image.open(io.BytesIO(data))
+    original_format = image.format
+    original_size = image.size
+    image.seek(0)  # GIF 等多帧图片只取第一帧
+    image.load()
+
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+    if crop_borders:
+        image = crop_uniform_border(image)
+
+    if max_long_edge and max(image.size) > max_long_edge:
+        scale = max_long_edge / max(image.size)
+        new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(new_size, Image.LANCZOS)
+
+    has_alpha = image.mode in ("RGBA", "LA")
+    formats = ["PNG"]
+    if allow_lossy:
+        formats.append("WEBP")
+        if not has_alpha:
+            formats.append("JPEG")
+
+    candidates = [(fmt, _encode(image, fmt)) for fmt in formats]
+    fmt, encoded = min(candidates, key=lambda item: len(item[1]))
+    width, height = image.size
+
+    # 尺寸没变且原图本身更小时，直接使用原图
+    if image.size == original_size and original_format in MEDIA_TYPES and len(data) <= len(encoded):
+        fmt, encoded = original_format, data
+
+    original_tokens = estimate_image_tokens(*original_size)
+    new_tokens = estimate_image_tokens(width, height)
+    report = {
+        "original_size": original_size,
+        "new_size": (width, height),
+        "format": fmt,
+        "original_bytes": len(data),
+        "new_bytes": len(encoded),
+        "bytes_saved": len(data) - len(encoded),
+        "original_tokens": original_tokens,
+        "new_tokens": new_tokens,
+        "tokens_saved": original_tokens - new_tokens,
+    }
+    return PreprocessResult(encoded, MEDIA_TYPES[fmt], width, height, report)
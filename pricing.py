@@ -0,0 +1,60 @@
+"""
+各模型的 token 价格（美元 / 百万 token）和费用估算。
+
+提示缓存的价格按官方规则计算：写入缓存为输入价格的 1.25 倍，读取缓存为输入价格的 0.1 倍。
+"""
+CACHE_WRITE_MULTIPLIER = 1.25
+CACHE_READ_MULTIPLIER = 0.1
+
+# 模型名: (输入价格, 输出价格)
+MODEL_PRICES = {
+    "claude-3-5-sonnet-20241022": (3.00, 15.00),
+    "claude-3-5-haiku-20241022": (0.80, 4.00),
+    "claude-3-7-sonnet-20250219": (3.00, 15.00),
+    "claude-3-opus-20240229": (15.00, 75.00),
+    "claude-3-haiku-20240307": (0.25, 1.25),
+    "claude-sonnet-4-20250514": (3.00, 15.00),
+    "claude-opus-4-20250514": (15.00, 75.00),
+}
+DEFAULT_MODEL_PRICE = MODEL_PRICES["claude-3-5-sonnet-20241022"]
+
+
+def get_model_pricing(model):
+    """返回模型每个 token 的价格字典：input / output / cache_write / cache_read"""
+    input_price, output_price = MODEL_PRICES.get(model, DEFAULT_MODEL_PRICE)
+    return {
+        "input": input_price / 1000000,
+        "output": output_price / 1000000,
+        "cache_write": input_price * CACHE_WRITE_MULTIPLIER / 1000000,
+        "cache_read": input_price * CACHE_READ_MULTIPLIER / 1000000,
+    }
+
+
+def usage_tokens(usage):
+    """从 API 返回的 usage 中取出各类 token 数，缺失的字段按 0 计"""
+    return {
+        "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+        "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+        "cache_write_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+        "cache_read_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+    }
+
+
+def estimate_cost(usage, model):
+    """
+    计算一次请求的费用。
+
+    返回的字典包含各类 token 数、实际费用 cost、
+    不使用提示缓存时的费用 cost_without_cache，以及两者之差 saved。
+    """
+    tokens = usage_tokens(usage)
+    price = get_model_pricing(model)
+    cost = (
+        tokens["input_tokens"] * price["input"]
+        + tokens["cache_write_tokens"] * price["cache_write"]
+        + tokens["cache_read_tokens"] * price["cache_read"]
+        + tokens["output_tokens"] * price["output"]
+    )
+    total_input = tokens["input_tokens"] + tokens["cache_write_tokens"] + tokens["cache_read_tokens"]
+    cost_without_cache = total_input * price["input"] + tokens["output_tokens"] * price["output"]
+    return dict(tokens, cost=cost, cost_without_cache=cost_without_cache, saved=cost_without_cache - cost)
@@ -0,0 +1,41 @@
+"""
+为对话加上提示缓存 (prompt caching) 标记。
+
+重新生成时对话只会在末尾追加新的轮次，前面的图片、指令提示词和历史轮次保持不变。
+在这些稳定前缀的末尾加上 cache_control 标记后，下一轮请求可以直接读取缓存，
+这部分输入只按十分之一的价格计费，首个 token 的延迟也更低。
+
+API 每个请求最多允许 4 个缓存断点，这里使用 3 个：
+    1. 第一条用户消息（图片 + 指令提示词），整个会话都不变；
+    2. 倒数第二条用户消息，对应上一轮请求写入的缓存，本轮读取；
+    3. 最后一条用户消息，写入缓存供下一轮读取。
+"""
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def _mark_last_block(message):
+    """返回最后一个内容块带有 cache_control 的消息副本"""
+    content = message["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    if not content:
+        return message
+    content = list(content)
+    content[-1] = dict(content[-1], cache_control=CACHE_CONTROL)
+    return dict(message, content=content)
+
+
+def mark_cache_breakpoints(messages):
+    """返回加上缓存断点的对话副本，不修改传入的对话"""
+    user_indices = [i for i, message in enumerate(messages) if message["role"] == "user"]
+    if not user_indices:
+        return messages
+
+    breakpoints = {user_indices[0], user_indices[-1]}
+    if len(user_indices) >= 2:
+        breakpoints.add(user_indices[-2])
+
+    return [
+        _mark_last_block(message) if i in breakpoints else message
+        for i, message in enumerate(messages)
+    ]
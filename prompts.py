@@ -0,0 +1,77 @@
+"""
+发给 Claude 的提示词。
+
+单独放在一个模块里，batch.py 等命令行脚本可以直接导入，不必为此导入 app.py（以及 Streamlit）。
+"""
+
+prompt_example_img = """
+观察上面的图像，图像中是一个什么样的曲线？曲线中有哪些要素？
+1.请你帮我使用Python代码复现这张figure;
+2.复现的时候，尤其注意原图的色彩风格，图形样式，力求与原图一致;
+3.如果你读取图中数据有困难，可以自己生成示例数据;
+注意，我会将你回答的内容直接放进一个exec(code, {"plt": plt})语句中，所以:
+1.请你保证你返回的内容直接就是一个可以执行的代码，不要包括解释或者markdown元素等内容;
+2.你绘制的图像应该保存在一个plt对象中，以便我提取回传到其他逻辑里;
+3.在添加颜色条时，确保绑定到正确的图形对象 (使用 fig.colorbar);
+4.避免出现紧凑布局与颜色条冲突的问题;
+5.我的环境中没有GUI界面，不要出现plt.show();
+"""
+
+prompt_doc = f"""
+请你帮我把下面的代码抽象为一个函数，要求如下:
+1.函数名为generate_figure;
+2.函数的输入参数为图像所需要的路径，以及一些可以自定义的参数（如色彩、样式等），这些参数要有一个默认值;
+3.函数的输出为一个plt对象;
+4.函数中所有的注释、参数解释都应当使用中文;
+下面是我需要你帮忙处理的代码：
+"""
+
+# 提示词变体：追加在本轮请求末尾的补充要求，routing.py 可以把同一请求的多个候选分配到不同的变体上，
+# 按实测的成功率比较哪种写法更有效。"default" 不追加任何内容。
+PROMPT_VARIANTS = {
+    "default": "",
+    "data": "补充要求：先仔细估读图中的关键数据（坐标轴范围、刻度、峰值和拐点的位置），再据此构造数据，不要随意生成。",
+    "layout": "补充要求：优先还原整体版式，包括画布比例、子图布局、坐标轴与图例的位置、字号、线型和配色。",
+}
+
+# 数据规格模式（见 spec_render.py）：模型只返回描述图表的 JSON，由本地渲染器画图
+prompt_spec = """
+观察上面的图像，读出图中的数据和样式，用一个 JSON 对象描述这张图，我会用固定的渲染器把它画出来。
+要求:
+1.只返回 JSON，不要包括解释、代码或 markdown 元素;
+2.数据要从图中估读（坐标轴范围、刻度、峰值和拐点的位置），不要随意编造;等间距的 x 用 {"start": 0, "stop": 10, "num": 50} 表示;
+3.颜色尽量与原图一致，使用 "#rrggbb" 格式;
+格式如下（可选字段不需要时省略）:
+{
+  "size": [宽, 高],                 画布尺寸，单位英寸
+  "layout": [行数, 列数],           子图网格，只有一个子图时省略
+  "title": "总标题",
+  "axes": [                          每个子图一项，按行排列
+    {
+      "title": "", "xlabel": "", "ylabel": "",
+      "xlim": [最小, 最大], "ylim": [最小, 最大], "xscale": "linear 或 log", "yscale": "linear 或 log",
+      "xticks": [刻度位置], "xticklabels": ["刻度文字"], "yticks": [...], "yticklabels": [...],
+      "grid": true, "legend": "图例位置，如 upper right",
+      "series": [
+        {"type": "line", "x": [...], "y": [...], "color": "#1f77b4", "linestyle": "-", "linewidth": 1.5, "marker": "o", "label": "图例名"}
+      ]
+    }
+  ]
+}
+series 的 type 可以是:
+line / step（折线）、scatter（散点，size 为点的大小）、bar / barh（柱状图，x 可以是类别名，可选 width、bottom）、
+area（填充区域，y2 为下边界）、errorbar（误差棒，yerr / xerr）、heatmap（热力图，z 为二维数组，可选 cmap、vmin、vmax、colorbar_label）、
+pie（饼图，values、labels、colors、percent）、hline / vline（参考线，y 或 x 为一个数）、text（文字标注，x、y、text）。
+数组中缺失的值写 null。
+"""
+
+# 多子图拆分（见 panels.py）：每个子图单独复现，再由本地代码拼回原来的布局
+prompt_panel = """
+上面的图像是一张组合图中的一个子图。请你用Python代码复现这个子图，要求如下:
+1.只定义一个函数 draw_panel(ax)，在传入的 ax 上绘图，所有数据和辅助变量都写在函数内部;
+2.不要创建新的画布或坐标轴（不要调用 plt.figure、plt.subplots、plt.subplot），也不要调用 plt.show、plt.savefig、tight_layout;
+3.绘图一律使用 ax 的方法（ax.plot、ax.set_xlabel 等），颜色条使用 ax.figure.colorbar(..., ax=ax)，内嵌的小图使用 ax.inset_axes;
+4.子图的编号（如 (a)、(b)）如果在图中出现，用 ax.set_title 或 ax.text 画出来;
+5.尤其注意原图的色彩风格和图形样式;如果读取图中数据有困难，可以自己生成示例数据;
+6.只返回代码，不要包括解释或者markdown元素等内容。
+"""
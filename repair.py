@@ -0,0 +1,251 @@
+"""
+执行-修复循环。
+
+代码执行失败时，把错误信息作为新一轮对话发回给模型，让它修正代码，直到成功或用完重试次数。
+每一轮可以同时请求 N 个候选回复，按完成顺序依次执行，采用第一个执行成功的候选并取消其余请求，
+这样一个失败的采样不必再花一整个往返的时间。
+
+指定相似度阈值时（见 similarity.py），执行成功的候选还要和原图比较：
+达到阈值的候选立即采用，否则在所有候选中取得分最高的；
+整体得分仍低于阈值时，把得分发回模型继续改进，直到达到阈值或用完重试次数。
+
+传入 routing.Router 时，每一轮的模型和候选的提示词变体由它决定（逐级升级或并发扇出）；
+每个完成的候选都会计入 routing 的统计。
+
+output_format 为 "spec" 时，模型返回的是数据规格 JSON（见 spec_render.py），在本进程中直接渲染，不执行任何代码；
+由规格生成的代码只用于显示和保存。规格无效时作为一次失败处理，错误信息同样发回模型修正。
+
+调用方可以替换发出请求的方式（request，例如界面的流式显示和响应缓存），
+并通过 on_round / on_candidate 回调显示进度；回调都在事件循环中被调用，不应阻塞。
+"""
+import asyncio
+import time
+import traceback
+from collections import namedtuple
+
+import metrics
+from claude_client import DEFAULT_MAX_TOKENS, DEFAULT_MODEL, acreate_message
+from code_check import extract_code
+from history import REFINE_PROMPT_PREFIX, REPAIR_PROMPT_PREFIX, compact_history, estimate_tokens
+from pricing import estimate_cost
+from routing import DEFAULT_VARIANT, Route, apply_variant, get_default_stats
+from sandbox import ExecResult
+from similarity import compare, format_score, reference_from_messages
+from spec_render import DEFAULT_DPI, SpecError, parse_spec, render_spec, spec_to_code
+
+# ok: 是否成功；code: 最终代码；messages: 包含修复轮次的完整对话；
+# result: 最后一次执行的 ExecResult；attempts: 执行过的候选总数；error: 最后一次的错误信息；
+# score: 与原图的 SimilarityScore（未评估时为 None）；reply: 模型的原始回复（数据规格模式下为规格 JSON）
+RepairResult = namedtuple("RepairResult", ["ok", "code", "messages", "result", "attempts", "error", "score", "reply"],
+                          defaults=(None, None))
+
+
+def format_exec_error(result):
+    """把 ExecResult 中的错误整理成发给模型的文字"""
+    if result.traceback:
+        return f"{result.error}\n{result.traceback}"
+    return result.error
+
+
+def repair_turns(reply_text, error_info, spec=False):
+    """构造修复轮次：模型上一次的回复 + 带错误信息的修复请求；spec 为 True 时要求修正的是数据规格"""
+    target = "请检查并修正上面的数据规格，仍然只返回 JSON。" if spec else "请检查并修正上面的代码。"
+    new_prompt = (
+        f"{REPAIR_PROMPT_PREFIX}\n"
+        f"代码执行出错的错误信息：{error_info}\n"
+        f"{target}"
+    )
+    return [
+        {"role": "assistant", "content": [{"type": "text", "text": reply_text}]},
+        {"role": "user", "content": [{"type": "text", "text": new_prompt}]},
+    ]
+
+
+def refine_turns(reply_text, score, spec=False):
+    """构造改进轮次：代码能运行但与原图差距较大时，把相似度得分发回模型"""
+    target = "数据规格（重新估读数据，仍然只返回 JSON）" if spec else "代码"
+    new_prompt = (
+        f"{REFINE_PROMPT_PREFIX} {format_score(score)}。\n"
+        f"请再仔细对照原图，在布局、配色和图形元素上进一步改进{target}。"
+    )
+    return [
+        {"role": "assistant", "content": [{"type": "text", "text": reply_text}]},
+        {"role": "user", "content": [{"type": "text", "text": new_prompt}]},
+    ]
+
+
+def reply_to_code(reply, output_format="code"):
+    """
+    把模型的回复转换为可执行的代码，返回 (code, error)，无法转换时 code 为 None，error 为发回模型的错误说明。
+    "panel" 为多子图拆分中单个子图的回复（draw_panel(ax) 函数，见 panels.py）。
+    """
+    if output_format == "panel":
+        # panels.py 导入了本模块，这里在用到时再导入
+        from panels import panel_to_code
+
+        return panel_to_code(reply)
+    return extract_code(reply), None
+
+
+def render_spec_reply(reply, dpi=None, figsize=None, **options):
+    """
+    按数据规格回复在本进程中渲染（不执行代码），返回 (code, ExecResult)；code 为由规格生成的代码，只用于显示和保存。
+    参数与 sandbox.SandboxPool.run 相同，其中只有 dpi 和 figsize 对规格渲染有意义，其余忽略。
+    """
+    start = time.perf_counter()
+    try:
+        spec = parse_spec(reply)
+    except SpecError as e:
+        return None, ExecResult(False, None, f"数据规格无效: {e}", None, time.perf_counter() - start)
+    try:
+        png = render_spec(spec, dpi=dpi or DEFAULT_DPI, size=figsize)
+    except SpecError as e:
+        result = ExecResult(False, None, f"数据规格无效: {e}", None, time.perf_counter() - start)
+    except Exception as e:
+        result = ExecResult(False, None, f"{type(e).__name__}: {e}", traceback.format_exc(),
+                            time.perf_counter() - start)
+    else:
+        result = ExecResult(True, png, None, None, time.perf_counter() - start)
+    metrics.record_stage("spec_render", result.elapsed, result.ok)
+    return spec_to_code(spec), result
+
+
+async def request_reply(messages, route, max_tokens):
+    """默认的请求方式：按 route 的模型调用 API，返回 (回复文本, 费用)"""
+    response = await acreate_message(messages, model=route.model, max_tokens=max_tokens)
+    return response.content[0].text, estimate_cost(response.usage, route.model)["cost"]
+
+
+async def _request_and_run(messages, pool, route, max_tokens, exec_options, output_format, request):
+    start = time.perf_counter()
+    messages = apply_variant(messages, route.variant)
+    reply, cost = await request(messages, route, max_tokens)
+    if output_format == "spec":
+        code, result = await asyncio.to_thread(render_spec_reply, reply, **exec_options)
+        return route, messages, reply, code, result, cost, time.perf_counter() - start
+    code, error = reply_to_code(reply, output_format)
+    if error is None:
+        result = await pool.arun(code, **exec_options)
+    else:
+        result = ExecResult(False, None, error, None, 0.0)
+    return route, messages, reply, code, result, cost, time.perf_counter() - start
+
+
+async def first_successful_candidate(messages, n_candidates, pool, model=DEFAULT_MODEL,
+                                     max_tokens=DEFAULT_MAX_TOKENS, reference=None, threshold=None,
+                                     exec_options=None, routes=None, output_format="code",
+                                     request=request_reply, on_candidate=None):
+    """
+    并发请求 n_candidates 个回复，按完成顺序执行，返回第一个执行成功的候选。
+    给出 routes（routing.Route 的列表）时，每个候选使用各自的模型和提示词变体，候选数为 len(routes)。
+    output_format 为 "spec" 时回复是数据规格，直接渲染而不经过 pool，返回的 code 是由规格生成的代码。
+
+    request(messages, route, max_tokens) 发出一个候选的请求，返回 (回复文本, 费用)，messages 已按提示词变体改写。
+    每个候选执行完成后调用 on_candidate(route, messages, reply, code, result, score)。
+
+    同时给出 reference（similarity.prepare_reference 的结果）和 threshold 时，
+    返回第一个相似度达到阈值的候选；都没有达到时等所有候选完成，返回得分最高的。
+
+    exec_options 原样传给 pool.arun（如 fast、preview、dpi，见 sandbox.SandboxPool.run）或 render_spec_reply。
+
+    返回 (ok, reply, code, result, attempts, score)；全部失败时返回最先完成的失败候选，
+    作为下一轮修复的依据。
+    """
+    scoring = reference is not None and threshold is not None
+    if routes is None:
+        routes = [Route(model, DEFAULT_VARIANT)] * n_candidates
+    stats = get_default_stats()
+    tasks = [
+        asyncio.ensure_future(_request_and_run(messages, pool, route, max_tokens, exec_options or {}, output_format,
+                                               request))
+        for route in routes
+    ]
+    first_failure = None
+    best = None
+    attempts = 0
+    last_error = None
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                route, sent, reply, code, result, cost, seconds = await next_done
+            except Exception as e:
+                # 单个候选的 API 错误不影响其他候选
+                last_error = e
+                continue
+            attempts += 1
+            score = compare(reference, result.png) if scoring and result.ok else None
+            stats.record(route.model, route.variant, result.ok and (score is None or score.score >= threshold),
+                         seconds, cost, score.score if score is not None else None)
+            if on_candidate is not None:
+                on_candidate(route, sent, reply, code, result, score)
+            if result.ok:
+                if not scoring:
+                    return True, reply, code, result, attempts, None
+                if best is None or score.score > best[3].score:
+                    best = (reply, code, result, score)
+                if score.score >= threshold:
+                    break
+            elif first_failure is None:
+                first_failure = (reply, code, result)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if best is not None:
+        reply, code, result, score = best
+        return True, reply, code, result, attempts, score
+    if first_failure is None:
+        raise last_error
+    reply, code, result = first_failure
+    return False, reply, code, result, attempts, None
+
+
+async def generate_with_repair(messages, pool, max_retries=3, n_candidates=1, model=DEFAULT_MODEL,
+                               max_tokens=DEFAULT_MAX_TOKENS, token_budget=None, similarity_threshold=None,
+                               exec_options=None, router=None, output_format="code", request=request_reply,
+                               count_tokens=estimate_tokens, on_round=None, on_candidate=None):
+    """
+    生成代码并执行，失败时把错误发回模型修复，最多修复 max_retries 次。
+    给出 router（routing.Router）时，每一轮的模型和候选的提示词变体由它决定，model 参数不再使用。
+    output_format 为 "spec" 时模型返回数据规格（messages 中应使用 prompts.prompt_spec），修复轮次也按规格的要求措辞。
+    指定 token_budget 时，每轮请求前都会按预算压缩对话历史（count_tokens 可以是阻塞的调用，在线程中执行）。
+    指定 similarity_threshold 时，与对话中的原图比较，得分低于阈值的结果也会占用一次重试来改进，
+    最终返回得分最高的一次。
+
+    每轮请求前调用 on_round(round_index, routes, tokens)，tokens 为压缩前后的 token 数，本轮没有压缩时为 None；
+    request 和 on_candidate 见 first_successful_candidate。
+    """
+    reference = reference_from_messages(messages) if similarity_threshold is not None else None
+    attempts = 0
+    error_info = None
+    result = None
+    best = None
+    for round_index in range(max_retries + 1):
+        tokens = None
+        if token_budget is not None:
+            compacted, before, after = await asyncio.to_thread(compact_history, messages, token_budget, count_tokens)
+            if compacted is not messages:
+                messages, tokens = compacted, (before, after)
+        if router is not None:
+            routes = router.routes(round_index, n_candidates)
+        else:
+            routes = [Route(model, DEFAULT_VARIANT)] * n_candidates
+        if on_round is not None:
+            on_round(round_index, routes, tokens)
+        ok, reply, code, result, tried, score = await first_successful_candidate(
+            messages, n_candidates, pool, model, max_tokens, reference, similarity_threshold, exec_options,
+            routes, output_format, request, on_candidate
+        )
+        attempts += tried
+        if ok:
+            if score is None or score.score >= similarity_threshold:
+                return RepairResult(True, code, messages, result, attempts, None, score, reply)
+            if best is None or score.score > best.score.score:
+                best = RepairResult(True, code, messages, result, attempts, None, score, reply)
+            messages = messages + refine_turns(reply, score, spec=output_format == "spec")
+            continue
+        error_info = format_exec_error(result)
+        messages = messages + repair_turns(reply, error_info, spec=output_format == "spec")
+    if best is not None:
+        return best._replace(attempts=attempts)
+    return RepairResult(False, None, messages, result, attempts, error_info)
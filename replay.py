@@ -0,0 +1,345 @@
+"""
+回放保存的结果，不调用 API 就能检查运行环境的变化对已有绘图代码的影响。
+
+升级 matplotlib / numpy、修改 rcParams 或改动 sandbox.py 之后，以前能正常复现的代码可能变慢、出错或者画得不一样。
+这里把保存的结果（artifacts.py 的紧凑格式，以及旧格式的结果 JSON）当作回归测试集:
+每段代码在沙箱进程池中并发重新执行，记录执行耗时、工作进程的峰值内存、成败，
+以及新图像与当时保存的图像、与原图之间的相似度（见 similarity.py），逐条写入 JSONL 报告。
+同一个测试集在两个环境中各回放一次，再比较两份报告。
+
+    python replay.py run . batch_output -o before.jsonl          # 回放当前目录和批量输出目录中的结果
+    pip install -U matplotlib
+    python replay.py run . batch_output -o after.jsonl
+    python replay.py compare before.jsonl after.jsonl           # 新出错、变慢、内存增加、图像变化的结果
+
+比较时出现新的失败，或者耗时、内存、图像的变化超出容差，以非零状态码退出，可以直接放进 CI。
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import re
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from importlib import metadata
+
+from artifacts import ArtifactStore, is_store
+from metrics import percentile
+from history import first_image_bytes
+from sandbox import SandboxPool
+from similarity import compare_images
+from storage import LocalStorage, make_backend
+
+LEGACY_RESULT = re.compile(r"^\d{8}_\d{4}_.+\.json$")  # 旧格式的结果 JSON，由 app.py 按时间命名
+DRIFT_THRESHOLD = 0.98     # 与保存的图像相似度低于此值时算作图像有变化
+MIN_TIME_DELTA = 0.05      # 耗时的变化小于此值（秒）时不算变慢，避免很快的代码因计时抖动被误报
+MIN_MEMORY_DELTA = 16 * 1024 * 1024
+# 每个工作进程第一次绘图时要加载字体等，明显比之后慢；正式计时前先在所有进程上各画一次
+WARMUP_CODE = "import matplotlib.pyplot as plt\nplt.plot([0, 1])\nplt.title('warm-up')"
+
+# created: 保存的时间，用于把多个来源的结果按时间排序；
+# load() 返回 (代码, 保存的图像字节, 原图字节)，图片没有时为 None；在回放时才读取，测试集很大时也不会占满内存
+ReplayCase = namedtuple("ReplayCase", ["name", "created", "load"])
+
+
+def _store_cases(store, query=None):
+    for run in store.search(query):
+        yield ReplayCase(run.name, run.manifest.get("created", 0),
+                         lambda run=run: (run.code, run.figure_bytes(), run.image_bytes()))
+
+
+def _load_legacy(path):
+    with open(path, "r", encoding="utf-8") as f:
+        result = json.load(f)
+    figure = None
+    figure_path = os.path.splitext(path)[0] + ".png"
+    if os.path.exists(figure_path):
+        with open(figure_path, "rb") as f:
+            figure = f.read()
+    return result.get("code"), figure, first_image_bytes(result.get("conversation_history") or [])
+
+
+def _legacy_case(path):
+    return ReplayCase(os.path.splitext(os.path.basename(path))[0], os.path.getmtime(path), lambda: _load_legacy(path))
+
+
+def collect_cases(sources, query=None):
+    """
+    从目录、s3://桶/前缀 或单个旧格式 JSON 收集要回放的结果。
+    目录中的紧凑格式结果和旧格式 JSON 都会收集；同名的结果只保留第一个。
+    返回的结果按保存时间从新到旧排列（不区分来源）。
+    """
+    cases = {}
+    for source in sources:
+        if source.startswith("s3://"):
+            found = _store_cases(ArtifactStore(make_backend(source)), query)
+        elif os.path.isfile(source):
+            found = [_legacy_case(source)]
+        else:
+            found = list(_store_cases(ArtifactStore(LocalStorage(source)), query)) if is_store(source) else []
+            for name in sorted(os.listdir(source)):
+                if LEGACY_RESULT.match(name) and (not query or query.lower() in name.lower()):
+                    found.append(_legacy_case(os.path.join(source, name)))
+        for case in found:
+            cases.setdefault(case.name, case)
+    return sorted(cases.values(), key=lambda case: case.created, reverse=True)
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest() if data is not None else None
+
+
+def replay_case(pool, case, repeat=1, **options):
+    """
+    重新执行一个结果的代码，返回报告中的一条记录（dict）。
+    repeat 大于 1 时执行多次，耗时取最小值、峰值内存取最大值，减小计时抖动的影响。
+    """
+    if repeat < 1:
+        raise ValueError("repeat 至少为 1")
+    record = {"name": case.name}
+    try:
+        code, figure, original = case.load()
+    except (OSError, ValueError, KeyError) as e:
+        return dict(record, ok=False, error=f"读取结果失败: {e}")
+    if not code:
+        return dict(record, ok=False, error="结果中没有代码")
+    record["code_sha256"] = _digest(code.encode("utf-8"))
+
+    results = [pool.run(code, **options) for _ in range(repeat)]
+    result = results[-1]
+    peaks = [item.peak_memory for item in results if item.peak_memory is not None]
+    record.update(
+        ok=result.ok,
+        error=result.error,
+        elapsed=round(min(item.elapsed for item in results), 4),
+        savefig=round(min(item.savefig for item in results), 4),
+        peak_memory=max(peaks) if peaks else None,
+        png_sha256=_digest(result.png),
+    )
+    if not result.ok:
+        return record
+    if figure is not None:
+        # 字节完全相同时不用再比较
+        identical = _digest(figure) == record["png_sha256"]
+        record["identical"] = identical
+        record["figure_similarity"] = 1.0 if identical else round(compare_images(figure, result.png).score, 4)
+    if original is not None:
+        record["source_similarity"] = round(compare_images(original, result.png).score, 4)
+    return record
+
+
+def _package_version(name):
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def environment(pool):
+    """回放时的环境，写在报告的第一行，比较两份报告时一并显示"""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "matplotlib": _package_version("matplotlib"),
+        "numpy": _package_version("numpy"),
+        "matplotlibrc": os.environ.get("MATPLOTLIBRC"),
+        "sandbox": {"workers": pool.size, "timeout": pool.timeout, "memory_mb": pool.memory_mb},
+    }
+
+
+def run_replay(cases, output, workers=None, repeat=1, progress=True, **options):
+    """
+    并发回放所有结果，每完成一条就追加写入报告（JSONL，第一行是环境和选项），返回所有记录。
+    options 原样传给 SandboxPool.run（如 dpi、fast）。
+    """
+    workers = workers or os.cpu_count() or 1
+    pool = SandboxPool(workers=workers)
+    records = []
+    try:
+        with open(output, "w", encoding="utf-8") as f:
+            header = {"environment": environment(pool), "options": dict(options, repeat=repeat),
+                      "started": round(time.time(), 3), "cases": len(cases)}
+            f.write(json.dumps(header, ensure_ascii=False) + "\n")
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(lambda _: pool.run(WARMUP_CODE, **options), range(workers)))
+                futures = [executor.submit(replay_case, pool, case, repeat, **options) for case in cases]
+                for future in as_completed(futures):
+                    record = future.result()
+                    records.append(record)
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    f.flush()
+                    if progress:
+                        status = "成功" if record["ok"] else f"失败: {record['error']}"
+                        print(f"[{len(records)}/{len(cases)}] {record['name']} {status}", file=sys.stderr)
+    finally:
+        pool.close()
+    return records
+
+
+def load_report(path):
+    """读取报告，返回 (第一行的环境和选项, {名称: 记录})"""
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    if not lines or "environment" not in lines[0]:
+        raise ValueError(f"{path} 不是 replay.py 的报告")
+    return lines[0], {record["name"]: record for record in lines[1:]}
+
+
+def summarize(records):
+    """汇总一次回放：成败数、耗时和峰值内存的分位数、图像变化"""
+    ok = [record for record in records if record["ok"]]
+    elapsed = [record["elapsed"] for record in ok]
+    peaks = [record["peak_memory"] for record in ok if record.get("peak_memory") is not None]
+    similarities = [record["figure_similarity"] for record in ok if "figure_similarity" in record]
+    return {
+        "cases": len(records),
+        "ok": len(ok),
+        "failed": len(records) - len(ok),
+        "elapsed_total": sum(elapsed),
+        "elapsed_p50": percentile(elapsed, 50),
+        "elapsed_p95": percentile(elapsed, 95),
+        "peak_memory_p50": percentile(peaks, 50),
+        "peak_memory_max": max(peaks) if peaks else None,
+        "identical": sum(1 for record in ok if record.get("identical")),
+        "drifted": sum(1 for value in similarities if value < DRIFT_THRESHOLD),
+        "figure_similarity_min": min(similarities) if similarities else None,
+    }
+
+
+def _mb(size):
+    return f"{size / 1024 / 1024:.1f} MB" if size is not None else "-"
+
+
+def _seconds(value):
+    return f"{value:.3f}s" if value is not None else "-"
+
+
+def format_summary(summary):
+    lines = [
+        f"共 {summary['cases']} 个结果，成功 {summary['ok']}，失败 {summary['failed']}",
+        f"执行耗时: 合计 {summary['elapsed_total']:.2f}s，p50 {_seconds(summary['elapsed_p50'])}，"
+        f"p95 {_seconds(summary['elapsed_p95'])}",
+        f"峰值内存: p50 {_mb(summary['peak_memory_p50'])}，最大 {_mb(summary['peak_memory_max'])}",
+        f"与保存的图像相比: {summary['identical']} 个完全相同，{summary['drifted']} 个相似度低于 {DRIFT_THRESHOLD}",
+    ]
+    if summary["figure_similarity_min"] is not None:
+        lines[-1] += f"（最低 {summary['figure_similarity_min']:.3f}）"
+    return "\n".join(lines)
+
+
+# broken: 之前成功现在失败；fixed: 之前失败现在成功；slower / more_memory / drifted: 超出容差的变化，
+# 每项为 (名称, 之前的值, 现在的值)；elapsed_ratio: 两次都成功的结果的总耗时之比（现在 / 之前）
+Comparison = namedtuple("Comparison", ["common", "only_before", "only_after", "broken", "fixed", "slower",
+                                       "more_memory", "drifted", "elapsed_ratio"])
+
+
+def compare_reports(before, after, time_tolerance=0.25, memory_tolerance=0.25, drift_tolerance=0.02):
+    """比较同一个测试集的两次回放（load_report 返回的 {名称: 记录}）"""
+    common = sorted(set(before) & set(after))
+    broken, fixed, slower, more_memory, drifted = [], [], [], [], []
+    total_before = total_after = 0.0
+    for name in common:
+        old, new = before[name], after[name]
+        if old["ok"] and not new["ok"]:
+            broken.append((name, None, new.get("error")))
+        if not old["ok"] and new["ok"]:
+            fixed.append((name, old.get("error"), None))
+        if not (old["ok"] and new["ok"]):
+            continue
+        total_before += old["elapsed"]
+        total_after += new["elapsed"]
+        if new["elapsed"] > old["elapsed"] * (1 + time_tolerance) and new["elapsed"] - old["elapsed"] > MIN_TIME_DELTA:
+            slower.append((name, old["elapsed"], new["elapsed"]))
+        old_peak, new_peak = old.get("peak_memory"), new.get("peak_memory")
+        if old_peak and new_peak and new_peak > old_peak * (1 + memory_tolerance) and new_peak - old_peak > MIN_MEMORY_DELTA:
+            more_memory.append((name, old_peak, new_peak))
+        # 两次都与保存的图像比较，相似度下降说明新环境画出的图离当时采用的结果更远了
+        old_score, new_score = old.get("figure_similarity"), new.get("figure_similarity")
+        if old_score is not None and new_score is not None and old_score - new_score > drift_tolerance:
+            drifted.append((name, old_score, new_score))
+    ratio = total_after / total_before if total_before else None
+    return Comparison(len(common), sorted(set(before) - set(after)), sorted(set(after) - set(before)),
+                      broken, fixed, slower, more_memory, drifted, ratio)
+
+
+def format_comparison(comparison, header_before, header_after):
+    env_before, env_after = header_before["environment"], header_after["environment"]
+    lines = []
+    for key in ("python", "matplotlib", "numpy", "matplotlibrc", "platform", "sandbox"):
+        if env_before.get(key) != env_after.get(key):
+            lines.append(f"{key}: {env_before.get(key)} → {env_after.get(key)}")
+    if env_before.get("sandbox") != env_after.get("sandbox") or header_before["options"] != header_after["options"]:
+        # 进程数多于 CPU 核数时任务互相争抢，单个结果的耗时不可比
+        lines.append("注意: 两次回放的沙箱设置或渲染选项不同，耗时和内存的比较仅供参考")
+    lines.append(f"共同的结果 {comparison.common} 个，只在之前的报告中 {len(comparison.only_before)} 个，"
+                 f"只在现在的报告中 {len(comparison.only_after)} 个")
+    if comparison.elapsed_ratio is not None:
+        lines.append(f"两次都成功的结果总耗时: 现在是之前的 {comparison.elapsed_ratio:.2f} 倍")
+    sections = [
+        ("新出现的失败", comparison.broken, lambda old, new: new),
+        ("恢复成功", comparison.fixed, lambda old, new: f"之前: {old}"),
+        ("变慢", comparison.slower, lambda old, new: f"{old:.3f}s → {new:.3f}s"),
+        ("峰值内存增加", comparison.more_memory, lambda old, new: f"{_mb(old)} → {_mb(new)}"),
+        ("与保存的图像差异变大", comparison.drifted, lambda old, new: f"相似度 {old:.3f} → {new:.3f}"),
+    ]
+    for title, items, describe in sections:
+        lines.append(f"{title}: {len(items)} 个")
+        lines.extend(f"    {name}  {describe(old, new)}" for name, old, new in items)
+    return "\n".join(lines)
+
+
+def _positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("应为正整数")
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放保存的结果，检查运行环境的变化对绘图代码的影响（不调用 API）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="回放测试集并写出报告")
+    run_parser.add_argument("sources", nargs="*",
+                            help="结果所在的目录、s3://桶/前缀 或旧格式的结果 JSON，默认与 FIGURE_STORAGE 相同")
+    run_parser.add_argument("-o", "--output", default="replay_report.jsonl", help="报告路径（JSONL）")
+    run_parser.add_argument("-q", "--query", help="只回放名称、原图文件名或文档标题中含有关键词的结果")
+    run_parser.add_argument("--limit", type=_positive_int,
+                            help="最多回放的结果数（所有来源合在一起按保存时间从新到旧取）")
+    run_parser.add_argument("--workers", type=_positive_int, help="沙箱进程数，默认为 CPU 核数")
+    run_parser.add_argument("--repeat", type=_positive_int, default=1, help="每段代码执行的次数，耗时取最小值")
+    run_parser.add_argument("--dpi", type=int, help="渲染的 DPI，默认使用 matplotlib 的设置")
+    run_parser.add_argument("--fast", action="store_true", help="使用 sandbox.FAST_RC 渲染")
+    compare_parser = subparsers.add_parser("compare", help="比较两份报告")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--time-tolerance", type=float, default=0.25, help="单个结果的耗时允许增加的比例")
+    compare_parser.add_argument("--memory-tolerance", type=float, default=0.25, help="单个结果的峰值内存允许增加的比例")
+    compare_parser.add_argument("--drift-tolerance", type=float, default=0.02, help="与保存的图像的相似度允许下降多少")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        sources = args.sources or [os.environ.get("FIGURE_STORAGE") or "."]
+        cases = collect_cases(sources, args.query)[:args.limit]
+        if not cases:
+            parser.error("没有找到保存的结果")
+        options = {"fast": args.fast}
+        if args.dpi:
+            options["dpi"] = args.dpi
+        records = run_replay(cases, args.output, workers=args.workers, repeat=args.repeat, **options)
+        print(format_summary(summarize(records)))
+        print(f"报告已写入 {args.output}")
+        return
+
+    header_before, before = load_report(args.before)
+    header_after, after = load_report(args.after)
+    comparison = compare_reports(before, after, args.time_tolerance, args.memory_tolerance, args.drift_tolerance)
+    print(format_comparison(comparison, header_before, header_after))
+    if comparison.broken or comparison.slower or comparison.more_memory or comparison.drifted:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+"""
+长时间运行的界面进程的内存与磁盘管理。
+
+以前每个浏览器会话的 st.session_state 里都有一份带完整 base64 原图的对话历史和生成的 PNG，
+会话结束后 Streamlit 不一定立即释放，进程的内存只增不减；磁盘上写到一半的临时文件和不再被引用的图片也从不清理。
+这里分成几部分:
+    ImageStore       进程内共享、按内容 SHA-256 寻址、带引用计数的图片存储，同一张图只存一份，
+                     引用计数归零时立即释放
+    SessionRegistry  记录每个会话持有的图片引用和最近一次活动的时间；会话的对话只保存图片引用
+                     （与 artifacts.py 的 blob 引用格式相同），空闲超过 SESSION_IDLE_SECONDS 的会话被释放
+    collect_garbage  清理存储目录中中断的写入留下的 .tmp_ 文件和没有任何结果引用的 blob
+                     （生成的图像只作为结果的 blob 保存，只按清单的引用清理，不按文件名猜测）
+    usage_report     当前进程的内存、图片存储、会话数和各目录的磁盘占用，同时作为 Prometheus 仪表输出
+
+    registry = get_default_registry()
+    turns = registry.keep_messages(session_id, messages)     # 存进 session_state 的是 turns
+    messages = registry.load_messages(turns)                 # 调用 API 前还原为带 base64 图片的对话
+    registry.touch(session_id)                               # 每次执行脚本时调用；会话已被释放时返回 False
+
+环境变量:
+    SESSION_IDLE_SECONDS  会话空闲多久后释放其占用的图片，默认 7200
+    GC_INTERVAL           界面进程自动清理磁盘的间隔（秒），默认 3600
+    TMP_MAX_AGE           临时文件和未被引用的 blob 保留多久（秒），默认 3600
+
+命令行:
+    python resources.py                  显示磁盘占用
+    python resources.py gc [--dry-run] [--tmp-age 3600]
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+from artifacts import BLOBS_PREFIX, MANIFEST_SUFFIX, RUNS_PREFIX, blob_name, dehydrate, rehydrate
+
+DEFAULT_IDLE_SECONDS = 2 * 3600
+DEFAULT_GC_INTERVAL = 3600
+DEFAULT_TMP_MAX_AGE = 3600
+EVICT_INTERVAL = 60.0   # 检查空闲会话的最短间隔（秒）
+EVICTED_MEMORY = 7 * 24 * 3600  # 被释放的会话 id 记住多久（之后再回来的会话当作新会话）
+
+# storage.py / library.py 原子写入时使用的临时文件前缀
+TMP_PREFIX = ".tmp_"
+
+# 清理结果：各类被删除（dry_run 时为将要删除）的文件数和字节数
+GCReport = namedtuple("GCReport", ["tmp_files", "tmp_bytes", "blob_files", "blob_bytes"])
+
+
+class SessionEvicted(KeyError):
+    """会话持有的图片已经被释放（会话空闲过久）"""
+
+
+class ImageStore:
+    """按内容寻址、带引用计数的图片存储，可以被多个线程同时使用"""
+
+    def __init__(self):
+        self._entries = {}  # sha256 -> [data, media_type, 引用数]
+        self._lock = threading.Lock()
+
+    def put(self, data, media_type):
+        """存入一张图片并增加一次引用，返回 sha256"""
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                entry = self._entries[digest] = [data, media_type, 0]
+            entry[2] += 1
+        return digest
+
+    def release(self, digest):
+        """减少一次引用，归零时删除"""
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return
+            entry[2] -= 1
+            if entry[2] <= 0:
+                del self._entries[digest]
+
+    def get(self, digest):
+        with self._lock:
+            entry = self._entries.get(digest)
+        if entry is None:
+            raise SessionEvicted(digest)
+        return entry[0]
+
+    def stats(self):
+        """(图片数, 字节数, 引用总数)"""
+        with self._lock:
+            entries = list(self._entries.values())
+        return len(entries), sum(len(entry[0]) for entry in entries), sum(entry[2] for entry in entries)
+
+
+class _Session:
+    __slots__ = ("last_seen", "refs")
+
+    def __init__(self, now):
+        self.last_seen = now
+        self.refs = {}  # 用途（如 "conversation"、"figure"）-> 引用的 sha256 列表
+
+
+class SessionRegistry:
+    """
+    各会话持有的图片引用。同一会话的同一用途（slot）再次保存时，先引用新的图片再释放旧的，
+    未变化的图片不会被释放后重新存入。
+    """
+
+    def __init__(self, store=None, idle_seconds=DEFAULT_IDLE_SECONDS):
+        self.store = store or ImageStore()
+        self.idle_seconds = idle_seconds
+        self._sessions = {}
+        self._evicted = {}  # session_id -> 释放的时间
+        self._last_evict = 0.0
+        self._lock = threading.Lock()
+
+    def _replace(self, session_id, slot, digests):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = _Session(time.time())
+            old = session.refs.get(slot, [])
+            session.refs[slot] = digests
+        for digest in old:
+            self.store.release(digest)
+
+    def keep_messages(self, session_id, messages, slot="conversation"):
+        """把对话中的 base64 图片存入共享存储，返回只含图片引用的对话（可以放进 session_state）"""
+        if messages is None:
+            self._replace(session_id, slot, [])
+            return None
+        turns, blobs = dehydrate(messages)
+        self._replace(session_id, slot, [self.store.put(data, media_type) for data, media_type in blobs.values()])
+        return turns
+
+    def load_messages(self, turns):
+        """还原为带 base64 图片的对话；图片已被释放时抛出 SessionEvicted"""
+        if turns is None:
+            return None
+        return rehydrate(turns, lambda digest, media_type: self.store.get(digest))
+
+    def keep_bytes(self, session_id, data, slot, media_type="image/png"):
+        """保存一张图片（如生成的 PNG），返回 sha256；data 为 None 时只释放这个用途之前的图片"""
+        if data is None:
+            self._replace(session_id, slot, [])
+            return None
+        digest = self.store.put(data, media_type)
+        self._replace(session_id, slot, [digest])
+        return digest
+
+    def load_bytes(self, digest):
+        return None if digest is None else self.store.get(digest)
+
+    def touch(self, session_id):
+        """
+        记录会话的活动，并按需释放空闲的会话。
+        返回 False 表示这个会话之前因空闲被释放过，调用方应当重置会话状态。
+        """
+        now = time.time()
+        with self._lock:
+            evicted = self._evicted.pop(session_id, None) is not None
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = _Session(now)
+            session.last_seen = now
+            due = now - self._last_evict >= EVICT_INTERVAL
+            if due:
+                self._last_evict = now
+        if due:
+            self.evict_idle(now)
+        return not evicted
+
+    def end(self, session_id):
+        """释放一个会话持有的所有图片"""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            for digests in session.refs.values():
+                for digest in digests:
+                    self.store.release(digest)
+
+    def evict_idle(self, now=None):
+        """释放空闲超过 idle_seconds 的会话，返回释放的会话数"""
+        now = now or time.time()
+        deadline = now - self.idle_seconds
+        with self._lock:
+            idle = [session_id for session_id, session in self._sessions.items() if session.last_seen < deadline]
+            # 只记住持有过图片的会话，它们回来时需要重新上传
+            for session_id in idle:
+                if any(self._sessions[session_id].refs.values()):
+                    self._evicted[session_id] = now
+            for session_id, evicted_at in list(self._evicted.items()):
+                if now - evicted_at > EVICTED_MEMORY:
+                    del self._evicted[session_id]
+        for session_id in idle:
+            self.end(session_id)
+        if idle:
+            metrics.log_event("session_evict", sessions=len(idle))
+        return len(idle)
+
+    def session_count(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+def process_memory():
+    """当前进程的常驻内存（字节）；读不到 /proc 时退回到峰值常驻内存"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        import sys
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def directory_size(path):
+    """目录（递归）或文件的总字节数，不存在时为 0"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+    return total
+
+
+def _walk_storage(root):
+    """存储目录中的文件路径，只进入 runs/、blobs/ 子目录"""
+    for directory, dirs, files in os.walk(root):
+        if os.path.samefile(directory, root):
+            dirs[:] = [name for name in dirs if name in (RUNS_PREFIX, BLOBS_PREFIX)]
+        for name in files:
+            yield os.path.join(directory, name)
+
+
+def storage_usage(root):
+    """存储目录中各部分的字节数：runs（清单和压缩的对话）、blobs（原图和生成的图像）、tmp"""
+    usage = {"runs": 0, "blobs": 0, "tmp": 0}
+    if not os.path.isdir(root):
+        return usage
+    for path in _walk_storage(root):
+        name = os.path.basename(path)
+        top = os.path.relpath(path, root).split(os.sep, 1)[0]
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        if name.startswith(TMP_PREFIX):
+            usage["tmp"] += size
+        elif top in (RUNS_PREFIX, BLOBS_PREFIX):
+            usage[top] += size
+    return usage
+
+
+def _referenced_blobs(root):
+    """所有清单引用的 blob 路径（相对于存储根目录）"""
+    referenced = set()
+    runs_dir = os.path.join(root, RUNS_PREFIX)
+    if not os.path.isdir(runs_dir):
+        return referenced
+    for name in os.listdir(runs_dir):
+        if not name.endswith(MANIFEST_SUFFIX):
+            continue
+        try:
+            with open(os.path.join(runs_dir, name), "rb") as f:
+                manifest = json.loads(f.read())
+        except (OSError, ValueError):
+            continue
+        for image in (manifest.get("images") or []) + [manifest.get("figure")]:
+            if image:
+                referenced.add(blob_name(image["sha256"], image["media_type"]))
+    return referenced
+
+
+def _remove(path, dry_run):
+    try:
+        size = os.path.getsize(path)
+        if not dry_run:
+            os.remove(path)
+    except OSError:
+        return 0
+    return size
+
+
+def collect_garbage(root, extra_dirs=(), tmp_max_age=DEFAULT_TMP_MAX_AGE, dry_run=False, now=None):
+    """
+    清理本地存储目录 root（以及 extra_dirs 中的 .tmp_ 文件），返回 GCReport:
+        - 超过 tmp_max_age 秒的 .tmp_ 文件（写入中断时留下的）
+        - 没有被任何清单引用、且超过 tmp_max_age 秒的 blob（保存结果时 blob 先于清单写入，
+          新写入和被复用的 blob 修改时间都是新的，不会被删）
+    只删除存储自己写入的文件，根目录下的其他文件一概不动。
+    """
+    now = now or time.time()
+    counts = dict.fromkeys(GCReport._fields, 0)
+
+    def old(path, max_age):
+        try:
+            return now - os.path.getmtime(path) > max_age
+        except OSError:
+            return False
+
+    paths = list(_walk_storage(root)) if os.path.isdir(root) else []
+    for directory in extra_dirs:
+        paths.extend(os.path.join(current, name) for current, _, files in os.walk(directory) for name in files)
+    for path in paths:
+        if os.path.basename(path).startswith(TMP_PREFIX) and old(path, tmp_max_age):
+            counts["tmp_bytes"] += _remove(path, dry_run)
+            counts["tmp_files"] += 1
+
+    blobs_dir = os.path.join(root, BLOBS_PREFIX)
+    if os.path.isdir(blobs_dir):
+        referenced = _referenced_blobs(root)
+        for current, _, files in os.walk(blobs_dir):
+            for name in files:
+                path = os.path.join(current, name)
+                relative = os.path.relpath(path, root).replace(os.sep, "/")
+                if relative not in referenced and not name.startswith(TMP_PREFIX) and old(path, tmp_max_age):
+                    counts["blob_bytes"] += _remove(path, dry_run)
+                    counts["blob_files"] += 1
+
+    report = GCReport(**counts)
+    if not dry_run and any(report):
+        metrics.log_event("gc", **report._asdict())
+    return report
+
+
+def local_roots():
+    """按环境变量得到本地的存储目录、响应缓存目录和图库目录（不在本地或未启用时为 None）"""
+    storage = os.environ.get("FIGURE_STORAGE") or "."
+    if storage.strip().lower() == "none" or storage.startswith("s3://"):
+        storage = None
+    cache_dir = os.environ.get("CLAUDE_CACHE_DIR", ".claude_cache")
+    library = os.environ.get("FIGURE_LIBRARY", ".figure_library")
+    if library.strip().lower() == "none":
+        library = None
+    return storage, cache_dir, library
+
+
+def usage_report(registry=None, disk=True):
+    """当前进程的内存、图片存储和各目录的磁盘占用（字节）；disk=False 时不遍历目录"""
+    report = {"rss": process_memory()}
+    if registry is not None:
+        entries, size, refs = registry.store.stats()
+        report.update(sessions=registry.session_count(), images=entries, image_bytes=size, image_refs=refs)
+    if not disk:
+        return report
+    storage, cache_dir, library = local_roots()
+    disk = {}
+    if storage is not None:
+        disk.update({f"storage_{kind}": size for kind, size in storage_usage(storage).items()})
+    disk["cache"] = directory_size(cache_dir)
+    if library is not None:
+        disk["library"] = directory_size(library)
+    report["disk"] = disk
+    return report
+
+
+def _collect_gauges(metrics_registry):
+    report = usage_report(get_default_registry())
+    metrics_registry.set_gauge("process_resident_memory_bytes", report["rss"], "界面进程的常驻内存")
+    metrics_registry.set_gauge("sessions_active", report["sessions"], "持有图片的活动会话数")
+    metrics_registry.set_gauge("image_store_bytes", report["image_bytes"], "共享图片存储占用的内存")
+    metrics_registry.set_gauge("image_store_entries", report["images"], "共享图片存储中的图片数")
+    for kind, size in report["disk"].items():
+        metrics_registry.set_gauge("disk_usage_bytes", size, "各目录的磁盘占用", kind=kind)
+
+
+_default_registry = None
+_default_lock = threading.Lock()
+_last_gc = 0.0
+
+
+def get_default_registry():
+    """进程内共享的 SessionRegistry（按环境变量配置），同时把资源占用注册为 Prometheus 仪表"""
+    global _default_registry
+    with _default_lock:
+        if _default_registry is None:
+            idle = float(os.environ.get("SESSION_IDLE_SECONDS", DEFAULT_IDLE_SECONDS))
+            _default_registry = SessionRegistry(idle_seconds=idle)
+            metrics.get_registry().add_collector(_collect_gauges)
+    return _default_registry
+
+
+def maybe_collect_garbage():
+    """距离上次清理超过 GC_INTERVAL 时在后台线程中清理磁盘，不阻塞调用方"""
+    global _last_gc
+    interval = float(os.environ.get("GC_INTERVAL", DEFAULT_GC_INTERVAL))
+    with _default_lock:
+        if time.time() - _last_gc < interval:
+            return False
+        _last_gc = time.time()
+    storage, _, library = local_roots()
+    if storage is None:
+        return False
+    tmp_max_age = float(os.environ.get("TMP_MAX_AGE", DEFAULT_TMP_MAX_AGE))
+    threading.Thread(
+        target=collect_garbage, name="resource-gc", daemon=True,
+        args=(storage, [library] if library else [], tmp_max_age),
+    ).start()
+    return True
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def main():
+    storage, _, library = local_roots()
+    parser = argparse.ArgumentParser(description="查看和清理磁盘占用")
+    parser.add_argument("--root", default=storage, help="本地存储目录，默认与 FIGURE_STORAGE 相同")
+    subparsers = parser.add_subparsers(dest="command")
+    gc_parser = subparsers.add_parser("gc", help="清理临时文件和未被引用的 blob")
+    gc_parser.add_argument("--dry-run", action="store_true", help="只列出将要删除的数量，不删除")
+    gc_parser.add_argument("--tmp-age", type=float, default=float(os.environ.get("TMP_MAX_AGE", DEFAULT_TMP_MAX_AGE)),
+                           help="临时文件和未被引用的 blob 的保留时间（秒）")
+    args = parser.parse_args()
+
+    if args.root is None:
+        parser.error("FIGURE_STORAGE 不是本地目录，请用 --root 指定")
+    if args.command == "gc":
+        report = collect_garbage(args.root, [library] if library else [], args.tmp_age, dry_run=args.dry_run)
+        action = "将要删除" if args.dry_run else "已删除"
+        print(f"{action}: 临时文件 {report.tmp_files} 个（{format_bytes(report.tmp_bytes)}），"
+              f"未被引用的 blob {report.blob_files} 个（{format_bytes(report.blob_bytes)}）")
+        return
+    for kind, size in storage_usage(args.root).items():
+        print(f"{kind:<8}{format_bytes(size):>12}")
+    for name, path in (("cache", local_roots()[1]), ("library", library)):
+        if path:
+            print(f"{name:<8}{format_bytes(directory_size(path)):>12}")
+
+
+if __name__ == "__main__":
+    main()
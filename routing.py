@@ -0,0 +1,302 @@
+"""
+按实测数据选择模型和提示词。
+
+两种用法，都以每个 (模型, 提示词变体) 的实测统计为依据:
+    逐级升级  先用便宜的模型，代码执行失败或相似度未达标时，下一轮修复换用更强的模型；
+              便宜模型的实测成功率太低、先试它的期望费用反而更高时直接跳过
+    并发扇出  同一轮的多个候选分配到不同的模型和提示词变体（见 prompts.PROMPT_VARIANTS）上，
+              采用第一个成功的，各组合的成败和耗时都计入统计
+
+每个候选完成后记录一条 route 事件（模型、变体、是否成功、API + 执行耗时、费用、相似度），
+写入 metrics.py 的 JSONL 日志；进程启动时从日志末尾读回最近的记录（最多 ROUTE_REPLAY_BYTES 字节，
+日志不断增长也不会拖慢启动），路由决策跨进程、跨重启都基于同一份数据。
+
+    router = Router(["claude-3-5-haiku-20241022", "claude-3-5-sonnet-20241022"])
+    routes = router.routes(attempt, n_candidates)    # [Route(model, variant), ...]
+    messages_for_route = apply_variant(messages, route.variant)
+    get_default_stats().record(route.model, route.variant, ok, seconds, cost, score)
+
+环境变量:
+    CLAUDE_ROUTE_MODELS  参与路由的模型，逗号分隔，按从便宜到贵的顺序排列，
+                         默认 claude-3-5-haiku-20241022,claude-3-5-sonnet-20241022
+
+查看统计:
+    python routing.py metrics.jsonl
+"""
+import argparse
+import itertools
+import json
+import os
+import threading
+from collections import deque, namedtuple
+
+import metrics
+from pricing import DEFAULT_MODEL_PRICE, MODEL_PRICES
+from prompts import PROMPT_VARIANTS
+
+DEFAULT_ROUTE_MODELS = ("claude-3-5-haiku-20241022", "claude-3-5-sonnet-20241022")
+DEFAULT_VARIANT = "default"
+MIN_SAMPLES = 10        # 某个组合至少有这么多次记录，才按它的实测数据做决策
+LATENCY_WINDOW = 200    # 计算耗时分位数时只看最近的这么多次
+ROUTE_REPLAY_BYTES = 4 * 1024 * 1024  # 启动时只读回 metrics 日志末尾的这么多字节
+
+Route = namedtuple("Route", ["model", "variant"])
+
+# attempts: 次数；success_rate: 成功率；p50_seconds / p95_seconds: API + 执行耗时；
+# mean_cost: 每次的平均费用（美元）；mean_score: 平均相似度（没有评估过时为 None）
+RouteSummary = namedtuple("RouteSummary", [
+    "model", "variant", "attempts", "success_rate", "p50_seconds", "p95_seconds", "mean_cost", "mean_score",
+])
+
+
+def route_models():
+    """CLAUDE_ROUTE_MODELS 中配置的模型，从便宜到贵"""
+    value = os.environ.get("CLAUDE_ROUTE_MODELS")
+    if not value:
+        return list(DEFAULT_ROUTE_MODELS)
+    return [model.strip() for model in value.split(",") if model.strip()]
+
+
+def unknown_variants(variants):
+    """variants 中不在 prompts.PROMPT_VARIANTS 里的名称"""
+    return [variant for variant in variants if variant not in PROMPT_VARIANTS]
+
+
+def apply_variant(messages, variant):
+    """返回在最后一条用户消息末尾追加了变体要求的对话副本；default 或未知变体原样返回"""
+    text = PROMPT_VARIANTS.get(variant or DEFAULT_VARIANT)
+    if not text:
+        return messages
+    last_user = max(i for i, message in enumerate(messages) if message["role"] == "user")
+    message = messages[last_user]
+    content = message["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = list(content) + [{"type": "text", "text": text}]
+    return messages[:last_user] + [dict(message, content=content)] + messages[last_user + 1:]
+
+
+def _price_weight(model):
+    """价格表中的输入 + 输出单价，只用于在缺少实测费用时估算两个模型的费用比例"""
+    input_price, output_price = MODEL_PRICES.get(model, DEFAULT_MODEL_PRICE)
+    return input_price + output_price
+
+
+class _Counter:
+    __slots__ = ("attempts", "successes", "cost", "score_total", "scored", "seconds")
+
+    def __init__(self):
+        self.attempts = 0
+        self.successes = 0
+        self.cost = 0.0
+        self.score_total = 0.0
+        self.scored = 0
+        self.seconds = deque(maxlen=LATENCY_WINDOW)
+
+    def add(self, ok, seconds, cost, score):
+        self.attempts += 1
+        self.successes += 1 if ok else 0
+        self.cost += cost or 0.0
+        if score is not None:
+            self.score_total += score
+            self.scored += 1
+        self.seconds.append(seconds)
+
+
+class RouteStats:
+    """各 (模型, 提示词变体) 的成功率、耗时、费用和相似度，可以被多个线程同时使用"""
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _add(self, model, variant, ok, seconds, cost, score):
+        with self._lock:
+            counter = self._counters.get((model, variant))
+            if counter is None:
+                counter = self._counters[(model, variant)] = _Counter()
+            counter.add(ok, seconds, cost, score)
+
+    def record(self, model, variant, ok, seconds, cost=0.0, score=None):
+        """
+        记录一个候选的结果并写入 metrics 日志。
+        ok 表示结果可以采用：代码执行成功，设置了相似度目标时还要达标；cost 为这次 API 调用的费用（美元）。
+        """
+        variant = variant or DEFAULT_VARIANT
+        self._add(model, variant, ok, seconds, cost, score)
+        metrics.log_event("route", model=model, variant=variant, ok=ok, seconds=round(seconds, 6),
+                          cost=round(cost or 0.0, 6), score=round(score, 4) if score is not None else None)
+
+    def load_log(self, path, max_bytes=None):
+        """
+        从 metrics 的 JSONL 日志中读回 route 事件，返回读到的事件数。
+        给出 max_bytes 时只读日志末尾的 max_bytes 字节（跳过被截断的第一行），即最近的记录。
+        """
+        count = 0
+        with open(path, "rb") as f:
+            if max_bytes is not None:
+                f.seek(0, os.SEEK_END)
+                if f.tell() > max_bytes:
+                    f.seek(-max_bytes - 1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        f.readline()
+            for line in f:
+                # 日志中大部分是其他事件，先按字符串过滤，只解析 route 事件
+                if b'"route"' not in line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    continue
+                if event.get("event") != "route":
+                    continue
+                self._add(event["model"], event.get("variant") or DEFAULT_VARIANT, event.get("ok", False),
+                          event.get("seconds", 0.0), event.get("cost", 0.0), event.get("score"))
+                count += 1
+        return count
+
+    def summary(self, model, variant=None):
+        """一个模型（variant 为 None 时合并所有变体）或一个组合的统计，没有记录时返回 None"""
+        with self._lock:
+            counters = [counter for (m, v), counter in self._counters.items()
+                        if m == model and (variant is None or v == variant)]
+            if not counters:
+                return None
+            attempts = sum(counter.attempts for counter in counters)
+            successes = sum(counter.successes for counter in counters)
+            cost = sum(counter.cost for counter in counters)
+            score_total = sum(counter.score_total for counter in counters)
+            scored = sum(counter.scored for counter in counters)
+            seconds = [value for counter in counters for value in counter.seconds]
+        return RouteSummary(
+            model, variant, attempts, successes / attempts,
+            metrics.percentile(seconds, 50), metrics.percentile(seconds, 95), cost / attempts,
+            score_total / scored if scored else None,
+        )
+
+    def summaries(self, by_variant=False):
+        """所有模型（by_variant 为 True 时为所有组合）的统计，按次数从多到少排列"""
+        with self._lock:
+            keys = sorted(self._counters) if by_variant else sorted({model for model, _ in self._counters})
+        rows = [self.summary(*key) if by_variant else self.summary(key) for key in keys]
+        return sorted(rows, key=lambda row: -row.attempts)
+
+
+class Router:
+    """
+    根据 RouteStats 决定每一轮使用的模型和提示词变体。
+
+    models 按从便宜到贵排列；variants 为并发扇出时参与的提示词变体；
+    fan_out 为 True 时同一轮的多个候选分配到不同的 (模型, 变体) 上，否则按轮次逐级升级模型。
+    variants 中有 prompts.PROMPT_VARIANTS 以外的名称时抛出 ValueError。
+    """
+
+    def __init__(self, models=None, variants=(DEFAULT_VARIANT,), fan_out=False, stats=None,
+                 min_samples=MIN_SAMPLES):
+        self.models = list(models or route_models())
+        self.variants = list(variants) or [DEFAULT_VARIANT]
+        unknown = unknown_variants(self.variants)
+        if unknown:
+            raise ValueError(f"未知的提示词变体: {', '.join(unknown)}（可选: {', '.join(PROMPT_VARIANTS)}）")
+        self.fan_out = fan_out
+        self.stats = stats if stats is not None else get_default_stats()
+        self.min_samples = min_samples
+
+    def _measured(self, model, variant=None):
+        summary = self.stats.summary(model, variant)
+        if summary is None or summary.attempts < self.min_samples:
+            return None
+        return summary
+
+    def worth_trying(self, model, stronger):
+        """
+        先试 model、失败再换 stronger 是否划算。
+        期望费用 c + (1 - p) * C 与直接使用 stronger 的 C 比较，即 c < p * C 时才值得先试；
+        c、p 取 model 的实测数据，C 没有足够记录时按价格表的比例从 c 推算。数据不足时总是先试。
+        """
+        cheap = self._measured(model)
+        if cheap is None:
+            return True
+        strong = self._measured(stronger)
+        strong_cost = strong.mean_cost if strong is not None else (
+            cheap.mean_cost * _price_weight(stronger) / _price_weight(model))
+        return cheap.mean_cost < cheap.success_rate * strong_cost
+
+    def plan(self):
+        """逐级升级的模型顺序：去掉按实测数据不值得先试的便宜模型，最强的模型总是保留"""
+        if len(self.models) <= 1:
+            return list(self.models)
+        strongest = self.models[-1]
+        return [model for model in self.models[:-1] if self.worth_trying(model, strongest)] + [strongest]
+
+    def model_for(self, attempt):
+        """第 attempt 轮（从 0 开始）使用的模型：每失败一轮升级一级，升到最强的模型后不再变化"""
+        plan = self.plan()
+        return plan[min(attempt, len(plan) - 1)]
+
+    def _ranked_routes(self):
+        """
+        所有 (模型, 变体) 组合：记录不足的排在前面（需要探索），其余按成功率从高到低、费用从低到高；
+        再把各模型交错排列，前几个候选先覆盖不同的模型。
+        """
+        def key(route):
+            summary = self._measured(route.model, route.variant)
+            if summary is None:
+                return (0, 0.0, 0.0)
+            return (1, -summary.success_rate, summary.mean_cost)
+
+        routes = sorted((Route(model, variant) for model in self.plan() for variant in self.variants), key=key)
+        position = {}
+        for route in routes:
+            position[route] = sum(1 for other in position if other.model == route.model)
+        return sorted(routes, key=position.get)
+
+    def routes(self, attempt, n_candidates=1):
+        """第 attempt 轮的 n_candidates 个候选各自使用的 Route"""
+        if self.fan_out and n_candidates > 1:
+            ranked = self._ranked_routes()
+            return list(itertools.islice(itertools.cycle(ranked), n_candidates))
+        return [Route(self.model_for(attempt), DEFAULT_VARIANT)] * n_candidates
+
+
+_default_stats = None
+_default_stats_lock = threading.Lock()
+
+
+def get_default_stats():
+    """进程内共享的 RouteStats，第一次调用时从 metrics 日志末尾读回最近的记录"""
+    global _default_stats
+    with _default_stats_lock:
+        if _default_stats is None:
+            stats = RouteStats()
+            if os.path.exists(metrics.log_path()):
+                stats.load_log(metrics.log_path(), max_bytes=ROUTE_REPLAY_BYTES)
+            _default_stats = stats
+    return _default_stats
+
+
+def format_summary(summary):
+    score = f"，平均相似度 {summary.mean_score:.2f}" if summary.mean_score is not None else ""
+    return (f"{summary.attempts} 次，成功率 {summary.success_rate:.0%}，耗时 p50 {summary.p50_seconds:.1f}s / "
+            f"p95 {summary.p95_seconds:.1f}s，平均费用 ${summary.mean_cost:.4f}{score}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查看各模型和提示词变体的实测统计")
+    parser.add_argument("log", nargs="?", default=metrics.log_path(), help="metrics 的 JSONL 日志路径")
+    parser.add_argument("--by-variant", action="store_true", help="按 (模型, 提示词变体) 分别统计")
+    args = parser.parse_args()
+
+    stats = RouteStats()
+    if stats.load_log(args.log) == 0:
+        print("日志中没有路由记录")
+        return
+    for summary in stats.summaries(by_variant=args.by_variant):
+        name = f"{summary.model} / {summary.variant}" if args.by_variant else summary.model
+        print(f"{name}: {format_summary(summary)}")
+    router = Router(stats=stats)
+    print(f"当前的升级顺序: {' → '.join(router.plan())}")
+
+
+if __name__ == "__main__":
+    main()
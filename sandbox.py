@@ -0,0 +1,415 @@
+"""
+在独立的工作进程中执行模型生成的绘图代码。
+
+工作进程在启动时就已经以 Agg 后端导入了 matplotlib，常驻等待任务，
+每个任务使用全新的全局命名空间，执行完后关闭所有图形。
+每个进程都有内存上限 (RLIMIT_AS)，每个任务有 CPU 时间上限 (RLIMIT_CPU) 和墙钟超时，
+超时或崩溃的进程会被杀掉并自动补充，不会拖垮 Streamlit 服务进程。
+代码交给工作进程之前先经过 code_check.analyze_code 的静态检查，明显有问题的代码不会被执行。
+
+    pool = get_default_pool()
+    result = pool.run(code)
+    if result.ok:
+        png_bytes = result.png
+    else:
+        print(result.error, result.traceback)
+
+环境变量:
+    SANDBOX_WORKERS        工作进程数，默认为 CPU 核数（最多 4 个）
+    SANDBOX_TIMEOUT        单个任务的墙钟超时（秒），默认 30
+    SANDBOX_MEMORY_MB      单个工作进程的内存上限（MB），默认 2048
+    SANDBOX_CPU_SECONDS    单个任务的 CPU 时间上限（秒），默认 60
+"""
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import io
+import linecache
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import sys
+import threading
+import time
+import traceback
+import types
+from collections import namedtuple
+
+import numpy as np
+
+import metrics
+from code_check import analyze_code, format_findings
+
+try:
+    import resource
+except ImportError:  # Windows 上没有 resource 模块，不做资源限制
+    resource = None
+
+DEFAULT_TIMEOUT = float(os.environ.get("SANDBOX_TIMEOUT", 30))
+DEFAULT_MEMORY_MB = int(os.environ.get("SANDBOX_MEMORY_MB", 2048))
+DEFAULT_CPU_SECONDS = int(os.environ.get("SANDBOX_CPU_SECONDS", 60))
+MAX_JOBS_PER_WORKER = 50  # 执行若干任务后重启工作进程，回收泄漏的内存
+
+# 渲染优化：简化密集折线的路径，并分块绘制超长路径（也避免 Agg 的 "Exceeded cell block limit" 错误）
+FAST_RC = {
+    "path.simplify": True,
+    "path.simplify_threshold": 1.0,
+    "agg.path.chunksize": 10000,
+}
+PREVIEW_DPI = 50
+PREVIEW_MAX_POINTS = 20000  # 预览时每组散点最多绘制的点数
+
+GENERATED_FILENAME = "<generated>"
+
+# elapsed 为执行代码的总耗时（含 savefig），savefig 为其中保存图片的耗时；
+# peak_memory 为执行期间工作进程的峰值常驻内存（字节，含预先导入的 matplotlib），无法测量时为 None
+ExecResult = namedtuple("ExecResult", ["ok", "png", "error", "traceback", "elapsed", "savefig", "peak_memory"],
+                        defaults=(0.0, None))
+
+
+class CpuLimitExceeded(Exception):
+    pass
+
+
+def _on_sigxcpu(signum, frame):
+    raise CpuLimitExceeded("超出 CPU 时间限制")
+
+
+def _set_memory_limit(memory_mb):
+    if resource is None or not memory_mb:
+        return
+    limit = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _set_cpu_limit(cpu_seconds):
+    """在当前已用 CPU 时间的基础上再给 cpu_seconds 秒，超出后收到 SIGXCPU"""
+    if resource is None or not cpu_seconds:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(usage.ru_utime + usage.ru_stime) + 1
+    # 只调整软上限：硬上限一旦降低就无法再提高，而每个任务都需要重新计算上限
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = used + cpu_seconds
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _reset_peak_memory():
+    """清零本进程的峰值常驻内存（Linux 的 VmHWM），之后读到的就是这一个任务的峰值；不支持时返回 False"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_memory(reset):
+    """本进程的峰值常驻内存（字节）。没能清零 VmHWM 时退回到 ru_maxrss，它是进程启动以来的峰值"""
+    if reset:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 上 ru_maxrss 的单位是字节，Linux 上是 KB
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _thin_scatter(collection, rng):
+    """散点超过 PREVIEW_MAX_POINTS 个时按固定种子抽样，逐点的颜色、大小一起抽样"""
+    offsets = collection.get_offsets()
+    n = len(offsets)
+    if n <= PREVIEW_MAX_POINTS:
+        return
+    keep = np.sort(rng.choice(n, PREVIEW_MAX_POINTS, replace=False))
+    array = collection.get_array()
+    collection.set_offsets(offsets[keep])
+    if array is not None and len(array) == n:
+        collection.set_array(array[keep])
+    elif len(collection.get_facecolor()) == n:
+        collection.set_facecolor(collection.get_facecolor()[keep])
+    for getter, setter in ((collection.get_edgecolor, collection.set_edgecolor),
+                           (collection.get_sizes, collection.set_sizes),
+                           (collection.get_linewidths, collection.set_linewidths)):
+        values = getter()
+        if len(values) == n:
+            setter(values[keep])
+
+
+def _thin_mesh(ax, mesh, dpi):
+    """网格比输出像素密得多时，隔行隔列取样后重新绘制（每个像素保留约 2 个网格）"""
+    coordinates = mesh.get_coordinates()
+    array = mesh.get_array()
+    if array is None or array.ndim < 2:
+        return
+    rows, cols = array.shape[:2]
+    bbox = ax.get_window_extent()
+    scale = dpi / ax.figure.dpi
+    step_y = max(1, int(rows / max(2 * bbox.height * scale, 1)))
+    step_x = max(1, int(cols / max(2 * bbox.width * scale, 1)))
+    if step_y == 1 and step_x == 1:
+        return
+    keep_y = np.append(np.arange(0, rows, step_y), rows)
+    keep_x = np.append(np.arange(0, cols, step_x), cols)
+    coordinates = coordinates[keep_y][:, keep_x]
+    ax.pcolormesh(coordinates[..., 0], coordinates[..., 1], array[keep_y[:-1]][:, keep_x[:-1]],
+                  shading="flat", cmap=mesh.get_cmap(), norm=mesh.norm, alpha=mesh.get_alpha(),
+                  zorder=mesh.get_zorder())
+    mesh.remove()
+
+
+def _thin_for_preview(fig, dpi):
+    """预览时把超出显示分辨率的图形元素抽稀，savefig 的耗时主要取决于元素个数，而不是 DPI"""
+    from matplotlib.collections import PathCollection, QuadMesh
+
+    rng = np.random.default_rng(0)
+    for ax in fig.axes:
+        for artist in list(ax.collections):
+            try:
+                if isinstance(artist, PathCollection):
+                    _thin_scatter(artist, rng)
+                elif isinstance(artist, QuadMesh):
+                    _thin_mesh(ax, artist, dpi)
+            except Exception:
+                pass  # 抽稀只是优化，失败时按原样绘制
+
+
+def _run_job(plt, code, render):
+    """
+    在全新的命名空间中执行代码，返回 (PNG 字节, savefig 耗时)。
+
+    render: savefig 为传给 fig.savefig 的参数；fast 为 True 时使用 FAST_RC；
+    figsize 为 (宽, 高) 英寸时在保存前调整图像尺寸；preview 为 True 时先抽稀图形元素。
+    """
+    linecache.cache[GENERATED_FILENAME] = (len(code), None, code.splitlines(True), GENERATED_FILENAME)
+    # 固定随机种子，同一段代码的预览和最终导出画出的是同一组示例数据
+    random.seed(0)
+    np.random.seed(0)
+    savefig_kwargs = render.get("savefig", {})
+    try:
+        with plt.rc_context(FAST_RC if render.get("fast") else {}):
+            exec(compile(code, GENERATED_FILENAME, "exec"), {"plt": plt})
+            fig = plt.gcf()
+            if render.get("figsize"):
+                fig.set_size_inches(render["figsize"])
+            if render.get("preview"):
+                _thin_for_preview(fig, savefig_kwargs.get("dpi") or fig.dpi)
+            # 不再先调用 fig.canvas.draw_idle()：Agg 后端会因此完整绘制一遍，savefig 时又要再画一遍
+            buffer = io.BytesIO()
+            start = time.perf_counter()
+            fig.savefig(buffer, format="png", **savefig_kwargs)
+        return buffer.getvalue(), time.perf_counter() - start
+    finally:
+        plt.close("all")
+
+
+def _worker_main(conn, memory_mb, cpu_seconds):
+    """工作进程主循环：预先导入 matplotlib，然后逐个处理任务"""
+    os.environ["MPLBACKEND"] = "Agg"
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    _set_memory_limit(memory_mb)
+    if resource is not None:
+        signal.signal(signal.SIGXCPU, _on_sigxcpu)
+    conn.send(("ready", os.getpid()))
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        code, render = job
+        _set_cpu_limit(cpu_seconds)
+        reset = _reset_peak_memory()
+        start = time.perf_counter()
+        try:
+            png, savefig_seconds = _run_job(plt, code, render)
+            conn.send(("ok", png, None, None, time.perf_counter() - start, savefig_seconds, _peak_memory(reset)))
+        except KeyboardInterrupt:
+            raise
+        except BaseException as e:
+            # SystemExit 等也只算作本次任务失败，工作进程继续等待下一个任务
+            conn.send(("error", None, f"{type(e).__name__}: {e}", traceback.format_exc(),
+                       time.perf_counter() - start, 0.0, _peak_memory(reset)))
+
+
+@contextlib.contextmanager
+def _detached_main_module():
+    """
+    启动子进程时临时换掉 __main__。
+    Streamlit 会把 app.py 注册为 __main__，不换掉的话每个工作进程启动时都会重新导入整个应用脚本。
+    """
+    main_module = sys.modules.get("__main__")
+    sys.modules["__main__"] = types.ModuleType("__main__")
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main_module
+
+
+def _mp_context():
+    """优先使用 forkserver：新进程从已经导入 matplotlib 的服务进程 fork，补充进程很快"""
+    methods = multiprocessing.get_all_start_methods()
+    if "forkserver" in methods:
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["numpy", "matplotlib", "matplotlib.pyplot"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+class _Worker:
+    def __init__(self, context, memory_mb, cpu_seconds):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, memory_mb, cpu_seconds), daemon=True
+        )
+        with _detached_main_module():
+            self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.ready = False
+
+    def wait_ready(self, timeout):
+        """等待进程完成预导入，超时返回 False"""
+        if not self.ready:
+            if not self.conn.poll(timeout):
+                return False
+            self.conn.recv()
+            self.ready = True
+        return True
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.kill()
+
+
+class SandboxPool:
+    """预先启动的绘图工作进程池，可以被多个线程同时使用"""
+
+    def __init__(self, workers=None, timeout=DEFAULT_TIMEOUT, memory_mb=DEFAULT_MEMORY_MB,
+                 cpu_seconds=DEFAULT_CPU_SECONDS, startup_timeout=60):
+        if workers is None:
+            workers = int(os.environ.get("SANDBOX_WORKERS", min(4, os.cpu_count() or 1)))
+        self.size = workers
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds
+        self.startup_timeout = startup_timeout
+        self._context = _mp_context()
+        self._idle = queue.Queue()
+        self._closed = False
+        for _ in range(workers):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        return _Worker(self._context, self.memory_mb, self.cpu_seconds)
+
+    def run(self, code, timeout=None, check=True, fast=False, preview=False, figsize=None, **savefig_kwargs):
+        """
+        执行代码并返回 ExecResult，savefig_kwargs（如 dpi）会传给 fig.savefig。
+        check 为 True 时先用 code_check.analyze_code 静态检查，有问题的代码不执行，问题列表放在 traceback 中。
+        fast 为 True 时使用 FAST_RC 渲染；preview 为 True 时把密集的散点和网格抽稀到显示分辨率，
+        用于生成过程中的快速预览；figsize 为 (宽, 高) 英寸时按此尺寸导出。
+        """
+        if check:
+            with metrics.timed("static_check"):
+                findings = analyze_code(code)
+            if findings:
+                metrics.log_event("static_reject", kinds=sorted({finding.kind for finding in findings}))
+                return ExecResult(False, None, f"静态检查未通过，代码没有执行: {findings[0].message}",
+                                  "发现的问题:\n" + format_findings(findings), 0.0)
+        render = {"savefig": savefig_kwargs, "fast": fast, "preview": preview, "figsize": figsize}
+        result = self._run(code, timeout, render)
+        metrics.record_stage("exec", result.elapsed - result.savefig, result.ok)
+        if result.savefig:
+            metrics.record_stage("savefig", result.savefig, preview=preview)
+        return result
+
+    def _run(self, code, timeout, render):
+        if self._closed:
+            raise RuntimeError("沙箱进程池已关闭")
+        timeout = self.timeout if timeout is None else timeout
+        worker = self._idle.get()
+        start = time.perf_counter()
+        try:
+            if not worker.wait_ready(self.startup_timeout):
+                worker.kill()
+                worker = self._spawn()
+                return ExecResult(False, None, "沙箱工作进程启动超时", None, time.perf_counter() - start)
+            worker.conn.send((code, render))
+            if not worker.conn.poll(timeout):
+                worker.kill()
+                worker = self._spawn()
+                return ExecResult(False, None, f"代码执行超时（超过 {timeout:g} 秒）", None,
+                                  time.perf_counter() - start)
+            status, png, error, tb, elapsed, savefig_seconds, peak_memory = worker.conn.recv()
+            worker.jobs += 1
+            return ExecResult(status == "ok", png, error, tb, elapsed, savefig_seconds, peak_memory)
+        except (EOFError, BrokenPipeError, ConnectionResetError, OSError):
+            # 进程被资源限制杀死（例如内存耗尽或 CPU 硬上限）
+            worker.kill()
+            exitcode = worker.process.exitcode
+            worker = self._spawn()
+            return ExecResult(False, None, f"执行代码的进程异常退出（退出码 {exitcode}），可能超出了内存或 CPU 限制",
+                              None, time.perf_counter() - start)
+        finally:
+            if worker.jobs >= MAX_JOBS_PER_WORKER:
+                worker.stop()
+                worker = self._spawn()
+            self._idle.put(worker)
+
+    async def arun(self, code, timeout=None, **options):
+        """run 的协程版本，在线程中等待工作进程，不阻塞事件循环；options 与 run 相同"""
+        loop = asyncio.get_running_loop()
+        # 线程池不会继承 contextvars，手动带上当前上下文，统计事件才能关联到所属请求
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(None, lambda: context.run(self.run, code, timeout, **options))
+
+    def close(self):
+        """停止所有工作进程"""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool():
+    """返回进程内共享的沙箱进程池（按环境变量配置）"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = SandboxPool()
+            atexit.register(_default_pool.close)
+    return _default_pool
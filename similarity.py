@@ -0,0 +1,166 @@
+"""
+原图与复现图的相似度评估，全部用 NumPy 向量化计算，不需要额外的 API 调用。
+
+两张图都先缩放到同样的小尺寸（默认 256×256），再计算三项指标：
+    ssim    灰度图上的结构相似度（7×7 均值窗口，用积分图计算）
+    color   颜色直方图的交集（每个通道 8 个区间，忽略接近白色的背景像素）
+    edges   Sobel 边缘的重合度（F1，允许 1 个像素的偏移）
+综合得分为三者的加权平均，范围 0~1，越高越相似。
+
+    reference = prepare_reference(original_bytes)   # 原图只需处理一次
+    score = compare(reference, png_bytes)
+    if score.score >= DEFAULT_THRESHOLD:
+        ...
+"""
+import io
+from collections import namedtuple
+
+import numpy as np
+
+from history import first_image_bytes
+
+DEFAULT_SIZE = 256
+DEFAULT_THRESHOLD = 0.75
+WEIGHTS = {"ssim": 0.4, "color": 0.3, "edges": 0.3}
+
+SSIM_WINDOW = 7
+SSIM_C1 = 0.01 ** 2
+SSIM_C2 = 0.03 ** 2
+HIST_BINS = 8
+BACKGROUND_LEVEL = 0.94  # 三个通道都高于此值的像素视为白色背景
+EDGE_QUANTILE = 0.9      # 梯度最大的 10% 像素视为边缘
+
+SimilarityScore = namedtuple("SimilarityScore", ["score", "ssim", "color", "edges"])
+
+# 预处理后的图像：rgb 为 [0, 1] 的浮点数组，gray 为灰度图，edges 为边缘掩码
+Prepared = namedtuple("Prepared", ["rgb", "gray", "edges"])
+
+
+def load_image(data, size=DEFAULT_SIZE):
+    """把图片字节解码为 size×size 的 RGB 浮点数组，透明部分按白色背景合成"""
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    image = image.convert("RGB").resize((size, size), Image.BILINEAR)
+    return np.asarray(image, dtype=np.float32) / 255.0
+
+
+def _box_mean(x, window):
+    """用积分图计算每个像素周围 window×window 区域的均值（valid 区域）"""
+    padded = np.pad(x, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    total = (padded[window:, window:] - padded[:-window, window:]
+             - padded[window:, :-window] + padded[:-window, :-window])
+    return total / (window * window)
+
+
+def ssim(a, b, window=SSIM_WINDOW):
+    """两张灰度图的平均 SSIM"""
+    mu_a = _box_mean(a, window)
+    mu_b = _box_mean(b, window)
+    var_a = _box_mean(a * a, window) - mu_a * mu_a
+    var_b = _box_mean(b * b, window) - mu_b * mu_b
+    cov = _box_mean(a * b, window) - mu_a * mu_b
+    numerator = (2 * mu_a * mu_b + SSIM_C1) * (2 * cov + SSIM_C2)
+    denominator = (mu_a * mu_a + mu_b * mu_b + SSIM_C1) * (var_a + var_b + SSIM_C2)
+    return float(np.mean(numerator / denominator))
+
+
+def color_histogram(rgb, bins=HIST_BINS):
+    """非背景像素的归一化三维颜色直方图；整张图都是背景时返回 None"""
+    pixels = rgb.reshape(-1, 3)
+    pixels = pixels[~np.all(pixels > BACKGROUND_LEVEL, axis=1)]
+    if len(pixels) == 0:
+        return None
+    index = np.minimum((pixels * bins).astype(np.int64), bins - 1)
+    flat = (index[:, 0] * bins + index[:, 1]) * bins + index[:, 2]
+    hist = np.bincount(flat, minlength=bins ** 3).astype(np.float64)
+    return hist / hist.sum()
+
+
+def color_similarity(hist_a, hist_b):
+    """直方图交集，两张图都只有背景时视为完全相同"""
+    if hist_a is None or hist_b is None:
+        return 1.0 if hist_a is None and hist_b is None else 0.0
+    return float(np.minimum(hist_a, hist_b).sum())
+
+
+def edge_map(gray, quantile=EDGE_QUANTILE):
+    """Sobel 梯度幅值大于分位数阈值的像素"""
+    padded = np.pad(gray, 1, mode="edge")
+    gx = (padded[:-2, 2:] + 2 * padded[1:-1, 2:] + padded[2:, 2:]
+          - padded[:-2, :-2] - 2 * padded[1:-1, :-2] - padded[2:, :-2])
+    gy = (padded[2:, :-2] + 2 * padded[2:, 1:-1] + padded[2:, 2:]
+          - padded[:-2, :-2] - 2 * padded[:-2, 1:-1] - padded[:-2, 2:])
+    magnitude = np.hypot(gx, gy)
+    threshold = np.quantile(magnitude, quantile)
+    if threshold <= 0:
+        return magnitude > 0
+    return magnitude > threshold
+
+
+def _dilate(mask):
+    """3×3 膨胀"""
+    padded = np.pad(mask, 1)
+    h, w = mask.shape
+    out = np.zeros_like(mask)
+    for dy in range(3):
+        for dx in range(3):
+            out |= padded[dy:dy + h, dx:dx + w]
+    return out
+
+
+def edge_similarity(edges_a, edges_b):
+    """允许 1 个像素偏移的边缘 F1"""
+    count_a = edges_a.sum()
+    count_b = edges_b.sum()
+    if count_a == 0 or count_b == 0:
+        return 1.0 if count_a == count_b else 0.0
+    precision = (edges_b & _dilate(edges_a)).sum() / count_b
+    recall = (edges_a & _dilate(edges_b)).sum() / count_a
+    if precision + recall == 0:
+        return 0.0
+    return float(2 * precision * recall / (precision + recall))
+
+
+def prepare(data, size=DEFAULT_SIZE):
+    """预先计算一张图用于比较的各项数据"""
+    rgb = load_image(data, size)
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    return Prepared(rgb, gray, edge_map(gray))
+
+
+def prepare_reference(data, size=DEFAULT_SIZE):
+    """预处理原图；同一张原图与多个候选比较时只需调用一次"""
+    return prepare(data, size)
+
+
+def compare(reference, data, weights=WEIGHTS):
+    """比较预处理过的原图和复现图的 PNG 字节，返回 SimilarityScore"""
+    candidate = prepare(data, reference.rgb.shape[0])
+    parts = {
+        "ssim": max(0.0, ssim(reference.gray, candidate.gray)),
+        "color": color_similarity(color_histogram(reference.rgb), color_histogram(candidate.rgb)),
+        "edges": edge_similarity(reference.edges, candidate.edges),
+    }
+    score = sum(weights[key] * parts[key] for key in parts) / sum(weights.values())
+    return SimilarityScore(score, parts["ssim"], parts["color"], parts["edges"])
+
+
+def compare_images(original, recreated, size=DEFAULT_SIZE):
+    """直接比较两张图片的字节"""
+    return compare(prepare_reference(original, size), recreated)
+
+
+def reference_from_messages(messages, size=DEFAULT_SIZE):
+    """从对话中第一张 base64 图片（即上传的原图）构造比较基准，没有图片时返回 None"""
+    data = first_image_bytes(messages)
+    return prepare_reference(data, size) if data is not None else None
+
+
+def format_score(score):
+    return (f"{score.score:.2f}（结构 {score.ssim:.2f}，颜色 {score.color:.2f}，"
+            f"边缘 {score.edges:.2f}）")
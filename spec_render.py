@@ -0,0 +1,485 @@
+"""
+数据规格模式：模型只返回描述图表的 JSON（图表类型、坐标轴、各系列的数值数组、颜色和样式），
+由本地的渲染器确定性地画出图像，不执行模型写的代码。
+
+输出比完整的绘图脚本短得多（通常只有几百个 token），同一份规格每次画出的图完全相同，
+提取出的数据也可以直接拿去复用。
+
+规格示例（字段说明见 prompts.prompt_spec）:
+    {"size": [8, 5], "axes": [{"title": "温度", "xlabel": "月份", "series": [
+        {"type": "line", "x": {"start": 1, "stop": 12, "num": 12}, "y": [3, 5, 9, 15, 20, 24, 27, 26, 21, 15, 8, 4],
+         "color": "#d62728", "marker": "o", "label": "北京"}]}]}
+
+规格先被校验并转换为一串绘图操作（ax.plot(...)、ax.set_title(...) 等），同一串操作有两种用法:
+    render_spec(spec)   直接在 matplotlib 的 Figure 上执行这些操作，得到 PNG 字节（不经过 exec）
+    spec_to_code(spec)  把这些操作写成一段独立的 Python 脚本，可以在沙箱中执行、保存和复用
+两者画出的图一致。
+
+    spec = parse_spec(reply_text)      # 规格有问题时抛出 SpecError，错误信息可以直接发回模型
+    png = render_spec(spec)
+    code = spec_to_code(spec)
+
+命令行:
+    python spec_render.py spec.json -o figure.png [--code figure.py]
+"""
+import argparse
+import io
+import json
+import math
+import re
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+MAX_POINTS = 200000    # 所有系列的数据点总数上限
+MAX_AXES = 16
+MAX_LINSPACE = 10000   # {"start", "stop", "num"} 的 num 上限
+DEFAULT_SIZE = (8.0, 5.0)
+DEFAULT_DPI = 100
+SCALES = ("linear", "log", "symlog", "logit")
+
+# 各系列类型必需的数组字段
+SERIES_TYPES = {
+    "line": ("x", "y"),
+    "scatter": ("x", "y"),
+    "bar": ("x", "y"),
+    "barh": ("x", "y"),
+    "area": ("x", "y"),
+    "step": ("x", "y"),
+    "errorbar": ("x", "y"),
+    "heatmap": ("z",),
+    "pie": ("values",),
+    "hline": (),
+    "vline": (),
+    "text": (),
+}
+
+# 原样传给 matplotlib 的样式字段: 规格中的名字 → 关键字参数
+_STYLE_KEYS = {
+    "color": "color", "linestyle": "linestyle", "linewidth": "linewidth", "marker": "marker",
+    "markersize": "markersize", "alpha": "alpha", "label": "label", "zorder": "zorder",
+}
+
+_render_lock = threading.Lock()
+
+# 一个绘图操作：target 为 "fig" 或子图序号；result 为保存返回值的变量名（如颜色条要用到的 imshow 结果）
+Op = namedtuple("Op", ["target", "method", "args", "kwargs", "result"], defaults=(None,))
+
+
+class SpecError(ValueError):
+    """规格无法解析或不符合要求，message 说明出错的位置，可以直接发回模型修正"""
+
+
+class _Array:
+    """数值数组：values 用于直接绘图，source 为写进脚本时的源码"""
+
+    def __init__(self, values, source):
+        self.values = values
+        self.source = source
+
+
+class _Ref:
+    """引用前面某个操作保存的返回值"""
+
+    def __init__(self, name):
+        self.name = name
+
+
+def extract_json(text):
+    """从模型回复中取出 JSON 对象的文本（允许包在 ```json 代码块里或前后带少量文字）"""
+    fenced = re.search(r"```(?:json)?\s*\n(.*?)```", text, re.S)
+    if fenced:
+        text = fenced.group(1)
+    start = text.find("{")
+    end = text.rfind("}")
+    if start < 0 or end < start:
+        raise SpecError("回复中没有 JSON 对象")
+    return text[start:end + 1]
+
+
+def _reject_constant(name):
+    raise SpecError(f"规格中不能有 {name}，缺失值请用 null")
+
+
+def parse_spec(text):
+    """解析并校验模型回复中的规格，返回规格字典"""
+    try:
+        # json.loads 默认接受 Infinity / NaN，写进生成的脚本后会变成未定义的名字 inf / nan
+        spec = json.loads(extract_json(text), parse_constant=_reject_constant)
+    except json.JSONDecodeError as e:
+        raise SpecError(f"JSON 格式错误（第 {e.lineno} 行第 {e.colno} 列）: {e.msg}") from None
+    if not isinstance(spec, dict):
+        raise SpecError("规格的最外层应该是一个对象")
+    build_ops(spec)
+    return spec
+
+
+def _number_source(value):
+    if value != value:
+        return "np.nan"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _numbers(value, path, budget):
+    """数值数组或 {"start", "stop", "num"} 等间距数组，null 视为缺失值（NaN）"""
+    if isinstance(value, dict):
+        try:
+            start, stop, num = float(value["start"]), float(value["stop"]), int(value["num"])
+        except (KeyError, TypeError, ValueError):
+            raise SpecError(f"{path} 应为数值数组或 {{\"start\", \"stop\", \"num\"}}") from None
+        if not (math.isfinite(start) and math.isfinite(stop)):
+            raise SpecError(f"{path} 的 start 和 stop 应为有限的数值")
+        if not 1 <= num <= MAX_LINSPACE:
+            raise SpecError(f"{path}.num 应在 1 到 {MAX_LINSPACE} 之间")
+        budget[0] += num
+        source = f"np.linspace({_number_source(start)}, {_number_source(stop)}, {num})"
+        return _Array(np.linspace(start, stop, num), source)
+    if not isinstance(value, list) or not value:
+        raise SpecError(f"{path} 应为非空的数值数组")
+    if any(isinstance(item, (bool, str, list, dict)) for item in value):
+        raise SpecError(f"{path} 中只能有数字或 null")
+    if any(item is not None and not math.isfinite(item) for item in value):
+        raise SpecError(f"{path} 中只能有有限的数值，缺失值请用 null")
+    budget[0] += len(value)
+    values = np.array([np.nan if item is None else item for item in value], dtype=float)
+    return _Array(values, "[" + ", ".join(_number_source(item) for item in values.tolist()) + "]")
+
+
+def _labels(value, path):
+    if not isinstance(value, list) or not all(isinstance(item, (str, int, float)) for item in value):
+        raise SpecError(f"{path} 应为字符串数组")
+    return [str(item) for item in value]
+
+
+def _positions(value, path, budget):
+    """柱状图的位置：数值数组或类别名数组"""
+    if isinstance(value, list) and value and all(isinstance(item, str) for item in value):
+        budget[0] += len(value)
+        return list(value)
+    return _numbers(value, path, budget)
+
+
+def _length(values):
+    return len(values.values) if isinstance(values, _Array) else len(values)
+
+
+def _check_same_length(series, path, names, arrays):
+    lengths = {name: _length(arrays[name]) for name in names if name in arrays}
+    if len(set(lengths.values())) > 1:
+        detail = "，".join(f"{name} 有 {n} 个" for name, n in lengths.items())
+        raise SpecError(f"{path} 中各数组的长度不一致（{detail}）")
+
+
+def _style(series):
+    return {key: series[name] for name, key in _STYLE_KEYS.items() if series.get(name) is not None}
+
+
+def _series_ops(index, series, path, budget, counter):
+    """一个系列对应的绘图操作"""
+    if not isinstance(series, dict):
+        raise SpecError(f"{path} 应为对象")
+    kind = series.get("type")
+    if kind not in SERIES_TYPES:
+        raise SpecError(f"{path}.type 不支持 {kind!r}，可选: {', '.join(SERIES_TYPES)}")
+    for name in SERIES_TYPES[kind]:
+        if name not in series:
+            raise SpecError(f"{path} 缺少 {name}")
+    style = _style(series)
+
+    if kind in ("bar", "barh"):
+        arrays = {"x": _positions(series["x"], f"{path}.x", budget), "y": _numbers(series["y"], f"{path}.y", budget)}
+        if "bottom" in series:
+            arrays["bottom"] = _numbers(series["bottom"], f"{path}.bottom", budget)
+        _check_same_length(series, path, ("x", "y", "bottom"), arrays)
+        kwargs = dict(style)
+        if isinstance(series.get("color"), list):
+            kwargs["color"] = _labels(series["color"], f"{path}.color")
+        if series.get("width") is not None:
+            kwargs["width" if kind == "bar" else "height"] = series["width"]
+        if "bottom" in arrays:
+            kwargs["bottom" if kind == "bar" else "left"] = arrays["bottom"]
+        kwargs.pop("marker", None)
+        return [Op(index, kind, (arrays["x"], arrays["y"]), kwargs)]
+
+    if kind == "heatmap":
+        z = series["z"]
+        if not isinstance(z, list) or not z or not all(isinstance(row, list) for row in z):
+            raise SpecError(f"{path}.z 应为二维数值数组")
+        rows = [_numbers(row, f"{path}.z[{i}]", budget) for i, row in enumerate(z)]
+        if len({len(row.values) for row in rows}) > 1:
+            raise SpecError(f"{path}.z 各行的长度不一致")
+        values = np.vstack([row.values for row in rows])
+        source = "np.array([\n    " + ",\n    ".join(row.source for row in rows) + ",\n])"
+        kwargs = {"aspect": "auto", "origin": series.get("origin", "lower")}
+        for name in ("cmap", "vmin", "vmax", "alpha"):
+            if series.get(name) is not None:
+                kwargs[name] = series[name]
+        if series.get("extent") is not None:
+            extent = series["extent"]
+            if not isinstance(extent, list) or len(extent) != 4:
+                raise SpecError(f"{path}.extent 应为 [x0, x1, y0, y1]")
+            kwargs["extent"] = extent
+        counter[0] += 1
+        name = f"image{counter[0]}"
+        ops = [Op(index, "imshow", (_Array(values, source),), kwargs, name)]
+        if series.get("colorbar", True):
+            colorbar = {"ax": _Ref(f"axes.flat[{index}]")}
+            if series.get("colorbar_label"):
+                colorbar["label"] = series["colorbar_label"]
+            ops.append(Op("fig", "colorbar", (_Ref(name),), colorbar))
+        return ops
+
+    if kind == "pie":
+        values = _numbers(series["values"], f"{path}.values", budget)
+        kwargs = {}
+        if series.get("labels") is not None:
+            kwargs["labels"] = _labels(series["labels"], f"{path}.labels")
+            if len(kwargs["labels"]) != len(values.values):
+                raise SpecError(f"{path}.labels 与 values 的长度不一致")
+        if series.get("colors") is not None:
+            kwargs["colors"] = _labels(series["colors"], f"{path}.colors")
+        if series.get("percent"):
+            kwargs["autopct"] = "%1.1f%%"
+        if series.get("startangle") is not None:
+            kwargs["startangle"] = series["startangle"]
+        return [Op(index, "pie", (values,), kwargs), Op(index, "set_aspect", ("equal",), {})]
+
+    if kind in ("hline", "vline"):
+        key = "y" if kind == "hline" else "x"
+        if not isinstance(series.get(key), (int, float)) or isinstance(series.get(key), bool):
+            raise SpecError(f"{path}.{key} 应为数字")
+        style.pop("marker", None)
+        return [Op(index, "axhline" if kind == "hline" else "axvline", (series[key],), style)]
+
+    if kind == "text":
+        if not all(isinstance(series.get(key), (int, float)) for key in ("x", "y")) or "text" not in series:
+            raise SpecError(f"{path} 需要数字 x、y 和文字 text")
+        kwargs = {key: series[key] for key in ("color", "fontsize", "ha", "va", "rotation") if series.get(key) is not None}
+        return [Op(index, "text", (series["x"], series["y"], str(series["text"])), kwargs)]
+
+    arrays = {"x": _numbers(series["x"], f"{path}.x", budget), "y": _numbers(series["y"], f"{path}.y", budget)}
+    for name in ("y2", "yerr", "xerr", "size"):
+        if isinstance(series.get(name), (list, dict)):
+            arrays[name] = _numbers(series[name], f"{path}.{name}", budget)
+    _check_same_length(series, path, ("x", "y", "y2", "yerr", "xerr", "size"), arrays)
+    x, y = arrays["x"], arrays["y"]
+
+    if kind == "scatter":
+        kwargs = dict(style)
+        size = arrays.get("size", series.get("size"))
+        if size is not None:
+            kwargs["s"] = size
+        for name in ("linestyle", "linewidth", "markersize"):
+            kwargs.pop(name, None)
+        if isinstance(series.get("color"), list):
+            kwargs["color"] = _labels(series["color"], f"{path}.color")
+        return [Op(index, "scatter", (x, y), kwargs)]
+    if kind == "area":
+        y2 = arrays.get("y2", series.get("y2", 0))
+        kwargs = {key: value for key, value in style.items() if key not in ("marker", "markersize")}
+        kwargs.setdefault("alpha", 0.4)
+        return [Op(index, "fill_between", (x, y, y2), kwargs)]
+    if kind == "step":
+        return [Op(index, "step", (x, y), dict(style, where=series.get("where", "mid")))]
+    if kind == "errorbar":
+        kwargs = dict(style)
+        for name in ("yerr", "xerr"):
+            if name in arrays:
+                kwargs[name] = arrays[name]
+            elif isinstance(series.get(name), (int, float)):
+                kwargs[name] = series[name]
+        kwargs["capsize"] = series.get("capsize", 3)
+        return [Op(index, "errorbar", (x, y), kwargs)]
+    return [Op(index, "plot", (x, y), style)]
+
+
+def _axis_ops(index, axis, path, budget, counter):
+    if not isinstance(axis, dict):
+        raise SpecError(f"{path} 应为对象")
+    series = axis.get("series", [])
+    if not isinstance(series, list):
+        raise SpecError(f"{path}.series 应为数组")
+    ops = []
+    for i, item in enumerate(series):
+        ops.extend(_series_ops(index, item, f"{path}.series[{i}]", budget, counter))
+    for name in ("title", "xlabel", "ylabel"):
+        if axis.get(name):
+            ops.append(Op(index, f"set_{name}", (str(axis[name]),), {}))
+    for name in ("xscale", "yscale"):
+        if axis.get(name):
+            if axis[name] not in SCALES:
+                raise SpecError(f"{path}.{name} 只能是 {', '.join(SCALES)}")
+            ops.append(Op(index, f"set_{name}", (axis[name],), {}))
+    for name in ("xlim", "ylim"):
+        value = axis.get(name)
+        if value is not None:
+            if (not isinstance(value, list) or len(value) != 2
+                    or not all(item is None or isinstance(item, (int, float)) for item in value)):
+                raise SpecError(f"{path}.{name} 应为 [最小值, 最大值]")
+            ops.append(Op(index, f"set_{name}", tuple(value), {}))
+    for name in ("xticks", "yticks"):
+        if axis.get(name) is not None:
+            ticks = _numbers(axis[name], f"{path}.{name}", budget)
+            labels = axis.get(f"{name[0]}ticklabels")
+            if labels is not None:
+                labels = _labels(labels, f"{path}.{name[0]}ticklabels")
+                if len(labels) != len(ticks.values):
+                    raise SpecError(f"{path}.{name[0]}ticklabels 与 {name} 的长度不一致")
+                ops.append(Op(index, f"set_{name}", (ticks, labels), {}))
+            else:
+                ops.append(Op(index, f"set_{name}", (ticks,), {}))
+    if axis.get("grid"):
+        ops.append(Op(index, "grid", (True,), {"alpha": 0.3}))
+    legend = axis.get("legend")
+    if legend is None:
+        legend = any(isinstance(item, dict) and item.get("label") for item in series)
+    if legend:
+        ops.append(Op(index, "legend", (), {"loc": legend if isinstance(legend, str) else "best"}))
+    return ops
+
+
+def build_ops(spec):
+    """
+    校验规格并转换为绘图操作。
+    返回 (rows, cols, size, ops)：子图网格的行列数、画布尺寸（英寸）和按顺序执行的 Op 列表。
+    """
+    axes = spec.get("axes")
+    if axes is None:
+        # 只有一个子图时允许省略 axes，把子图的字段直接写在最外层
+        axes = [{key: value for key, value in spec.items() if key not in ("size", "layout", "title")}]
+    if not isinstance(axes, list) or not axes:
+        raise SpecError("axes 应为非空数组")
+    if len(axes) > MAX_AXES:
+        raise SpecError(f"子图不能超过 {MAX_AXES} 个")
+
+    layout = spec.get("layout") or [1, len(axes)]
+    if (not isinstance(layout, list) or len(layout) != 2 or not all(isinstance(n, int) and n > 0 for n in layout)
+            or layout[0] * layout[1] < len(axes)):
+        raise SpecError(f"layout 应为 [行数, 列数]，且能放下 {len(axes)} 个子图")
+    size = spec.get("size") or list(DEFAULT_SIZE)
+    if not isinstance(size, list) or len(size) != 2 or not all(isinstance(n, (int, float)) and 0 < n <= 40 for n in size):
+        raise SpecError("size 应为 [宽, 高]（英寸）")
+
+    budget = [0]
+    counter = [0]
+    ops = []
+    for index, axis in enumerate(axes):
+        ops.extend(_axis_ops(index, axis, f"axes[{index}]", budget, counter))
+    if budget[0] > MAX_POINTS:
+        raise SpecError(f"数据点总数 {budget[0]} 超过上限 {MAX_POINTS}")
+    for index in range(len(axes), layout[0] * layout[1]):
+        ops.append(Op(index, "remove", (), {}))
+    if spec.get("title"):
+        ops.append(Op("fig", "suptitle", (str(spec["title"]),), {}))
+    return layout[0], layout[1], (float(size[0]), float(size[1])), ops
+
+
+def _resolve(value, axes, results):
+    if isinstance(value, _Array):
+        return value.values
+    if isinstance(value, _Ref):
+        if value.name.startswith("axes.flat["):
+            return axes.flat[int(value.name[len("axes.flat["):-1])]
+        return results[value.name]
+    return value
+
+
+def draw(fig, spec):
+    """在 matplotlib 的 Figure 上按规格作图（不经过 pyplot，也不执行任何代码字符串）"""
+    rows, cols, _, ops = build_ops(spec)
+    axes = fig.subplots(rows, cols, squeeze=False)
+    results = {}
+    for op in ops:
+        target = fig if op.target == "fig" else axes.flat[op.target]
+        args = [_resolve(value, axes, results) for value in op.args]
+        kwargs = {key: _resolve(value, axes, results) for key, value in op.kwargs.items()}
+        try:
+            value = getattr(target, op.method)(*args, **kwargs)
+        except (TypeError, ValueError) as e:
+            where = "整张图" if op.target == "fig" else f"axes[{op.target}]"
+            raise SpecError(f"{where} 的 {op.method} 出错: {e}") from None
+        if op.result:
+            results[op.result] = value
+    if not any(op.method == "colorbar" for op in ops):
+        fig.tight_layout()
+    return fig
+
+
+def render_spec(spec, dpi=DEFAULT_DPI, size=None):
+    """按规格渲染为 PNG 字节；size 为 (宽, 高) 英寸时覆盖规格中的尺寸。可以在多个线程中调用"""
+    from matplotlib.figure import Figure
+
+    _, _, spec_size, _ = build_ops(spec)
+    # matplotlib 不保证线程安全，同时渲染的多个候选逐个进行
+    with _render_lock:
+        fig = Figure(figsize=size or spec_size)
+        draw(fig, spec)
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=dpi)
+    return buffer.getvalue()
+
+
+def _source(value):
+    if isinstance(value, _Array):
+        return value.source
+    if isinstance(value, _Ref):
+        return value.name
+    return repr(value)
+
+
+def spec_to_code(spec):
+    """把规格写成一段独立的 matplotlib 脚本，执行后得到与 render_spec 相同的图"""
+    rows, cols, size, ops = build_ops(spec)
+    lines = [
+        "# 由数据规格生成（见 spec_render.py），修改下面的数据后可以直接重新运行",
+        "import matplotlib.pyplot as plt",
+        "import numpy as np",
+        "",
+        f"fig, axes = plt.subplots({rows}, {cols}, figsize=({size[0]:g}, {size[1]:g}), squeeze=False)",
+    ]
+    current = None
+    for op in ops:
+        if op.target == "fig":
+            target = "fig"
+        else:
+            if op.target != current:
+                lines.extend(["", f"ax = axes.flat[{op.target}]"])
+                current = op.target
+            target = "ax"
+        arguments = [_source(value) for value in op.args]
+        arguments += [f"{key}={_source(value)}" for key, value in op.kwargs.items()]
+        call = f"{target}.{op.method}({', '.join(arguments)})"
+        lines.append(f"{op.result} = {call}" if op.result else call)
+    if not any(op.method == "colorbar" for op in ops):
+        lines.append("fig.tight_layout()")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把数据规格 JSON 渲染为图片或绘图脚本")
+    parser.add_argument("spec", help="规格文件（JSON，也可以是包含 JSON 的模型回复）")
+    parser.add_argument("-o", "--output", help="输出的 PNG 路径")
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI)
+    parser.add_argument("--code", help="同时把规格写成 Python 脚本")
+    args = parser.parse_args()
+
+    with open(args.spec, "r", encoding="utf-8") as f:
+        try:
+            spec = parse_spec(f.read())
+        except SpecError as e:
+            parser.exit(1, f"规格无效: {e}\n")
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(render_spec(spec, dpi=args.dpi))
+        print(f"图片已保存到: {args.output}")
+    if args.code:
+        with open(args.code, "w", encoding="utf-8") as f:
+            f.write(spec_to_code(spec))
+        print(f"脚本已保存到: {args.code}")
+
+
+if __name__ == "__main__":
+    main()
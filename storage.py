@@ -0,0 +1,172 @@
+"""
+生成结果的可选持久化。
+
+上传的图片和生成的 PNG 都只在内存中处理，只有最终采用的结果（代码、文档、对话和图像，格式见 artifacts.py）才会保存，
+保存操作在后台线程中完成，不阻塞页面渲染。保存位置由环境变量 FIGURE_STORAGE 决定:
+    未设置          保存到当前工作目录（与之前的行为一致）
+    none            不保存
+    目录路径         保存到该目录
+    s3://桶/前缀     保存到 S3 兼容的对象存储（需要安装 boto3，可用 AWS_ENDPOINT_URL 指定其他服务）
+
+    persister = get_default_persister()
+    if persister is not None:
+        future = persister.save_run(name, code, doc, messages, figure=png_bytes)
+"""
+import atexit
+import contextvars
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+STORAGE_WORKERS = 2
+
+
+class LocalStorage:
+    """保存到本地目录，先写临时文件再替换，并发写同名文件也不会得到不完整的文件"""
+
+    def __init__(self, root="."):
+        self.root = root
+
+    def location(self, name):
+        return os.path.join(self.root, name)
+
+    def write(self, name, data):
+        path = self.location(name)
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o644)  # mkstemp 创建的文件只有所有者可读
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return path
+
+    def touch(self, name):
+        """文件存在时把修改时间更新为现在并返回 True，不存在时返回 False"""
+        try:
+            os.utime(self.location(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def read(self, name):
+        with open(self.location(name), "rb") as f:
+            return f.read()
+
+    def list(self, prefix):
+        """列出 prefix 目录下的文件名（相对于存储根目录，不递归）"""
+        directory = self.location(prefix)
+        if not os.path.isdir(directory):
+            return []
+        return [f"{prefix}/{entry}" for entry in sorted(os.listdir(directory))
+                if not entry.startswith(".tmp_")]
+
+
+class S3Storage:
+    """保存到 S3 兼容的对象存储"""
+
+    def __init__(self, url):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("保存到对象存储需要安装 boto3: pip install boto3")
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self._client = boto3.client("s3", endpoint_url=os.environ.get("AWS_ENDPOINT_URL") or None)
+
+    def _key(self, name):
+        return f"{self.prefix}/{name}" if self.prefix else name
+
+    def location(self, name):
+        return f"s3://{self.bucket}/{self._key(name)}"
+
+    def write(self, name, data):
+        self._client.put_object(Bucket=self.bucket, Key=self._key(name), Body=data)
+        return self.location(name)
+
+    def touch(self, name):
+        """对象是否存在（只有本地存储目录会被 resources.collect_garbage 清理，不需要刷新时间）"""
+        from botocore.exceptions import ClientError
+
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=self._key(name))
+        except ClientError:
+            return False
+        return True
+
+    def read(self, name):
+        return self._client.get_object(Bucket=self.bucket, Key=self._key(name))["Body"].read()
+
+    def list(self, prefix):
+        """列出 prefix 下的对象名（相对于前缀，不递归）"""
+        root = self._key(prefix) + "/"
+        names = []
+        paginator = self._client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=root, Delimiter="/"):
+            for item in page.get("Contents", []):
+                names.append(f"{prefix}/{item['Key'][len(root):]}")
+        return sorted(names)
+
+
+class Persister:
+    """在后台线程池中写入存储，save_run 立即返回 Future"""
+
+    def __init__(self, backend, workers=STORAGE_WORKERS):
+        self.backend = backend
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="storage")
+
+    def location(self, name):
+        return self.backend.location(name)
+
+    def _write_run(self, name, code, doc, messages, figure, meta):
+        from artifacts import write_run
+
+        with metrics.timed("persist", name=name, kind="run"):
+            return write_run(self.backend, name, code, doc, messages, figure=figure, **meta)
+
+    def save_run(self, name, code, doc, messages, figure=None, **meta):
+        """按 artifacts.py 的紧凑格式保存一次生成的结果，Future 的结果为清单位置"""
+        # 带上当前的 contextvars，保存耗时才能关联到所属请求
+        context = contextvars.copy_context()
+        return self._executor.submit(context.run, self._write_run, name, code, doc, messages, figure, meta)
+
+    def close(self):
+        """等待所有保存完成"""
+        self._executor.shutdown(wait=True)
+
+
+def make_backend(spec):
+    """按 FIGURE_STORAGE 的写法创建存储，none 时返回 None"""
+    if spec is None:
+        return LocalStorage(".")
+    if spec.strip().lower() == "none":
+        return None
+    if spec.startswith("s3://"):
+        return S3Storage(spec)
+    return LocalStorage(spec)
+
+
+_default_persister = None
+_default_lock = threading.Lock()
+_default_created = False
+
+
+def get_default_persister():
+    """返回进程内共享的 Persister（按环境变量配置），不保存时返回 None"""
+    global _default_persister, _default_created
+    with _default_lock:
+        if not _default_created:
+            backend = make_backend(os.environ.get("FIGURE_STORAGE"))
+            if backend is not None:
+                _default_persister = Persister(backend)
+                atexit.register(_default_persister.close)
+            _default_created = True
+    return _default_persister
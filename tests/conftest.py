@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("CLAUDE_CACHE_DISABLE", "1")
+os.environ.setdefault("METRICS_DISABLE", "1")
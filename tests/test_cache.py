@@ -0,0 +1,110 @@
+import os
+import time
+from types import SimpleNamespace
+
+import cache
+from cache import CachedRequest, CachedTextBlock, ResponseCache, make_cache_key
+
+
+def image_message(data, text="画出这张图"):
+    return [{
+        "role": "user",
+        "content": [
+            {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": data}},
+            {"type": "text", "text": text},
+        ],
+    }]
+
+
+def reply(text):
+    return [CachedTextBlock("text", text)]
+
+
+def test_cache_key_depends_on_request():
+    messages = image_message("aGVsbG8=")
+    key = make_cache_key(messages, "model-a", 1000)
+    assert key == make_cache_key(image_message("aGVsbG8="), "model-a", 1000)
+    assert key != make_cache_key(messages, "model-b", 1000)
+    assert key != make_cache_key(messages, "model-a", 2000)
+    assert key != make_cache_key(image_message("aGVsbG8h"), "model-a", 1000)
+    assert key != make_cache_key(image_message("aGVsbG8=", "另一个提示词"), "model-a", 1000)
+
+
+def test_cache_key_ignores_cache_control():
+    messages = image_message("aGVsbG8=")
+    marked = image_message("aGVsbG8=")
+    marked[0]["content"][1]["cache_control"] = {"type": "ephemeral"}
+    assert make_cache_key(messages, "m", 1) == make_cache_key(marked, "m", 1)
+
+
+def test_put_and_get(tmp_path):
+    responses = ResponseCache(str(tmp_path))
+    assert responses.get("k") is None
+    responses.put("k", reply("代码"), model="m", usage={"input_tokens": 1, "output_tokens": 2})
+    assert responses.get("k") == reply("代码")
+    responses.discard("k")
+    assert responses.get("k") is None
+
+
+def test_expired_entry_is_removed(tmp_path):
+    responses = ResponseCache(str(tmp_path), ttl=60)
+    responses.put("k", reply("代码"))
+    path = tmp_path / "k.json"
+    written = time.time() - 120
+    os.utime(path, (written, written))
+    assert responses.get("k") is None
+    assert not path.exists()
+
+
+def test_hit_keeps_write_time(tmp_path):
+    # 命中只更新访问时间，TTL 仍从写入时算起
+    responses = ResponseCache(str(tmp_path), ttl=60)
+    responses.put("k", reply("代码"))
+    path = tmp_path / "k.json"
+    written = time.time() - 50
+    os.utime(path, (written, written))
+    assert responses.get("k") is not None
+    assert os.stat(path).st_mtime == written
+    assert os.stat(path).st_atime > written
+
+
+def test_evict_least_recently_used(tmp_path):
+    responses = ResponseCache(str(tmp_path), max_bytes=10 ** 6)
+    for i, key in enumerate(["old", "used", "new"]):
+        responses.put(key, reply("x" * 1000))
+        stamp = time.time() - 100 + i
+        os.utime(tmp_path / f"{key}.json", (stamp, stamp))
+    responses.get("used")
+    responses.max_bytes = os.path.getsize(tmp_path / "new.json") + os.path.getsize(tmp_path / "used.json")
+    responses.evict()
+    assert sorted(os.listdir(tmp_path)) == ["new.json", "used.json"]
+
+
+def test_put_scans_directory_only_when_due(tmp_path, monkeypatch):
+    responses = ResponseCache(str(tmp_path))
+    scans = []
+    evict = responses.evict
+    monkeypatch.setattr(responses, "evict", lambda: scans.append(1) or evict())
+    for i in range(2 * cache.EVICT_EVERY + 1):
+        responses.put(f"k{i}", reply("代码"))
+    assert len(scans) == 3
+
+
+def test_cached_request(tmp_path, monkeypatch):
+    monkeypatch.setenv("CLAUDE_CACHE_DISABLE", "0")
+    monkeypatch.setattr(cache, "_default_cache", ResponseCache(str(tmp_path)))
+    messages = image_message("aGVsbG8=")
+    response = SimpleNamespace(content=reply("代码"), usage=SimpleNamespace(input_tokens=10, output_tokens=5))
+
+    request = CachedRequest(messages, "m", 100)
+    assert request.get() is None
+    request.put(response)
+    assert CachedRequest(messages, "m", 100).get() == reply("代码")
+    assert CachedRequest(messages, "m", 100, use_cache=False).get() is None
+    CachedRequest(messages, "m", 100).discard()
+    assert request.get() is None
+
+    monkeypatch.setenv("CLAUDE_CACHE_DISABLE", "1")
+    request = CachedRequest(messages, "m", 100)
+    request.put(response)
+    assert request.get() is None
@@ -0,0 +1,72 @@
+import pytest
+
+from code_check import analyze_code, find_partial_syntax_error, format_findings
+
+CLEAN = """
+import numpy as np
+import matplotlib.pyplot as plt
+
+x = np.linspace(0, 10, 200)
+fig, ax = plt.subplots(figsize=(8, 5))
+for i in range(3):
+    ax.plot(x, np.sin(x + i), label=f"sin {i}")
+ax.legend()
+fig.tight_layout()
+"""
+
+
+def kinds(code):
+    return [finding.kind for finding in analyze_code(code)]
+
+
+def test_clean_code_passes():
+    assert analyze_code(CLEAN) == []
+
+
+def test_sandbox_provides_plt():
+    assert kinds("plt.plot([1, 2], [3, 4])") == []
+
+
+@pytest.mark.parametrize("code, kind", [
+    ("import matplotlib.pyplot as plt\nplt.plot([1])\nplt.show()", "forbidden_call"),
+    ("import matplotlib\nmatplotlib.use('TkAgg')", "forbidden_call"),
+    ("import os\nos.system('ls')", "forbidden_call"),
+    ("import subprocess\nsubprocess.run(['ls'])", "disallowed_import"),
+    ("from urllib.request import urlopen", "disallowed_import"),
+    ("import surely_not_installed_module", "missing_import"),
+    ("x = np.arange(10)", "missing_import"),
+    ("while True:\n    x = 1", "unbounded_loop"),
+    ("import itertools\nfor i in itertools.count():\n    pass", "unbounded_loop"),
+    ("import numpy as np\na = np.zeros((100000, 100000))", "large_allocation"),
+    ("def f(:\n    pass", "syntax"),
+])
+def test_problems_are_reported(code, kind):
+    assert kind in kinds(code)
+
+
+def test_loops_with_exit_are_allowed():
+    assert kinds("i = 0\nwhile True:\n    i += 1\n    if i > 10:\n        break") == []
+
+
+def test_missing_import_suggests_the_usual_alias():
+    message = format_findings(analyze_code("x = np.arange(10)"))
+    assert "import numpy as np" in message
+
+
+def test_findings_are_sorted_by_line():
+    findings = analyze_code("x = np.arange(3)\nimport socket\nplt.show()")
+    assert [finding.lineno for finding in findings] == sorted(finding.lineno for finding in findings)
+
+
+@pytest.mark.parametrize("text", [
+    "```python\nimport numpy as np\nx = np.linspace(0, 1,\n",
+    "```python\nfig, ax = plt.subplots()\nfor i in range(3):\n",
+    "Sure, here is the code:\n",
+    "```python\nimport numpy as np\n```",
+])
+def test_incomplete_stream_is_not_an_error(text):
+    assert find_partial_syntax_error(text) is None
+
+
+def test_broken_line_in_stream_is_an_error():
+    assert find_partial_syntax_error("```python\nimport numpy as np\nx = = 1\ny = 2\n") is not None
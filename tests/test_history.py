@@ -0,0 +1,77 @@
+from history import (
+    FEEDBACK_ITEM_CHARS, compact_history, estimate_text_tokens, estimate_tokens, message_text,
+)
+from repair import refine_turns, repair_turns
+from similarity import SimilarityScore
+
+
+def user(text):
+    return {"role": "user", "content": [{"type": "text", "text": text}]}
+
+
+def assistant(text):
+    return {"role": "assistant", "content": [{"type": "text", "text": text}]}
+
+
+def conversation(rounds):
+    messages = [user("把这张图转换为 matplotlib 代码")]
+    for i in range(rounds):
+        messages += [assistant(f"# 第 {i} 版\n" + "plt.plot(x, y)\n" * 50), user(f"第 {i} 次修改：把线条改粗一些")]
+    return messages
+
+
+def test_estimate_text_tokens_counts_cjk_per_character():
+    assert estimate_text_tokens("abcd" * 10) == 11
+    assert estimate_text_tokens("中文") == 3
+
+
+def test_under_budget_is_unchanged():
+    messages = conversation(3)
+    compacted, before, after = compact_history(messages, token_budget=10 ** 6)
+    assert compacted is messages
+    assert before == after == estimate_tokens(messages)
+
+
+def test_ending_with_assistant_is_unchanged():
+    messages = conversation(3)[:-1]
+    compacted, _, _ = compact_history(messages, token_budget=1)
+    assert compacted is messages
+
+
+def test_compacts_to_first_message_latest_code_and_summary():
+    messages = conversation(5)
+    compacted, before, after = compact_history(messages, token_budget=estimate_tokens(messages) // 2)
+    assert after < before
+    assert [m["role"] for m in compacted] == ["user", "assistant", "user"]
+    assert compacted[0] is messages[0]
+    assert message_text(compacted[1]).startswith("# 第 4 版")
+    summary = message_text(compacted[2])
+    assert "1. 第 0 次修改" in summary
+    assert "第 3 次修改" in summary
+    assert summary.endswith("第 4 次修改：把线条改粗一些")
+
+
+def test_drops_oldest_feedback_to_fit_budget():
+    messages = [user("原始指令")]
+    for i in range(6):
+        messages += [assistant("code"), user(f"要求 {i} " + "很长的说明" * 100)]
+    messages += [assistant("code"), user("最后的要求")]
+    compacted, _, after = compact_history(messages, token_budget=500)
+    summary = message_text(compacted[2])
+    assert after <= 500
+    assert "要求 0" not in summary
+    assert "要求 5" in summary
+    for line in summary.splitlines()[1:-1]:
+        assert len(line) <= FEEDBACK_ITEM_CHARS + len("1. ...")
+
+
+def test_repair_and_refine_turns_are_condensed():
+    messages = [user("原始指令")]
+    messages += repair_turns("code v1", "NameError: name 'x' is not defined\nTraceback ...")
+    messages += refine_turns("code v2", SimilarityScore(0.61, 0.6, 0.6, 0.6))
+    messages += [assistant("code v3"), user("最后的要求")]
+    compacted, _, _ = compact_history(messages, token_budget=estimate_tokens(messages) - 1)
+    summary = message_text(compacted[2])
+    assert "修复执行错误: NameError: name 'x' is not defined" in summary
+    assert "提高与原图的相似度（当时得分 0.61）" in summary
+    assert "Traceback" not in summary
@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+
+from jobqueue import CANCELLED, DONE, FAILED, QUEUED, RUNNING, JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.db"))
+
+
+def test_claim_takes_oldest_job_first(queue):
+    first = queue.submit("generate", {"n": 1})
+    second = queue.submit("generate", {"n": 2})
+    assert queue.position(second) == 1
+
+    job = queue.claim("w1")
+    assert (job.id, job.status, job.worker, job.attempts) == (first, RUNNING, "w1", 1)
+    assert job.payload == {"n": 1}
+    assert queue.position(second) == 0
+    assert queue.claim("w2").id == second
+    assert queue.claim("w3") is None
+
+
+def test_concurrent_claims_never_share_a_job(queue):
+    submitted = {queue.submit("generate", {"n": i}) for i in range(20)}
+    claimed = []
+
+    def work(name):
+        while True:
+            job = queue.claim(name)
+            if job is None:
+                return
+            claimed.append(job.id)
+
+    workers = [threading.Thread(target=work, args=(f"w{i}",)) for i in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert sorted(claimed) == sorted(submitted)
+
+
+def test_complete_and_fail(queue):
+    done = queue.submit("generate", {})
+    failed = queue.submit("generate", {})
+    assert queue.complete(queue.claim("w").id, {"code": "x"}, png=b"png")
+    assert queue.fail(queue.claim("w").id, "boom")
+    assert queue.get(done).status == DONE and queue.get(done).result == {"code": "x"} and queue.get(done).png == b"png"
+    assert queue.get(failed).status == FAILED and queue.get(failed).error == "boom"
+    assert queue.counts() == {DONE: 1, FAILED: 1}
+
+
+def test_cancelled_job_result_is_discarded(queue):
+    job_id = queue.submit("generate", {})
+    queue.claim("w")
+    assert queue.cancel(job_id)
+    assert not queue.complete(job_id, {"code": "x"})
+    assert queue.get(job_id).status == CANCELLED
+    assert queue.get(job_id).result is None
+
+
+def test_stale_job_is_requeued_and_claimed_again(queue):
+    job_id = queue.submit("generate", {})
+    queue.claim("crashed")
+    assert queue.requeue_stale(stale_after=60) == 0
+    assert queue.requeue_stale(stale_after=-1) == 1
+    job = queue.get(job_id)
+    assert job.status == QUEUED and job.worker is None
+
+    job = queue.claim("w2")
+    assert (job.id, job.worker, job.attempts) == (job_id, "w2", 2)
+
+
+def test_heartbeat_keeps_job_running(queue):
+    job_id = queue.submit("generate", {})
+    queue.claim("w")
+    queue.heartbeat(job_id)
+    assert queue.requeue_stale(stale_after=60) == 0
+    assert queue.get(job_id).status == RUNNING
+
+
+def test_job_failing_too_often_is_not_requeued(queue):
+    job_id = queue.submit("generate", {})
+    for _ in range(3):
+        queue.claim("crashed")
+        queue.requeue_stale(stale_after=-1, max_attempts=3)
+    job = queue.get(job_id)
+    assert job.status == FAILED
+    assert job.attempts == 3
+    assert queue.claim("w") is None
+
+
+def test_purge_removes_only_finished_jobs(queue):
+    finished = queue.submit("generate", {})
+    waiting = queue.submit("generate", {})
+    queue.cancel(finished)
+    assert queue.purge(older_than=-1) == 1
+    assert queue.get(finished) is None
+    assert queue.get(waiting).status == QUEUED
@@ -0,0 +1,52 @@
+import io
+
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+
+from panels import PANEL_PADDING, crop_panels, detect_panels
+
+
+def render(nrows, ncols, figsize, labels=False):
+    fig, axes = plt.subplots(nrows, ncols, figsize=figsize)
+    x = np.linspace(0, 10, 100)
+    for ax in np.ravel(axes):
+        ax.plot(x, np.sin(x * 0.6))
+        if labels:
+            ax.set_xlabel("time (s)")
+            ax.set_ylabel("value")
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    plt.close(fig)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("figsize", [(8, 6), (12, 6), (6, 6), (10, 4)])
+@pytest.mark.parametrize("labels", [False, True])
+@pytest.mark.parametrize("shape", [(2, 2), (1, 2), (2, 3)])
+def test_tight_layout_grid(shape, labels, figsize):
+    # 负号、刻度文字伸进子图之间的间隔时，间隔只剩几个像素宽，也要切开
+    layout = detect_panels(render(*shape, figsize, labels))
+    assert (layout.nrows, layout.ncols) == shape
+    assert len(layout.panels) == shape[0] * shape[1]
+    for panel in layout.panels:
+        assert panel.rows[1] - panel.rows[0] == 1 and panel.cols[1] - panel.cols[0] == 1
+
+
+def test_panels_do_not_overlap_and_keep_tick_labels():
+    layout = detect_panels(render(2, 2, (8, 6)))
+    boxes = [panel.box for panel in layout.panels]
+    # 同一行的子图左右相接，间隔两侧的内容（右侧子图 y 轴刻度文字的负号）不会被裁掉
+    assert abs(boxes[1][0] - boxes[0][2]) <= 2 * PANEL_PADDING
+    assert boxes[0][1] == boxes[1][1] and boxes[2][1] == boxes[3][1]
+    assert len(crop_panels(render(2, 2, (8, 6)), layout)) == 4
+
+
+@pytest.mark.parametrize("figsize", [(6, 4), (8, 6), (4, 4)])
+def test_single_axes_is_one_panel(figsize):
+    layout = detect_panels(render(1, 1, figsize, labels=True))
+    assert len(layout.panels) == 1
@@ -0,0 +1,63 @@
+import os
+import time
+
+from artifacts import _put_blob, blob_name, write_run
+from resources import collect_garbage
+from storage import LocalStorage
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"figure"
+
+
+def age(path, seconds):
+    stamp = time.time() - seconds
+    os.utime(path, (stamp, stamp))
+
+
+def test_unreferenced_old_blob_is_collected(tmp_path):
+    backend = LocalStorage(str(tmp_path))
+    digest, written = _put_blob(backend, PNG, "image/png")
+    assert written
+    path = tmp_path / blob_name(digest, "image/png")
+    age(path, 7200)
+    report = collect_garbage(str(tmp_path), tmp_max_age=3600)
+    assert report.blob_files == 1
+    assert not path.exists()
+
+
+def test_reused_blob_survives_until_manifest_is_written(tmp_path):
+    # 之前中断的保存留下了同样内容的 blob，这次保存复用它；清单写入前的清理不能删掉它
+    backend = LocalStorage(str(tmp_path))
+    digest, _ = _put_blob(backend, PNG, "image/png")
+    path = tmp_path / blob_name(digest, "image/png")
+    age(path, 7200)
+    assert _put_blob(backend, PNG, "image/png") == (digest, False)
+    assert collect_garbage(str(tmp_path), tmp_max_age=3600).blob_files == 0
+    assert path.exists()
+
+
+def test_referenced_blob_is_kept(tmp_path):
+    backend = LocalStorage(str(tmp_path))
+    write_run(backend, "run", "print(1)", "doc", [], figure=PNG)
+    for current, _, files in os.walk(tmp_path):
+        for name in files:
+            age(os.path.join(current, name), 7200)
+    assert collect_garbage(str(tmp_path), tmp_max_age=3600).blob_files == 0
+
+
+def test_interrupted_write_is_collected(tmp_path):
+    leftover = tmp_path / "runs" / ".tmp_abc"
+    leftover.parent.mkdir()
+    leftover.write_bytes(b"partial")
+    assert collect_garbage(str(tmp_path), tmp_max_age=3600).tmp_files == 0
+    age(leftover, 7200)
+    assert collect_garbage(str(tmp_path), tmp_max_age=3600).tmp_files == 1
+    assert not leftover.exists()
+
+
+def test_other_files_in_root_are_kept(tmp_path):
+    # 存储目录可能就是工作目录，名字像生成图像的文件也不是存储写入的
+    stray = tmp_path / "20241222_1812_image.png"
+    stray.write_bytes(PNG)
+    age(stray, 400 * 86400)
+    assert not any(collect_garbage(str(tmp_path), tmp_max_age=0))
+    assert stray.exists()
@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from routing import DEFAULT_VARIANT, Route, RouteStats, Router
+
+CHEAP = "claude-3-5-haiku-20241022"
+STRONG = "claude-3-5-sonnet-20241022"
+
+
+def record(stats, model, successes, failures, cost, variant=DEFAULT_VARIANT):
+    for i in range(successes + failures):
+        stats.record(model, variant, i < successes, 1.0, cost)
+
+
+def test_plan_tries_cheap_model_without_data():
+    router = Router([CHEAP, STRONG], stats=RouteStats())
+    assert router.plan() == [CHEAP, STRONG]
+    assert router.model_for(0) == CHEAP
+    assert router.model_for(5) == STRONG
+
+
+def test_plan_keeps_cheap_model_that_usually_succeeds():
+    stats = RouteStats()
+    record(stats, CHEAP, 9, 1, 0.001)
+    record(stats, STRONG, 10, 0, 0.01)
+    assert Router([CHEAP, STRONG], stats=stats).plan() == [CHEAP, STRONG]
+
+
+def test_plan_skips_cheap_model_that_rarely_succeeds():
+    stats = RouteStats()
+    record(stats, CHEAP, 1, 9, 0.004)
+    record(stats, STRONG, 10, 0, 0.01)
+    assert Router([CHEAP, STRONG], stats=stats).plan() == [STRONG]
+
+
+def test_plan_ignores_combinations_below_min_samples():
+    stats = RouteStats()
+    record(stats, CHEAP, 0, 5, 0.004)
+    assert Router([CHEAP, STRONG], stats=stats, min_samples=10).plan() == [CHEAP, STRONG]
+
+
+def test_fan_out_covers_models_first():
+    router = Router([CHEAP, STRONG], variants=["default", "data"], fan_out=True, stats=RouteStats())
+    routes = router.routes(0, 4)
+    assert {route.model for route in routes[:2]} == {CHEAP, STRONG}
+    assert len(set(routes)) == 4
+
+
+def test_without_fan_out_all_candidates_share_a_route():
+    router = Router([CHEAP, STRONG], stats=RouteStats())
+    assert router.routes(1, 3) == [Route(STRONG, DEFAULT_VARIANT)] * 3
+
+
+def test_unknown_variant_is_rejected():
+    with pytest.raises(ValueError, match="nope"):
+        Router([CHEAP], variants=["default", "nope"], stats=RouteStats())
+
+
+def write_log(path, events):
+    with open(path, "w", encoding="utf-8") as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+
+
+def route_event(ok, model=CHEAP):
+    return {"event": "route", "model": model, "variant": "default", "ok": ok, "seconds": 1.0, "cost": 0.001}
+
+
+def test_load_log_reads_everything_by_default(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    write_log(path, [route_event(False)] * 5 + [{"event": "stage", "stage": "api"}] + [route_event(True)] * 5)
+    stats = RouteStats()
+    assert stats.load_log(path) == 10
+    assert stats.summary(CHEAP).success_rate == 0.5
+
+
+def test_load_log_reads_only_the_tail(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    write_log(path, [route_event(False)] * 100 + [route_event(True)] * 10)
+    line = len(json.dumps(route_event(True))) + 1
+    stats = RouteStats()
+    assert stats.load_log(path, max_bytes=10 * line) == 10
+    assert stats.summary(CHEAP).success_rate == 1.0
+
+    stats = RouteStats()
+    assert stats.load_log(path, max_bytes=10 * line + line // 2) == 10
@@ -0,0 +1,76 @@
+import base64
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from similarity import compare, compare_images, prepare_reference, reference_from_messages
+
+
+def render(kind="line", color="#1f77b4", size=(6, 4), dpi=60, transparent=False):
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=size)
+    ax = fig.subplots()
+    x = np.linspace(0, 10, 100)
+    if kind == "line":
+        ax.plot(x, np.sin(x), color=color, linewidth=2)
+    else:
+        ax.bar(range(6), [3, 1, 4, 1, 5, 9], color=color)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=dpi, transparent=transparent)
+    return buffer.getvalue()
+
+
+@pytest.fixture(scope="module")
+def original():
+    return render()
+
+
+def test_identical_images_score_one(original):
+    score = compare_images(original, original)
+    assert score.score == pytest.approx(1.0)
+    assert score.ssim == pytest.approx(1.0)
+
+
+def test_same_figure_at_another_resolution_is_similar(original):
+    assert compare_images(original, render(dpi=100)).score > 0.8
+
+
+def test_recolored_figure_loses_color_score(original):
+    score = compare_images(original, render(color="#d62728"))
+    assert score.color < 0.8
+    assert score.edges > 0.6
+
+
+def test_different_chart_scores_lower(original):
+    same = compare_images(original, render(dpi=100)).score
+    different = compare_images(original, render(kind="bar", color="#2ca02c")).score
+    assert different < same - 0.2
+
+
+def test_transparent_background_is_white(original):
+    assert compare_images(original, render(transparent=True)).score > 0.95
+
+
+def test_reference_is_reusable(original):
+    reference = prepare_reference(original)
+    candidate = render(kind="bar")
+    assert compare(reference, candidate) == compare_images(original, candidate)
+
+
+def test_reference_from_messages(original):
+    image = {"type": "base64", "media_type": "image/png", "data": base64.standard_b64encode(original).decode()}
+    messages = [{"role": "user", "content": [{"type": "image", "source": image}, {"type": "text", "text": "复现"}]}]
+    reference = reference_from_messages(messages)
+    assert np.array_equal(reference.rgb, prepare_reference(original).rgb)
+    assert reference_from_messages([{"role": "user", "content": "只有文字"}]) is None
+
+
+def test_scores_are_bounded(original):
+    noise = np.random.default_rng(0).integers(0, 256, (120, 180, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(noise).save(buffer, format="PNG")
+    score = compare_images(original, buffer.getvalue())
+    assert all(0.0 <= value <= 1.0 for value in score)
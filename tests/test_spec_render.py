@@ -0,0 +1,69 @@
+import io
+import json
+
+import pytest
+from PIL import Image
+
+from repair import render_spec_reply
+from spec_render import MAX_AXES, SpecError, build_ops, parse_spec, render_spec
+
+LINE = {"type": "line", "x": {"start": 0, "stop": 1, "num": 5}, "y": [0, 1, 4, 9, 16], "color": "#d62728"}
+
+
+def test_parse_spec_accepts_fenced_reply():
+    reply = "规格如下:\n```json\n" + json.dumps({"axes": [{"series": [LINE]}]}) + "\n```"
+    assert parse_spec(reply)["axes"][0]["series"][0]["type"] == "line"
+
+
+@pytest.mark.parametrize("reply, message", [
+    ("没有 JSON", "没有 JSON"),
+    ("{\"axes\": [}", "JSON 格式错误"),
+    ('{"axes": [{"series": [{"type": "line", "x": [1, NaN], "y": [1, 2]}]}]}', "NaN"),
+    ('{"axes": []}', "axes"),
+    ('{"axes": [{"series": [{"type": "line", "x": [1, 2], "y": [1]}]}]}', "长度不一致"),
+    ('{"axes": [{"series": [{"type": "sankey"}]}]}', "sankey"),
+    ('{"size": [0, 5], "series": []}', "size"),
+])
+def test_parse_spec_rejects_invalid_specs(reply, message):
+    with pytest.raises(SpecError, match=message):
+        parse_spec(reply)
+
+
+def test_build_ops_single_axes_shorthand():
+    rows, cols, size, ops = build_ops({"size": [6, 4], "title": "t", "series": [LINE]})
+    assert (rows, cols, size) == (1, 1, (6.0, 4.0))
+    plot = next(op for op in ops if op.method == "plot")
+    assert plot.target == 0 and plot.kwargs["color"] == "#d62728"
+    assert list(plot.args[0].values) == [0, 0.25, 0.5, 0.75, 1]
+    assert ops[-1].method == "suptitle"
+
+
+def test_build_ops_removes_unused_cells():
+    axes = [{"series": [LINE]}] * 3
+    rows, cols, _, ops = build_ops({"layout": [2, 2], "axes": axes})
+    assert (rows, cols) == (2, 2)
+    assert [op.target for op in ops if op.method == "remove"] == [3]
+
+
+def test_build_ops_limits_axes():
+    with pytest.raises(SpecError):
+        build_ops({"axes": [{"series": [LINE]}] * (MAX_AXES + 1), "layout": [MAX_AXES + 1, 1]})
+
+
+def test_render_spec_size_and_dpi():
+    png = render_spec(parse_spec(json.dumps({"size": [4, 3], "series": [LINE]})), dpi=50)
+    assert Image.open(io.BytesIO(png)).size == (200, 150)
+
+
+def test_render_spec_reply_renders_without_sandbox():
+    code, result = render_spec_reply(json.dumps({"series": [LINE]}), dpi=40, figsize=(5, 2), fast=True, preview=True)
+    assert result.ok and result.error is None
+    assert Image.open(io.BytesIO(result.png)).size == (200, 80)
+    assert "ax.plot(" in code
+
+
+def test_render_spec_reply_reports_invalid_spec():
+    code, result = render_spec_reply("not json")
+    assert code is None
+    assert not result.ok and result.png is None
+    assert result.error.startswith("数据规格无效")
@@ -0,0 +1,211 @@
+"""
+任务队列的工作进程。
+
+从 jobqueue.py 的 SQLite 队列中领取任务，调用 API、在沙箱中执行代码，并把结果写回队列。
+每个工作进程一次处理一个任务，各自拥有一个沙箱进程池；主进程负责补充退出的工作进程，
+并定期把心跳超时的任务放回队列。
+
+用法:
+    python worker.py --db jobs.db --workers 4 --exec-workers 1
+    JOB_QUEUE_DB=jobs.db streamlit run app.py
+
+任务类型:
+    generate  payload: messages, max_retries, n_candidates, token_budget, similarity_threshold, exec_options,
+                       routing（models、variants、fan_out，见 routing.Router），output_format（code 或 spec），
+                       split_panels（原图是组合图时拆分子图并发复现，见 panels.py）
+              结果: code, reply, messages, attempts, score；生成的 PNG 存在任务的 png 字段
+    doc       payload: messages；结果: text
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+
+POLL_INTERVAL = 0.5
+HEARTBEAT_INTERVAL = 10.0
+RETENTION_SECONDS = 7 * 24 * 3600  # 结束超过 7 天的任务会被删除
+
+
+def _run_panels(payload, pool, router):
+    """拆分子图并发复现；原图只有一个子图时返回 None"""
+    from claude_client import run_sync
+    from history import first_image_bytes
+    from panels import detect_panels, reconstruct_panels
+
+    image = first_image_bytes(payload["messages"])
+    layout = detect_panels(image) if image is not None else None
+    if layout is None or len(layout.panels) < 2:
+        return None
+    outcome = run_sync(reconstruct_panels(
+        image, pool, layout, max_retries=payload.get("max_retries", 3),
+        exec_options=payload.get("exec_options"), router=router,
+    ))
+    if not outcome.result.ok:
+        raise RuntimeError(f"拼合子图的代码执行失败: {outcome.result.error}")
+    result = {
+        "code": outcome.code,
+        "reply": None,
+        "messages": payload["messages"],
+        "attempts": outcome.attempts,
+        "score": None,
+        "panels": len(layout.panels),
+    }
+    return result, outcome.result.png
+
+
+def _run_generate(payload, pool):
+    from claude_client import run_sync
+    from repair import generate_with_repair
+    from routing import Router
+
+    routing = payload.get("routing")
+    router = Router(**routing) if routing else None
+    # 子图按 draw_panel(ax) 函数生成，数据规格模式下整张生成
+    if payload.get("split_panels") and payload.get("output_format", "code") == "code":
+        panels = _run_panels(payload, pool, router)
+        if panels is not None:
+            return panels
+    outcome = run_sync(generate_with_repair(
+        payload["messages"],
+        pool,
+        max_retries=payload.get("max_retries", 3),
+        n_candidates=payload.get("n_candidates", 1),
+        token_budget=payload.get("token_budget"),
+        similarity_threshold=payload.get("similarity_threshold"),
+        exec_options=payload.get("exec_options"),
+        router=router,
+        output_format=payload.get("output_format", "code"),
+    ))
+    if not outcome.ok:
+        raise RuntimeError(f"已达到最大重试次数，无法成功生成图表: {outcome.error}")
+    result = {
+        "code": outcome.code,
+        "reply": outcome.reply,
+        "messages": outcome.messages,
+        "attempts": outcome.attempts,
+        "score": outcome.score._asdict() if outcome.score else None,
+    }
+    return result, outcome.result.png
+
+
+def _run_doc(payload, pool):
+    from claude_client import create_message
+
+    # 文档请求只发送一次，不加提示缓存标记
+    response = create_message(payload["messages"], prompt_cache=False)
+    return {"text": response.content[0].text}, None
+
+
+HANDLERS = {
+    "generate": _run_generate,
+    "doc": _run_doc,
+}
+
+
+def run_job(queue, job, pool):
+    """运行一个任务，期间在后台线程中更新心跳"""
+    import metrics
+
+    done = threading.Event()
+
+    def beat():
+        while not done.wait(HEARTBEAT_INTERVAL):
+            queue.heartbeat(job.id)
+
+    heart = threading.Thread(target=beat, daemon=True)
+    heart.start()
+    try:
+        with metrics.request_scope(job.id), metrics.timed("job", kind=job.kind):
+            handler = HANDLERS.get(job.kind)
+            if handler is None:
+                raise ValueError(f"未知的任务类型: {job.kind}")
+            result, png = handler(job.payload, pool)
+        queue.complete(job.id, result, png)
+    except Exception as e:
+        queue.fail(job.id, f"{type(e).__name__}: {e}\n{traceback.format_exc()}")
+    finally:
+        done.set()
+        heart.join()
+
+
+def worker_main(db_path, exec_workers, stop_event):
+    """工作进程主循环"""
+    from jobqueue import JobQueue
+    from sandbox import SandboxPool
+
+    # Ctrl+C 由主进程处理，工作进程跑完当前任务后再退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    queue = JobQueue(db_path)
+    pool = SandboxPool(workers=exec_workers)
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    try:
+        while not stop_event.is_set():
+            job = queue.claim(name)
+            if job is None:
+                stop_event.wait(POLL_INTERVAL)
+                continue
+            run_job(queue, job, pool)
+    finally:
+        pool.close()
+
+
+def serve(db_path, workers=2, exec_workers=1):
+    """启动 workers 个工作进程并一直运行，直到收到 SIGINT / SIGTERM"""
+    from jobqueue import JobQueue
+
+    queue = JobQueue(db_path)
+    # 工作进程还要创建沙箱子进程，不能是守护进程；用 spawn 避免继承主进程的线程和连接
+    context = multiprocessing.get_context("spawn")
+    stop_event = context.Event()
+
+    def start():
+        process = context.Process(target=worker_main, args=(db_path, exec_workers, stop_event),
+                                  name="figure-worker")
+        process.start()
+        return process
+
+    def on_sigterm(signum, frame):
+        # 不能在信号处理函数里调用 stop_event.set()：主线程可能正在同一个 Event 上等待，会死锁
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    processes = [start() for _ in range(workers)]
+    print(f"已启动 {workers} 个工作进程，任务数据库: {db_path}")
+    last_purge = 0.0
+    try:
+        while True:
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    print(f"工作进程 {process.pid} 已退出（退出码 {process.exitcode}），重新启动")
+                    processes[i] = start()
+            requeued = queue.requeue_stale()
+            if requeued:
+                print(f"{requeued} 个任务的心跳超时，已重新放回队列或标记为失败")
+            if time.time() - last_purge > 3600:
+                queue.purge(RETENTION_SECONDS)
+                last_purge = time.time()
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("正在等待工作进程完成当前任务...")
+        stop_event.set()
+        for process in processes:
+            process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="任务队列的工作进程")
+    parser.add_argument("--db", default=os.environ.get("JOB_QUEUE_DB", "jobs.db"), help="任务数据库路径")
+    parser.add_argument("--workers", type=int, default=2, help="工作进程数，即同时处理的任务数")
+    parser.add_argument("--exec-workers", type=int, default=1, help="每个工作进程的沙箱进程数")
+    args = parser.parse_args()
+    serve(args.db, args.workers, args.exec_workers)
+
+
+if __name__ == "__main__":
+    main()